@@ -1,3 +1,7 @@
+import asyncio
+import json
+
+import aiohttp
 import requests
 import logging
 from collections import defaultdict
@@ -5,8 +9,10 @@ from collections import defaultdict
 import time
 
 from src.api import ReportableError
+from src.api.rate_limiter import RateLimiter, TokenBucket
 
 API_URL = "https://us.api.battle.net/"
+REGION_API_URL = "https://%s.api.battle.net/"
 logger = logging.getLogger("SimBot")
 
 
@@ -20,21 +26,31 @@ class BattleNet:
     # API rate limits
     BNET_MAX_CALLS_SEC = 100
     BNET_MAX_CALLS_HR = 36000
+    # share of each limit that can be used in a burst, the rest is refilled over the limit's window
+    BNET_BURST_FRACTION = 0.1
 
-    def __init__(self, api_key):
-        self._api_key = api_key
+    # character fields simc needs to import a character, as armory= requests them
+    CHARACTER_FIELDS = "talents,items,professions"
+
+    # shared by every BattleNet in the process, since the quota belongs to the API key
+    rate_limiter = RateLimiter({
+        "second": TokenBucket.for_limit(BNET_MAX_CALLS_SEC, 1, BNET_BURST_FRACTION),
+        "hour": TokenBucket.for_limit(BNET_MAX_CALLS_HR, 3600, BNET_BURST_FRACTION),
+    })
 
-        # running totals of API calls quota
-        self._calls_sec = 0
-        self._calls_hr = 0
+    def __init__(self, api_key, roster_cache=None, roster_ttl=0):
+        """
+        :param api_key: Battle.net API key
+        :param roster_cache: Optional SqliteCache of guild rosters
+        :param roster_ttl: Seconds a cached roster is used without asking Battle.net whether it changed
+        """
+        self._api_key = api_key
 
-        self._sec_ticker = time.time()
-        self._hr_ticker = time.time()
+        self._roster_cache = roster_cache
+        self._roster_ttl = roster_ttl
 
         # cache responses
         # TODO cache these responses
-        # TODO this should be moved to mongo eventually, with a timeout/stale time
-        self.guild_members_cache = {}
         self.talents_cache = {}
 
     def get_guild_members(self, realm, guild_name, locale, level):
@@ -61,8 +77,32 @@ class BattleNet:
             logger.error(message)
             raise ValueError(message)
 
+        cache_key = json.dumps([realm.lower(), guild_name.lower(), locale, level])
+        cached = None
+        headers = {}
+
+        if self._roster_cache is not None:
+            cached, stored_at = self._roster_cache.get_entry(cache_key)
+
+            if cached is not None:
+                if time.time() - stored_at < self._roster_ttl:
+                    logger.debug("Using cached roster for guild '%s', realm '%s'", guild_name, realm)
+
+                    return defaultdict(list, cached["names"]), cached["basic_names"]
+
+                if cached["last_modified"]:
+                    # stale, only download the roster again if it changed
+                    headers["If-Modified-Since"] = cached["last_modified"]
+
         r = self.bnet_request(requests.get, API_URL + "wow/guild/%s/%s" % (realm, guild_name),
-                              params={"fields": "members", "locale": locale, "apikey": self._api_key})
+                              params={"fields": "members", "locale": locale, "apikey": self._api_key},
+                              headers=headers)
+
+        if r.status_code == 304 and cached is not None:
+            logger.debug("Cached roster for guild '%s', realm '%s' is unchanged", guild_name, realm)
+            self._roster_cache.touch(cache_key)
+
+            return defaultdict(list, cached["names"]), cached["basic_names"]
 
         raw = r.json()
         names = defaultdict(list)
@@ -96,6 +136,13 @@ class BattleNet:
                 else:
                     logger.error("Character %s does not have a spec!", character['name'])
 
+        if self._roster_cache is not None:
+            self._roster_cache.put(cache_key, {
+                "names": names,
+                "basic_names": basic_names,
+                "last_modified": getattr(r, "headers", {}).get("Last-Modified")
+            })
+
         return names, basic_names
 
     def get_all_talents(self, locale):
@@ -113,36 +160,82 @@ class BattleNet:
 
         return r.json()
 
+    async def get_characters(self, characters, region, locale, max_concurrent_requests):
+        """
+        Gets the Bnet profiles (gear, talents, professions) of many characters concurrently, over one keep-alive
+        connection pool.
+        :param characters: List of (character name, realm slug) tuples
+        :param region: Region of the characters
+        :param locale:
+        :param max_concurrent_requests: Maximum requests in flight at once
+        :return: List with each character's Bnet character json, or None if it could not be fetched
+        """
+        connector = aiohttp.TCPConnector(limit=max_concurrent_requests)
+        params = {"fields": self.CHARACTER_FIELDS, "locale": locale, "apikey": self._api_key}
+
+        async def fetch(session, character_name, realm_slug):
+            url = REGION_API_URL % region.lower() + "wow/character/%s/%s" % (realm_slug, character_name)
+
+            try:
+                status_code, raw = await self.bnet_request_async(session, url, params)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                logger.error("Unable to retrieve bnet profile of character %s, realm %s: %s", character_name,
+                             realm_slug, e)
+                return None
+
+            if status_code != 200:
+                logger.error("Unable to retrieve bnet profile of character %s, realm %s (code %d)", character_name,
+                             realm_slug, status_code)
+                return None
+
+            return raw
+
+        async with aiohttp.ClientSession(connector=connector) as session:
+            return await asyncio.gather(*[fetch(session, name, realm_slug) for name, realm_slug in characters])
+
+    async def bnet_request_async(self, session, url, params):
+        """
+        Makes an API call on an aiohttp session, first waiting as long as needed to stay within the API rate limits.
+        :return: (status code, response json)
+        """
+        waited = await self.rate_limiter.acquire_async()
+
+        if waited:
+            logger.debug("Delayed Bnet request %.2f sec for rate limit", waited)
+
+        start = time.time()
+
+        async with session.get(url, params=params) as r:
+            raw = await r.json(content_type=None)
+
+        logger.debug("Bnet request complete (%d ms) - (%s)", (time.time() - start) * 1000, url)
+
+        return r.status, raw
+
     def bnet_request(self, req_func, *args, **kwargs):
         """
-        Monitors rate of API calls to warn if rates are exceeded.
+        Makes an API call, first waiting as long as needed to stay within the API rate limits.
         :param req_func: Function to call
         :param args:
         :param kwargs:
         :return:
         """
-        if self._calls_sec > self.BNET_MAX_CALLS_SEC:
-            logger.error("API call/sec rate %d exceeded max %d", self._calls_sec, self.BNET_MAX_CALLS_SEC)
-        elif self._calls_hr > self.BNET_MAX_CALLS_HR:
-            logger.error("API call/hr rate %d exceeded max %d", self._calls_hr, self.BNET_MAX_CALLS_HR)
+        waited = self.rate_limiter.acquire()
+
+        if waited:
+            logger.debug("Delayed Bnet request %.2f sec for rate limit", waited)
 
         start = time.time()
         r = req_func(*args, **kwargs)
         dur = time.time() - start
 
-        logger.debug("Bnet request complete (%d ms) - (%s). In last hour: %d", dur, r.url, self._calls_hr)
-        self._calls_sec += 1
-        self._calls_hr += 1
-
-        # reset quotas if time is up
-        curr_time = time.time()
-
-        if curr_time - self._sec_ticker >= 1:
-            self._calls_sec = 0
-            self._sec_ticker = curr_time
-
-        if curr_time - self._hr_ticker >= 3600:
-            self._calls_hr = 0
-            self._hr_ticker = curr_time
+        logger.debug("Bnet request complete (%d ms) - (%s)", dur * 1000, r.url)
 
         return r
+
+    def get_rate_limit_levels(self):
+        """
+        Calls that can currently be made without waiting, per rate limit window.
+        :return: Dict of "second" and "hour" bucket levels
+        """
+        return self.rate_limiter.levels()
@@ -0,0 +1,168 @@
+import asyncio
+import threading
+import time
+
+
+class TokenBucket:
+    def __init__(self, capacity, refill_rate):
+        """
+        :param capacity: Maximum tokens held, i.e. the largest burst allowed
+        :param refill_rate: Tokens added per second
+        """
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+
+        self._tokens = float(capacity)
+        self._last_refill = time.monotonic()
+
+    @classmethod
+    def for_limit(cls, max_calls, window_sec, burst_fraction):
+        """
+        Bucket that never allows more than max_calls in any window_sec long window.
+        Burst plus refill over one window equals max_calls.
+        :param max_calls: Calls allowed per window
+        :param window_sec: Window length in seconds
+        :param burst_fraction: Fraction of max_calls that may be made back to back
+        :return: TokenBucket
+        """
+        capacity = max(1, int(max_calls * burst_fraction))
+
+        return cls(capacity, (max_calls - capacity) / window_sec)
+
+    def refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.refill_rate)
+        self._last_refill = now
+
+    def level(self):
+        return self._tokens
+
+    def wait_time(self):
+        """
+        :return: Seconds until a token is available, 0 if one is available now
+        """
+        if self._tokens >= 1:
+            return 0
+
+        return (1 - self._tokens) / self.refill_rate
+
+    def take(self):
+        self._tokens -= 1
+
+
+class RateLimiter:
+    def __init__(self, buckets):
+        """
+        Delays callers so every bucket's limit is respected. Safe to share between threads and event loops.
+        :param buckets: Dict of bucket name to TokenBucket. A call takes one token from each bucket.
+        """
+        self._buckets = buckets
+        self._lock = threading.Lock()
+
+    def _try_take(self):
+        """
+        Takes a token from every bucket if all have one.
+        :return: 0 if the call may proceed, otherwise seconds to wait before trying again
+        """
+        with self._lock:
+            now = time.monotonic()
+
+            for bucket in self._buckets.values():
+                bucket.refill(now)
+
+            wait = max(bucket.wait_time() for bucket in self._buckets.values())
+
+            if wait == 0:
+                for bucket in self._buckets.values():
+                    bucket.take()
+
+            return wait
+
+    def acquire(self):
+        """
+        Blocks until a call is allowed.
+        :return: Seconds spent waiting
+        """
+        waited = 0
+
+        wait = self._try_take()
+        while wait:
+            time.sleep(wait)
+            waited += wait
+            wait = self._try_take()
+
+        return waited
+
+    async def acquire_async(self):
+        """
+        Waits, without blocking the event loop, until a call is allowed.
+        :return: Seconds spent waiting
+        """
+        waited = 0
+
+        wait = self._try_take()
+        while wait:
+            await asyncio.sleep(wait)
+            waited += wait
+            wait = self._try_take()
+
+        return waited
+
+    def levels(self):
+        """
+        :return: Dict of bucket name to tokens currently available
+        """
+        with self._lock:
+            now = time.monotonic()
+            levels = {}
+
+            for name, bucket in self._buckets.items():
+                bucket.refill(now)
+                levels[name] = bucket.level()
+
+            return levels
+
+
+class AdaptiveConcurrency:
+    def __init__(self, initial, maximum, minimum=1, decrease_factor=0.5):
+        """
+        Concurrency limit that adapts to a remote service with AIMD (additive increase, multiplicative decrease):
+        it grows by about one slot per round of successful calls, and shrinks by decrease_factor whenever the
+        service throttles or fails. Use from a single event loop.
+        :param initial: Starting limit
+        :param maximum: Largest limit, e.g. the concurrency paid for
+        :param minimum: Smallest limit
+        :param decrease_factor: Limit is multiplied by this on throttling
+        """
+        self.limit = float(initial)
+        self.maximum = maximum
+        self.minimum = minimum
+        self.decrease_factor = decrease_factor
+
+        self.in_flight = 0
+        self._condition = None
+
+    async def acquire(self):
+        """
+        Waits until a call may start.
+        """
+        if self._condition is None:
+            # created on first use, so it belongs to the loop the calls run on
+            self._condition = asyncio.Condition()
+
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self, throttled):
+        """
+        Ends a call started with acquire.
+        :param throttled: True if the service throttled or failed the call
+        """
+        if throttled:
+            self.limit = max(self.minimum, self.limit * self.decrease_factor)
+        else:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
@@ -1,7 +1,13 @@
 import asyncio
+import hashlib
+from collections import namedtuple
 import json
 import logging
 import os
+import re
+import tempfile
+
+from src.cache.sim_cache import SimCache
 
 logger = logging.getLogger("SimBot")
 
@@ -10,8 +16,33 @@ class SimulationcraftProcessError(Exception):
     pass
 
 
+# one distinct sim
+SimJob = namedtuple("SimJob", ["character_name", "realm_slug", "region", "spec", "talent_string", "fight_style",
+                               "iterations", "target_error"])
+# target_error is optional, namedtuple's defaults argument needs Python 3.7 and Lambda runs 3.6
+SimJob.__new__.__defaults__ = (None,)
+
+
 class SimulationCraft:
-    def __init__(self, simc_path, simc_timeout, config_path):
+    # simc's default confidence level for DPS error, used if a json report does not state it
+    DEFAULT_CONFIDENCE_ESTIMATOR = 1.96
+
+    # sims of a suite run one at a time, the local connector caps the number of suites running instead
+    parallel = False
+
+    def __init__(self, simc_path, simc_timeout, config_path, sim_cache=None, batch_size=1, batch_window=0.05,
+                 output_format="text", boss_profiles=None):
+        """
+        :param simc_path: Absolute path of simc executable
+        :param simc_timeout: Timeout, in seconds, of each individual simulation
+        :param config_path: Config directory containing boss_profiles.json, unused if boss_profiles is given
+        :param sim_cache: Optional SimCache consulted before spawning simc
+        :param batch_size: Maximum sims run_sim packs into one simc process. 1 runs every sim in its own process.
+        :param batch_window: Seconds run_sim waits for more sims to join a batch that is not full
+        :param output_format: "json" reads results from a json2 report with the text report discarded,
+                              "text" scrapes them from the text report on stdout
+        :param boss_profiles: Boss profiles already loaded, e.g. kept by a warm Lambda worker
+        """
         if not os.path.isfile(simc_path):
             logger.error("Unable to find simcraft executable at location %s", simc_path)
             raise RuntimeError("Unable to find simcraft executable at location " + simc_path)
@@ -23,14 +54,125 @@ class SimulationCraft:
             logging.error("Simc path incomplete (must end with simc executable")
             raise RuntimeError("Simc path incomplete (must end with simc executable")
 
-        with open(os.path.join(config_path, "boss_profiles.json"), 'r') as f:
-            self.boss_profiles = json.loads(f.read())
+        if boss_profiles is None:
+            with open(os.path.join(config_path, "boss_profiles.json"), 'r') as f:
+                boss_profiles = json.loads(f.read())
+
+        self.boss_profiles = boss_profiles
+
+        if output_format not in ("json", "text"):
+            raise RuntimeError("Unknown simc output format " + output_format)
 
         self._simc_timeout = simc_timeout
+        self._sim_cache = sim_cache
+        self._output_format = output_format
+
+        # results of sims run by this instance, used when there is no persistent cache
+        self._results = {}
+        # futures of sims currently running, by cache key, so identical concurrent sims run once
+        self._in_flight = {}
+
+        # local profile files simc imports characters from instead of the armory,
+        # by (character name, realm slug, region): (file path, profile hash)
+        self._character_profiles = {}
+
+        self.simc_version = self.get_simc_version(simc_path)
+
+        self._batch_size = batch_size
+        self._batch_window = batch_window
+        # batches waiting to be run, by (iterations, fight style, simc_stderr, target error)
+        self._pending_batches = {}
+        # tasks of batches being run, the event loop only keeps weak references to them
+        self._batch_tasks = set()
+
+    @staticmethod
+    def get_simc_version(simc_path):
+        """
+        Identifies the simc build, so cached results are not reused across simc upgrades.
+        :param simc_path:
+        :return: Short hash of the executable's size and modification time
+        """
+        stat = os.stat(simc_path)
+
+        return hashlib.sha1(("%d-%d" % (stat.st_size, stat.st_mtime)).encode('utf-8')).hexdigest()[:12]
+
+    def cache_key(self, job):
+        """
+        :param job: SimJob
+        :return: Key of the job's result in the sim cache
+        """
+        return SimCache.make_key(simc_version=self.simc_version,
+                                 profile_hash=self.character_profile(job.character_name, job.realm_slug,
+                                                                     job.region)[1],
+                                 **job._asdict())
+
+    def set_character_profile(self, character_name, realm_slug, region, profile_path, profile_hash):
+        """
+        Sims a character from a local Bnet character json file, instead of importing it from the armory.
+        :param profile_path: Bnet character json file, see ProfileStore
+        :param profile_hash: Hash of the profile, part of the sim cache key so gear changes are simmed again
+        """
+        self._character_profiles[(character_name.lower(), realm_slug.lower(), region.upper())] = (profile_path,
+                                                                                                   profile_hash)
+
+    def character_profile(self, character_name, realm_slug, region):
+        """
+        :return: (profile file path, profile hash), (None, None) if the character is imported from the armory
+        """
+        return self._character_profiles.get((character_name.lower(), realm_slug.lower(), region.upper()),
+                                            (None, None))
+
+    def forget_results(self):
+        """
+        Forgets the results of sims this instance ran, so long-lived instances neither grow without bound nor
+        answer with DPS from before a gear change. Results in the sim cache are kept.
+        """
+        self._results.clear()
+
+    def cached_result(self, job):
+        """
+        :param job: SimJob
+        :return: Result of the job in the sim cache, or None if it is not cached
+        """
+        if self._sim_cache is None:
+            return None
+
+        return self._sim_cache.get(self.cache_key(job))
+
+    def store_result(self, job, result):
+        """
+        Stores the result of a job simmed elsewhere, e.g. on Lambda, in the sim cache.
+        :param job: SimJob
+        :param result: Result dict of run_sim_result
+        """
+        if self._sim_cache is not None:
+            self._sim_cache.put(self.cache_key(job), result)
+
+    def is_cached(self, job):
+        """
+        :param job: SimJob
+        :return: True if run_sim would return a stored result for this job without running simc
+        """
+        cache_key = self.cache_key(job)
+
+        return cache_key in self._results or (self._sim_cache is not None and
+                                              self._sim_cache.get(cache_key) is not None)
+
+    async def run_sim(self, character_name, realm_slug, region, spec, talent_string, iterations, simc_stderr=False,
+                      fight_style=None, target_error=None):
+        """
+        Runs an async sim with the given params, or returns the cached result of an identical sim
+        :return: Coroutine containing the resulting simmed DPS, or False if sim timed out
+        """
+        result = await self.run_sim_result(character_name, realm_slug, region, spec, talent_string, iterations,
+                                           simc_stderr, fight_style, target_error)
+
+        return result["dps"] if result else False
 
-    async def run_sim(self, character_name, realm_slug, region, spec, talent_string, iterations, simc_stderr=False):
+    async def run_sim_result(self, character_name, realm_slug, region, spec, talent_string, iterations,
+                             simc_stderr=False, fight_style=None, target_error=None):
         """
-        Runs an async sim with the given params
+        Like run_sim, with everything known about the sim
         :param iterations: Simcraft iterations
         :param talent_string: Simcraft talent string, 7 digits 1-3
         :param spec: Spec string
@@ -38,24 +180,213 @@ class SimulationCraft:
         :param realm_slug: Realm slug
         :param character_name: Character name
         :param simc_stderr: Pipe stderr back to python? Seems to not work on Windows
-        :return: Coroutine containing the resulting simmed DPS, or False if sim timed out
+        :param fight_style: simc fight style from boss_profiles.json, or None for the simc default
+        :param target_error: DPS error, in percent of DPS, at which simc stops the sim. iterations is then the most
+                             iterations simc runs. None runs exactly iterations.
+        :return: Coroutine containing a dict of the simmed "dps", and with json output also "dps_error",
+                 "iterations" actually run and "elapsed_time" of the simc process. False if sim timed out.
         """
+        cache_key = self.cache_key(SimJob(character_name, realm_slug, region, spec, talent_string, fight_style,
+                                          iterations, target_error))
 
-        sim_string = "armory=%s,%s,%s spec=%s talents=%s iterations=%d" % (
-            region, realm_slug, character_name, spec, talent_string, iterations)
-        logger.debug("Simming with string %s", sim_string)
+        if cache_key in self._results:
+            return self._results[cache_key]
+
+        if self._sim_cache is not None:
+            cached = self._sim_cache.get(cache_key)
+
+            if cached is not None:
+                logger.debug("Using cached sim (%d) for player %s spec %s fight style %s", cached["dps"],
+                             character_name, spec, fight_style)
+                self._results[cache_key] = cached
+
+                return cached
+
+        if cache_key in self._in_flight:
+            return await asyncio.shield(self._in_flight[cache_key])
+
+        future = asyncio.get_event_loop().create_future()
+        self._in_flight[cache_key] = future
+
+        try:
+            result = await self._run_uncached(character_name, realm_slug, region, spec, talent_string, iterations,
+                                              simc_stderr, fight_style, target_error)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # marks the exception as retrieved when no identical sim is waiting on it
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            del self._in_flight[cache_key]
+
+        if not result:
+            return False
+
+        self._results[cache_key] = result
+
+        if self._sim_cache is not None:
+            self._sim_cache.put(cache_key, result)
+
+        return result
+
+    async def _run_uncached(self, character_name, realm_slug, region, spec, talent_string, iterations, simc_stderr,
+                            fight_style, target_error):
+        """
+        Runs a sim in its own simc process, or in a batch.
+        :return: Result dict as returned by run_sim_result, or False if simc failed
+        """
+        actor = {
+            "character_name": character_name,
+            "realm_slug": realm_slug,
+            "region": region,
+            "spec": spec,
+            "talent_string": talent_string
+        }
+
+        if self._batch_size > 1:
+            return await self._run_batched(actor, iterations, fight_style, simc_stderr, target_error)
+
+        sim_args = self.actor_args(actor) + self.sim_options(iterations, fight_style, target_error)
+
+        if self._output_format == "json":
+            report = await self._run_simc_json(sim_args, self._simc_timeout, simc_stderr)
+            results = self.parse_json_report(report)
+
+            return results.get(character_name.lower(), False)
 
-        shell_cmd = "%s %s" % (self._simc_path, sim_string)
+        output = await self._run_simc(sim_args, self._simc_timeout, simc_stderr)
+
+        cleaned_output = output.decode('utf-8').replace('\r', '').replace('\n', '')
+        dps = int(self.find_dps(cleaned_output))
+
+        return {"dps": dps} if dps else False
+
+    async def run_batch(self, actors, iterations, fight_style=None, simc_stderr=False, target_error=None):
+        """
+        Sims several actors in one simc process. Each actor is simmed on its own, one after another
+        (single_actor_batch), so results are the same as separate sims while simc startup is paid once.
+        :param actors: List of dicts with character_name, realm_slug, region, spec and talent_string.
+                       Character names must be unique within a batch.
+        :param iterations: Simcraft iterations
+        :param fight_style: simc fight style, or None for the simc default
+        :param simc_stderr: Pipe stderr back to python? Seems to not work on Windows
+        :param target_error: DPS error, in percent of DPS, at which simc stops simming an actor
+        :return: Dict of lowercase character name to result dict as returned by run_sim_result.
+                 Actors simc failed to sim are missing.
+        """
+        sim_args = [arg for actor in actors for arg in self.actor_args(actor)] + ["single_actor_batch=1"] + \
+            self.sim_options(iterations, fight_style, target_error)
+
+        # actors are simmed one at a time, so the timeout is per actor
+        timeout = self._simc_timeout * len(actors)
+
+        if self._output_format == "json":
+            return self.parse_json_report(await self._run_simc_json(sim_args, timeout, simc_stderr))
+
+        output = await self._run_simc(sim_args, timeout, simc_stderr)
+
+        return {name.lower(): {"dps": dps} for name, dps in self.find_player_dps(output.decode('utf-8')).items()}
+
+    async def _run_batched(self, actor, iterations, fight_style, simc_stderr, target_error):
+        """
+        Adds a sim to the pending batch for its sim options, and waits for the batch to finish.
+        A batch runs when it is full, or batch_window seconds after its first sim was added.
+        :return: Result dict, or False if simc did not sim this actor
+        """
+        loop = asyncio.get_event_loop()
+        key = (iterations, fight_style, simc_stderr, target_error)
+        name = actor["character_name"].lower()
+
+        if key in self._pending_batches and name in self._pending_batches[key]["names"]:
+            # same character with other talents or spec, simc actor names must be unique
+            self._flush_batch(key)
+
+        if key not in self._pending_batches:
+            self._pending_batches[key] = {
+                "actors": [],
+                "names": set(),
+                "futures": [],
+                "timer": loop.call_later(self._batch_window, self._flush_batch, key)
+            }
+
+        batch = self._pending_batches[key]
+        future = loop.create_future()
+
+        batch["actors"].append(actor)
+        batch["names"].add(name)
+        batch["futures"].append(future)
+
+        if len(batch["actors"]) >= self._batch_size:
+            self._flush_batch(key)
+
+        try:
+            return await future
+        except asyncio.CancelledError:
+            if self._pending_batches.get(key) is batch and all(waiting.cancelled() for waiting in batch["futures"]):
+                # no sim of the batch is wanted anymore, don't run it
+                self._flush_batch(key, run=False)
+
+            raise
+
+    def _flush_batch(self, key, run=True):
+        batch = self._pending_batches.pop(key, None)
+
+        if batch is None:
+            return
+
+        batch["timer"].cancel()
+
+        if run:
+            task = asyncio.ensure_future(self._complete_batch(batch, *key))
+            self._batch_tasks.add(task)
+            task.add_done_callback(self._batch_tasks.discard)
+
+    async def _complete_batch(self, batch, iterations, fight_style, simc_stderr, target_error):
+        logger.debug("Running batch of %d sims (%d iterations, fight style %s, target error %s)", len(batch["actors"]),
+                     iterations, fight_style, target_error)
+
+        try:
+            results = await self.run_batch(batch["actors"], iterations, fight_style, simc_stderr, target_error)
+        except asyncio.CancelledError:
+            for future in batch["futures"]:
+                future.cancel()
+
+            raise
+        except Exception as e:
+            for future in batch["futures"]:
+                if not future.done():
+                    future.set_exception(e)
+
+            return
+
+        for actor, future in zip(batch["actors"], batch["futures"]):
+            if not future.done():
+                future.set_result(results.get(actor["character_name"].lower(), False))
+
+    async def _run_simc(self, sim_args, timeout, simc_stderr):
+        """
+        Runs simc with the given arguments.
+        :param sim_args: List of simc options, each passed to simc as is, even with spaces in it
+        :return: simc stdout
+        """
+        sim_string = " ".join(sim_args)
+        logger.debug("Simming with string %s", sim_string)
 
         if simc_stderr:
             stderr_pipe = asyncio.subprocess.PIPE
         else:
             stderr_pipe = None
 
-        proc_handle = await asyncio.create_subprocess_shell(shell_cmd, stdout=asyncio.subprocess.PIPE,
-                                                            stderr=stderr_pipe)
+        # without a shell in between, killing the process kills simc
+        proc_handle = await asyncio.create_subprocess_exec(self._simc_path, *sim_args,
+                                                           stdout=asyncio.subprocess.PIPE, stderr=stderr_pipe)
         try:
-            output, err = await asyncio.wait_for(proc_handle.communicate(), timeout=self._simc_timeout)
+            output, err = await asyncio.wait_for(proc_handle.communicate(), timeout=timeout)
         except asyncio.TimeoutError:
             # HecticAddCleave can take a long time on some specs -- make the timeout generous to avoid skipping any
             logger.error("Sim timed out with string %s, skipping." % sim_string)
@@ -63,6 +394,14 @@ class SimulationCraft:
             proc_handle.kill()
             await proc_handle.communicate()
 
+            raise
+        except asyncio.CancelledError:
+            # the sim is not wanted anymore, give its core back right away
+            logger.debug("Sim cancelled, killing simc")
+
+            proc_handle.kill()
+            await proc_handle.wait()
+
             raise
 
         if err is not None:
@@ -70,8 +409,72 @@ class SimulationCraft:
 
             raise SimulationcraftProcessError(str(err))
 
-        cleaned_output = output.decode('utf-8').replace('\r', '').replace('\n', '')
-        return int(self.find_dps(cleaned_output))
+        return output
+
+    async def _run_simc_json(self, sim_args, timeout, simc_stderr):
+        """
+        Runs simc with a json2 report, discarding the text report.
+        :return: Parsed json2 report
+        """
+        fd, json_path = tempfile.mkstemp(prefix="simc_", suffix=".json")
+        os.close(fd)
+
+        try:
+            await self._run_simc(sim_args + ["json2=%s" % json_path, "report_details=0", "output=%s" % os.devnull],
+                                 timeout, simc_stderr)
+
+            with open(json_path, 'r') as f:
+                return json.loads(f.read())
+        finally:
+            os.remove(json_path)
+
+    @classmethod
+    def parse_json_report(cls, report):
+        """
+        Reads the results of every player in a simc json2 report.
+        :param report: Parsed json2 report
+        :return: Dict of lowercase player name to dict of "dps" (rounded mean), "dps_error" (at simc's
+                 confidence level), "iterations" actually run and "elapsed_time" of the simc process
+        """
+        sim = report["sim"]
+        confidence_estimator = sim["options"].get("confidence_estimator", cls.DEFAULT_CONFIDENCE_ESTIMATOR)
+        elapsed_time = sim.get("statistics", {}).get("elapsed_time_seconds")
+
+        results = {}
+
+        for player in sim["players"]:
+            dps = player["collected_data"]["dps"]
+
+            results[player["name"].lower()] = {
+                "dps": int(round(dps["mean"])),
+                "dps_error": dps.get("mean_std_dev", 0) * confidence_estimator,
+                "iterations": dps.get("count", sim["options"].get("iterations")),
+                "elapsed_time": elapsed_time
+            }
+
+        return results
+
+    @staticmethod
+    def sim_options(iterations, fight_style=None, target_error=None):
+        options = ["iterations=%d" % iterations]
+
+        if target_error:
+            options.append("target_error=%s" % target_error)
+
+        if fight_style:
+            options.append("fight_style=%s" % fight_style)
+
+        return options
+
+    def actor_args(self, actor):
+        profile_path, _ = self.character_profile(actor["character_name"], actor["realm_slug"], actor["region"])
+
+        if profile_path is not None:
+            character = "local_json=%s" % profile_path
+        else:
+            character = "armory=%s,%s,%s" % (actor["region"], actor["realm_slug"], actor["character_name"])
+
+        return [character, "spec=%s" % actor["spec"], "talents=%s" % actor["talent_string"]]
 
     @staticmethod
     def find_dps(string):
@@ -93,3 +496,12 @@ class SimulationCraft:
             return False
 
         return x
+
+    @staticmethod
+    def find_player_dps(string):
+        """
+        Finds the DPS of every player in a simc text report.
+        :param string: simc report, with or without line breaks
+        :return: Dict of player name to DPS
+        """
+        return {name: int(round(float(dps))) for name, dps in re.findall(r"Player: (\S+) [^\n]*?\s+DPS: ([\d.]+)", string)}
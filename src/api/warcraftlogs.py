@@ -1,6 +1,9 @@
+import asyncio
 import logging
 from time import time
 import datetime
+
+import aiohttp
 import requests
 from datetime import timedelta
 
@@ -53,10 +56,18 @@ class WarcraftLogs:
         "Restoration",
     ]
 
+    # retries of a request rejected with HTTP 429, and the backoff when no Retry-After is given
+    MAX_RATE_LIMIT_RETRIES = 5
+    RATE_LIMIT_BACKOFF_SEC = 1
+
     def __init__(self, api_key):
         self._api_key = api_key
 
         self._talent_data = {}
+        # built from the talent data by set_talent_data
+        self._talent_index = {}
+        # converted talents, by class, spec and warcraftlogs talent ids
+        self._converted_talents = {}
 
     def get_reports(self, guild_name, server, region):
         r = self.warcraftlogs_request(requests.get, API_URL + "reports/guild/%s/%s/%s" % (guild_name, server, region),
@@ -79,7 +90,74 @@ class WarcraftLogs:
         :param num_weeks:
         :return:
         """
+        difficulty_normalized = self.normalize_parse_args(character_name, server, region, metric, difficulty,
+                                                          num_weeks)
+
+        if not difficulty_normalized:
+            return False
+
+        r = self.warcraftlogs_request(requests.get,
+                                      API_URL + "parses/character/%s/%s/%s" % (character_name, server, region),
+                                      params={"metric": metric, "api_key": self._api_key})
+
+        return self.handle_parses_response(r.status_code, r.json(), character_name, server, region, difficulty,
+                                           difficulty_normalized, num_weeks)
+
+    async def get_all_parses_async(self, session, character_name, server, region, metric, difficulty, num_weeks):
+        """
+        Same as get_all_parses, using a shared aiohttp session.
+        :param session: aiohttp ClientSession
+        :return:
+        """
+        difficulty_normalized = self.normalize_parse_args(character_name, server, region, metric, difficulty,
+                                                          num_weeks)
+
+        if not difficulty_normalized:
+            return False
+
+        status, raw = await self.warcraftlogs_request_async(
+            session, API_URL + "parses/character/%s/%s/%s" % (character_name, server, region),
+            params={"metric": metric, "api_key": self._api_key})
 
+        return self.handle_parses_response(status, raw, character_name, server, region, difficulty,
+                                           difficulty_normalized, num_weeks)
+
+    async def get_parses_for_players(self, players, region, metric, difficulty, num_weeks, max_concurrent_requests):
+        """
+        Get parses of many players concurrently, over one keep-alive connection pool.
+        :param players: List of (character name, server) tuples
+        :param region:
+        :param metric:
+        :param difficulty:
+        :param num_weeks:
+        :param max_concurrent_requests: Maximum requests in flight at once
+        :return: List with the result of get_all_parses for each player, or the WarcraftLogsError it raised.
+                 Any other error fetching a player's parses, e.g. a dropped connection, is returned as a
+                 WarcraftLogsError too, so it only fails that player.
+        """
+        semaphore = asyncio.Semaphore(max_concurrent_requests)
+        connector = aiohttp.TCPConnector(limit=max_concurrent_requests)
+
+        async def fetch(session, character_name, server):
+            async with semaphore:
+                try:
+                    return await self.get_all_parses_async(session, character_name, server, region, metric,
+                                                           difficulty, num_weeks)
+                except WarcraftLogsError as e:
+                    return e
+                except Exception as e:
+                    logger.exception("Unable to fetch parses for character %s, server %s, region %s",
+                                     character_name, server, region)
+                    return WarcraftLogsError("WarcraftLogs request failed: %s" % (str(e) or type(e).__name__))
+
+        async with aiohttp.ClientSession(connector=connector) as session:
+            return await asyncio.gather(*[fetch(session, name, server) for name, server in players])
+
+    def normalize_parse_args(self, character_name, server, region, metric, difficulty, num_weeks):
+        """
+        Validates get_all_parses arguments.
+        :return: Difficulty as its WarcraftLogs int value, or False if the arguments can never return parses
+        """
         if num_weeks <= 0:
             logger.error("Number of weeks cannot be <= 0.")
             return False
@@ -102,21 +180,19 @@ class WarcraftLogs:
             else:
                 difficulty_normalized = self.DIFFICULTY_DICT[difficulty.lower()]
 
-        r = self.warcraftlogs_request(requests.get,
-                                      API_URL + "parses/character/%s/%s/%s" % (character_name, server, region),
-                                      params={"metric": metric, "api_key": self._api_key})
-
-        raw = r.json()
+        return difficulty_normalized
 
+    def handle_parses_response(self, status_code, raw, character_name, server, region, difficulty,
+                               difficulty_normalized, num_weeks):
         if not raw:
             logger.info("Empty warcraftlogs response for character %s, server %s, region %s, difficulty %s",
                          character_name, server, region, difficulty)
             raise WarcraftLogsError("No logs on record.")
-        elif r.status_code != 200:
+        elif status_code != 200:
             logger.error(
                 "Unable to find parses for character %s, server %s, region %s, difficulty %s",
                 character_name, server, region, difficulty)
-            raise WarcraftLogsError("WarcraftLogs server error %d" % r.status_code)
+            raise WarcraftLogsError("WarcraftLogs server error %d" % status_code)
 
         process_result = self.process_parses(character_name, difficulty_normalized, num_weeks, raw)
 
@@ -208,6 +284,37 @@ class WarcraftLogs:
 
         return r
 
+    async def warcraftlogs_request_async(self, session, url, params):
+        """
+        GET from WarcraftLogs on a shared session, backing off and retrying when rate limited.
+        :param session: aiohttp ClientSession
+        :param url:
+        :param params:
+        :return: (status code, decoded json or None)
+        """
+        for attempt in range(self.MAX_RATE_LIMIT_RETRIES + 1):
+            start = time()
+
+            async with session.get(url, params=params) as r:
+                if r.status != 429 or attempt == self.MAX_RATE_LIMIT_RETRIES:
+                    try:
+                        raw = await r.json(content_type=None)
+                    except ValueError:
+                        raw = None
+
+                    dur = time() - start
+                    logger.debug("Warcraftlogs request complete (%d ms) - (%s)", dur, r.url)
+
+                    return r.status, raw
+
+                try:
+                    delay = float(r.headers.get("Retry-After"))
+                except (TypeError, ValueError):
+                    delay = self.RATE_LIMIT_BACKOFF_SEC * 2 ** attempt
+
+            logger.warning("Warcraftlogs rate limit hit, retrying in %.1f sec - (%s)", delay, url)
+            await asyncio.sleep(delay)
+
     def convert_talents(self, class_str, spec_str, warcraftlogs_talents):
         """
         Convert from warcraftlogs talent format to column number format (e.g. 0011221)
@@ -216,53 +323,73 @@ class WarcraftLogs:
         :param warcraftlogs_talents:
         :return:
         """
+        if not self.has_talent_data():
+            error_str = "Blizzard talents not set for WarcraftLogs!"
+            logger.critical(error_str)
+            raise RuntimeError(error_str)
+
+        class_id = WarcraftLogs.BNET_CLASS_MAPPING[class_str.lower()]
+        spec = spec_str.lower()
+        memo_key = (class_id, spec, tuple(talent["id"] for talent in warcraftlogs_talents))
 
-        temp = []
+        if memo_key not in self._converted_talents:
+            temp = []
 
-        counter = 0
+            for tier, talent in enumerate(warcraftlogs_talents):
+                # a talent is either specific to this spec, or the same for all specs of the class
+                # if both exist, the one listed first by Battle.net wins
+                matches = [m for m in (self._talent_index.get((class_id, tier, talent["id"], spec)),
+                                       self._talent_index.get((class_id, tier, talent["id"], None))) if m]
 
+                if matches:
+                    temp.append(min(matches)[1])
+
+            self._converted_talents[memo_key] = temp
+
+        return list(self._converted_talents[memo_key])
+
+    @staticmethod
+    def build_talent_index(talent_data):
+        """
+        Flattens the Bnet talent tree for convert_talents.
+        :param talent_data: Talent data from Bnet API
+        :return: Dict of (class id, tier, spell id, spec or None if for all specs) to
+                 (position in the tier, simc talent column)
+        """
         # Simc talents are 1-indexed instead of 0, for the time being (pending fix)
         simc_offset = 1
 
-        if not self.has_talent_data():
-            error_str = "Blizzard talents not set for WarcraftLogs!"
-            logger.critical(error_str)
-            raise RuntimeError(error_str)
+        index = {}
 
-        for talent in warcraftlogs_talents:
-            entry = self._talent_data[WarcraftLogs.BNET_CLASS_MAPPING[class_str.lower()]]
-            tier = entry["talents"][counter]
-
-            done_tier = False
-            for talent_entry in tier:
-                for talent_for_spec in talent_entry:
-                    # One talent for each 3 (or 2, or 4) specs
-                    if "spec" in talent_for_spec:
-                        if talent_for_spec["spec"]["name"].lower().replace(" ", "") == spec_str.lower() and \
-                                        talent_for_spec["spell"]["id"] == talent["id"]:
-                            temp.append(talent_for_spec["column"] + simc_offset)
-                            done_tier = True
-                            break
-                    else:
-                        # talent is the same for all 3 specs
-                        if talent_for_spec["spell"]["id"] == talent["id"]:
-                            temp.append(talent_for_spec["column"] + simc_offset)
-                            done_tier = True
-                            break
-                if done_tier:
-                    break
+        for class_id, entry in talent_data.items():
+            for tier, tier_entries in enumerate(entry["talents"]):
+                position = 0
+
+                for talent_entry in tier_entries:
+                    # One talent for each 3 (or 2, or 4) specs, or one talent the same for all specs
+                    for talent_for_spec in talent_entry:
+                        if "spec" in talent_for_spec:
+                            spec = talent_for_spec["spec"]["name"].lower().replace(" ", "")
+                        else:
+                            spec = None
+
+                        index.setdefault((class_id, tier, talent_for_spec["spell"]["id"], spec),
+                                         (position, talent_for_spec["column"] + simc_offset))
+                        position += 1
 
-            counter += 1
-        return temp
+        return index
 
     def has_talent_data(self):
         return self._talent_data != {}
 
-    def set_talent_data(self, talent_data):
+    def set_talent_data(self, talent_data, talent_index=None):
         """
         Set talent data from Bnet API.
         :param talent_data:
+        :param talent_index: Index previously built from the same talent data, built now if not given
         :return:
 
         """
         self._talent_data = talent_data
+        self._talent_index = talent_index if talent_index is not None else self.build_talent_index(talent_data)
+        self._converted_talents = {}
@@ -0,0 +1,72 @@
+import hashlib
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger("SimBot")
+
+
+class ProfileStore:
+    # fields of a Bnet character that change without changing the sim
+    VOLATILE_FIELDS = ("lastModified", "achievementPoints", "totalHonorableKills")
+
+    def __init__(self, cache_dir, ttl):
+        """
+        Keeps Battle.net character profiles on disk, so simc imports characters from a local file
+        instead of the armory.
+        :param cache_dir: Directory to store profile files in
+        :param ttl: Seconds a stored profile is used before it is downloaded again
+        """
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self._cache_dir = cache_dir
+        self._ttl = ttl
+
+    def path(self, region, realm_slug, character_name):
+        return os.path.join(self._cache_dir, "%s_%s_%s.json" % (region.lower(), realm_slug.lower(),
+                                                                character_name.lower()))
+
+    def get(self, region, realm_slug, character_name):
+        """
+        :return: (profile file path, profile hash) if a fresh profile is stored, otherwise None
+        """
+        path = self.path(region, realm_slug, character_name)
+
+        if not os.path.isfile(path) or time.time() - os.path.getmtime(path) >= self._ttl:
+            return None
+
+        try:
+            with open(path, 'r') as f:
+                profile = json.loads(f.read())
+        except ValueError:
+            logger.error("Discarding corrupt profile file %s", path)
+            return None
+
+        return path, self.profile_hash(profile)
+
+    def put(self, region, realm_slug, character_name, profile):
+        """
+        :param profile: Bnet character json
+        :return: (profile file path, profile hash)
+        """
+        path = self.path(region, realm_slug, character_name)
+
+        # write then rename, so a simc process never reads a partial file
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+
+        with open(tmp_path, 'w') as f:
+            f.write(json.dumps(profile))
+
+        os.replace(tmp_path, path)
+
+        return path, self.profile_hash(profile)
+
+    @classmethod
+    def profile_hash(cls, profile):
+        """
+        :return: Short hash of everything in the profile that can change a sim
+        """
+        relevant = {key: value for key, value in profile.items() if key not in cls.VOLATILE_FIELDS}
+
+        return hashlib.sha1(json.dumps(relevant, sort_keys=True).encode('utf-8')).hexdigest()[:12]
@@ -0,0 +1,151 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+
+logger = logging.getLogger("SimBot")
+
+
+class ResultStore:
+    TABLE = "guild_reports"
+
+    def __init__(self, db_path, retention=30 * 24 * 3600, max_reports_per_guild=10):
+        """
+        Persistent store of finished guild runs, so reports can be served again without simming the guild.
+        Every run is kept with its parameters and timestamps, until it is older than the retention period or its
+        guild has max_reports_per_guild newer runs with the same difficulty and weeks.
+        :param db_path: Path of the SQLite database file, created if it does not exist
+        :param retention: Seconds a report is kept after its run finished
+        :param max_reports_per_guild: Most reports kept of each guild, difficulty and weeks
+        """
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+
+        self._retention = retention
+        self._max_reports_per_guild = max_reports_per_guild
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+
+        with self._lock, self._conn:
+            # the site reads reports while its job processes write them
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS %s (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                               "region TEXT NOT NULL, realm TEXT NOT NULL, guild TEXT NOT NULL, "
+                               "difficulty TEXT NOT NULL, weeks INTEGER NOT NULL, params TEXT NOT NULL, "
+                               "report TEXT NOT NULL, etag TEXT NOT NULL, started REAL NOT NULL, "
+                               "finished REAL NOT NULL)" % self.TABLE)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS %s_guild ON %s (region, realm, guild, finished)" %
+                               (self.TABLE, self.TABLE))
+
+    @staticmethod
+    def realm_key(realm):
+        """
+        Realms are matched by their Battle.net slug, so a realm's name ("Area 52") and the slug in a url
+        ("area-52") find the same reports.
+        :return: Lower-cased realm name, without accents or apostrophes, words joined by hyphens
+        """
+        nfkd_form = unicodedata.normalize('NFKD', realm)
+        realm = u"".join([c for c in nfkd_form if not unicodedata.combining(c)])
+
+        return "-".join(re.sub(r"['()]", "", realm).replace("-", " ").split()).lower()
+
+    @classmethod
+    def guild_key(cls, region, realm, guild):
+        """
+        Guild names and realms are matched regardless of case, as Battle.net does.
+        :return: (region, realm, guild) as stored
+        """
+        return region.upper(), cls.realm_key(realm), guild.lower()
+
+    def put(self, region, realm, guild, difficulty, weeks, report, params, started=None):
+        """
+        Stores the report of a finished guild run.
+        :param difficulty: Raid difficulty the guild's kills were taken from
+        :param weeks: Weeks of kills the run averaged
+        :param report: Guild sim report, see SimcraftBot.run_all_sims
+        :param params: JSON serializable parameters the guild was simmed with
+        :param started: Time the run started, defaults to now
+        :return: ETag of the report, which only changes when the report does
+        """
+        now = time.time()
+        report_json = json.dumps(report, sort_keys=True)
+        etag = hashlib.sha1(report_json.encode('utf-8')).hexdigest()
+
+        with self._lock, self._conn:
+            self._conn.execute("INSERT INTO %s (region, realm, guild, difficulty, weeks, params, report, etag, "
+                               "started, finished) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)" % self.TABLE,
+                               self.guild_key(region, realm, guild) +
+                               (difficulty, int(weeks), json.dumps(params, sort_keys=True), report_json, etag,
+                                started if started is not None else now, now))
+
+        self.purge()
+
+        return etag
+
+    def latest(self, region, realm, guild, difficulty=None, weeks=None):
+        """
+        :param difficulty: Only consider runs of this raid difficulty, None for any
+        :param weeks: Only consider runs over this many weeks of kills, None for any
+        :return: dict of the latest "report" of a guild, its "params", "etag", and "started" and "finished" times,
+                 or None if no report of the guild is stored
+        """
+        query = "SELECT report, params, etag, started, finished FROM %s WHERE region = ? AND realm = ? AND " \
+                "guild = ?" % self.TABLE
+        args = list(self.guild_key(region, realm, guild))
+
+        if difficulty is not None:
+            query += " AND difficulty = ?"
+            args.append(difficulty)
+
+        if weeks is not None:
+            query += " AND weeks = ?"
+            args.append(int(weeks))
+
+        with self._lock:
+            row = self._conn.execute(query + " ORDER BY finished DESC LIMIT 1", args).fetchone()
+
+        if row is None:
+            return None
+
+        report, params, etag, started, finished = row
+
+        return {
+            "report": json.loads(report),
+            "params": json.loads(params),
+            "etag": etag,
+            "started": started,
+            "finished": finished
+        }
+
+    def purge(self):
+        """
+        Removes reports older than the retention period, then reports beyond max_reports_per_guild newer ones.
+        :return: Number of reports removed
+        """
+        with self._lock, self._conn:
+            removed = self._conn.execute("DELETE FROM %s WHERE finished < ?" % self.TABLE,
+                                         (time.time() - self._retention,)).rowcount
+
+            removed += self._conn.execute(
+                "DELETE FROM {0} WHERE id IN (SELECT id FROM (SELECT id, ROW_NUMBER() OVER (PARTITION BY region, "
+                "realm, guild, difficulty, weeks ORDER BY finished DESC) AS newer FROM {0}) WHERE newer > ?)"
+                .format(self.TABLE), (self._max_reports_per_guild,)).rowcount
+
+        if removed > 0:
+            logger.debug("Removed %d old guild reports", removed)
+
+        return removed
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM %s" % self.TABLE).fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,27 @@
+import json
+
+from src.cache.sqlite_cache import SqliteCache
+
+
+class SimCache(SqliteCache):
+    TABLE = "sim_results"
+
+    def __init__(self, db_path, ttl=None, max_entries=None):
+        """
+        On-disk cache of simc results, shared between players, runs and processes.
+        :param db_path: Path of the SQLite database file
+        :param ttl: Seconds a sim result is reused for. Gear changes are only picked up once results expire.
+        :param max_entries: Maximum number of sim results kept
+        """
+        super().__init__(db_path, self.TABLE, ttl, max_entries)
+
+    @staticmethod
+    def make_key(character_name, realm_slug, region, spec, talent_string, fight_style, iterations, simc_version,
+                 target_error=None, profile_hash=None):
+        """
+        Everything that changes the outcome of a sim is part of the key.
+        :param profile_hash: Hash of the local character profile simmed, None if simc imports it from the armory
+        :return: Cache key string
+        """
+        return json.dumps([character_name.lower(), realm_slug.lower(), region.upper(), spec, talent_string,
+                           fight_style, iterations, simc_version, target_error, profile_hash])
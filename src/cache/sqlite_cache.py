@@ -0,0 +1,115 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger("SimBot")
+
+
+class SqliteCache:
+    def __init__(self, db_path, table, ttl=None, max_entries=None):
+        """
+        Persistent key/value cache stored in a SQLite table. Values are stored as JSON.
+        :param db_path: Path of the SQLite database file, created if it does not exist
+        :param table: Table holding this cache's entries. Several caches can share one database file.
+        :param ttl: Seconds an entry stays fresh, or None to never expire
+        :param max_entries: Maximum entries kept, least recently used entries are evicted first. None for no limit.
+        """
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+
+        self._table = table
+        self._ttl = ttl
+        self._max_entries = max_entries
+
+        # connection is shared by the threads a SimcraftBot may run on, guarded by the lock
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+
+        with self._lock, self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS %s (key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                               "created REAL NOT NULL, last_access REAL NOT NULL)" % table)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS %s_last_access ON %s (last_access)" % (table, table))
+
+    def get(self, key):
+        """
+        Get a fresh entry, marking it as recently used.
+        :param key:
+        :return: Cached value, or None if missing or expired
+        """
+        value, created = self.get_entry(key)
+
+        if value is None or self.is_expired(created):
+            return None
+
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE %s SET last_access = ? WHERE key = ?" % self._table, (time.time(), key))
+
+        return value
+
+    def get_entry(self, key):
+        """
+        Get an entry regardless of its age.
+        :param key:
+        :return: (value, time the value was stored), or (None, None) if missing
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT value, created FROM %s WHERE key = ?" % self._table, (key,)).fetchone()
+
+        if row is None:
+            return None, None
+
+        return json.loads(row[0]), row[1]
+
+    def put(self, key, value):
+        now = time.time()
+
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO %s (key, value, created, last_access) VALUES (?, ?, ?, ?)" %
+                               self._table, (key, json.dumps(value), now, now))
+
+        self.evict()
+
+    def touch(self, key):
+        """
+        Mark an existing entry as fresh again without rewriting it.
+        :param key:
+        """
+        now = time.time()
+
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE %s SET created = ?, last_access = ? WHERE key = ?" % self._table,
+                               (now, now, key))
+
+    def delete(self, key):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM %s WHERE key = ?" % self._table, (key,))
+
+    def evict(self):
+        """
+        Remove expired entries, then least recently used entries over the size limit.
+        """
+        with self._lock, self._conn:
+            if self._ttl is not None:
+                self._conn.execute("DELETE FROM %s WHERE created < ?" % self._table, (time.time() - self._ttl,))
+
+            if self._max_entries is not None:
+                removed = self._conn.execute(
+                    "DELETE FROM %s WHERE key IN (SELECT key FROM %s ORDER BY last_access DESC LIMIT -1 OFFSET ?)" %
+                    (self._table, self._table), (self._max_entries,)).rowcount
+
+                if removed > 0:
+                    logger.debug("Evicted %d entries from cache %s", removed, self._table)
+
+    def is_expired(self, created):
+        return self._ttl is not None and time.time() - created > self._ttl
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM %s" % self._table).fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
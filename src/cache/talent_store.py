@@ -0,0 +1,103 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from src.api.warcraftlogs import WarcraftLogs
+
+logger = logging.getLogger("SimBot")
+
+
+class TalentStore:
+    # talent files read by any TalentStore in this process, by file path: (file mtime, file contents)
+    _loaded = {}
+    _loaded_lock = threading.Lock()
+
+    def __init__(self, cache_dir, ttl, version_tag=None):
+        """
+        Keeps the Battle.net talent master data, and its talent index, on disk between runs.
+        :param cache_dir: Directory to store talent files in
+        :param ttl: Seconds stored talent data is used before it is downloaded again
+        :param version_tag: Game patch the data belongs to. Stored data with a different tag is downloaded again.
+        """
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self._cache_dir = cache_dir
+        self._ttl = ttl
+        self._version_tag = version_tag
+
+    def get(self, locale, fetch_func):
+        """
+        Get talent data for a locale, from disk if it is fresh, otherwise using fetch_func.
+        :param locale:
+        :param fetch_func: Function taking a locale and returning Bnet talent data
+        :return: (talent data, talent index as built by WarcraftLogs.build_talent_index)
+        """
+        path = os.path.join(self._cache_dir, "talents_%s.json" % locale)
+        stored = self._read(path)
+
+        if stored is not None and stored["version"] == self._version_tag and \
+                time.time() - stored["fetched_at"] < self._ttl:
+            return stored["talent_data"], stored["talent_index"]
+
+        talent_data = fetch_func(locale)
+        content_hash = self.content_hash(talent_data)
+
+        if stored is not None and stored["content_hash"] == content_hash:
+            # talents did not change, only the index needs to be reused
+            logger.debug("Talent data for %s unchanged", locale)
+            talent_index = stored["talent_index"]
+        else:
+            logger.info("Indexing new talent data for %s (version %s)", locale, self._version_tag)
+            talent_index = WarcraftLogs.build_talent_index(talent_data)
+
+        self._write(path, {
+            "fetched_at": time.time(),
+            "version": self._version_tag,
+            "content_hash": content_hash,
+            "talent_data": talent_data,
+            # json keys cannot be tuples
+            "talent_index": [list(key) + list(value) for key, value in talent_index.items()]
+        })
+
+        return talent_data, talent_index
+
+    @staticmethod
+    def content_hash(talent_data):
+        return hashlib.sha1(json.dumps(talent_data, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _read(self, path):
+        if not os.path.isfile(path):
+            return None
+
+        mtime = os.path.getmtime(path)
+
+        with self._loaded_lock:
+            if path in self._loaded and self._loaded[path][0] == mtime:
+                return self._loaded[path][1]
+
+        try:
+            with open(path, 'r') as f:
+                stored = json.loads(f.read())
+        except ValueError:
+            logger.error("Discarding corrupt talent file %s", path)
+            return None
+
+        stored["talent_index"] = {tuple(row[:4]): tuple(row[4:]) for row in stored["talent_index"]}
+
+        with self._loaded_lock:
+            self._loaded[path] = (mtime, stored)
+
+        return stored
+
+    @staticmethod
+    def _write(path, stored):
+        # write then rename, so concurrent readers never see a partial file
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+
+        with open(tmp_path, 'w') as f:
+            f.write(json.dumps(stored))
+
+        os.replace(tmp_path, path)
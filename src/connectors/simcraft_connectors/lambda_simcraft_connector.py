@@ -1,73 +1,294 @@
+import logging
+import random
+
 import aiohttp
 import asyncio
 
+from src.api.rate_limiter import AdaptiveConcurrency
+from src.api.simcraft import SimJob
 from src.connectors.simcraft_connectors.simcraft_connector import SimcraftConnector
 
+logger = logging.getLogger("SimBot")
+
 
 class LambdaSimcraftConnector(SimcraftConnector):
-    def __init__(self, urls):
+    # statuses worth retrying: throttled, or Lambda/API Gateway failures
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+    # backoff before the first retry, doubled for each further retry, with full jitter
+    RETRY_BASE_DELAY_SEC = 1
+    RETRY_MAX_DELAY_SEC = 30
+
+    # what one invocation runs: a player's whole sim suite, or a single sim
+    WORK_UNITS = ("suite", "sim")
+
+    def __init__(self, urls, max_concurrency=100, initial_concurrency=10, request_timeout=300, max_retries=3,
+                 work_unit="suite", screening=None, simc=None):
+        """
+        Runs queued sims on Lambda, with adaptive concurrency, per-request timeouts and retries.
+        A player whose invocation keeps failing gets an error result, the other players are unaffected.
+
+        With work_unit "suite", each queued sim suite is one invocation, so a run takes as long as the slowest suite.
+        With work_unit "sim", suites run here and every distinct sim of a suite is its own invocation, so a run
+        takes about as long as the slowest sim. Identical sims of different players' suites are invoked once.
+        :param urls: urls.json contents
+        :param max_concurrency: Most invocations in flight at once, e.g. the Lambda concurrency limit
+        :param initial_concurrency: Invocations in flight at once before the limit adapts
+        :param request_timeout: Seconds an invocation may take before it is retried
+        :param max_retries: Retries of an invocation that was throttled, failed or timed out
+        :param work_unit: "suite" or "sim"
+        :param screening: Two-pass options the invoked suites run with, as returned by SimcraftBot.screening_options,
+                          None for one pass. Suites run here with work_unit "sim" use their own SimcraftBot's.
+        :param simc: SimulationCraft whose sim cache sims of work_unit "sim" are looked up in before they are
+                     invoked, and stored in once they succeed. None to always invoke them.
+        """
         super().__init__()
 
+        if work_unit not in self.WORK_UNITS:
+            raise RuntimeError("Unknown Lambda work unit %s" % work_unit)
+
         # note, not a proactor event loop (overrides super)
         self._old_loop = asyncio.get_event_loop()
         self.loop = asyncio.new_event_loop()
         asyncio.set_event_loop(self.loop)
 
-        self.sim_args = []
+        # (sim coroutine function, args, kwargs)
+        self.queued_sims = []
         self._urls = urls
 
-    @staticmethod
-    async def fetch(player, session, url, data):
-        async with session.post(url, json=data) as response:
-            if response.status != 200:
-                simc_response = {
-                    "player_name": player,
-                    "error": await response.json()
-                }
+        self.work_unit = work_unit
+        self._screening = screening
+        self._simc = simc
+        # sim suites run on this connector start all their sims at once
+        self.parallel = work_unit == "sim"
+        # client session of the current run, used by run_sim_result
+        self._client_session = None
+        # SimJob to result, and SimJob to future of a sim being invoked
+        self._sim_results = {}
+        self._sims_in_flight = {}
+
+        self._concurrency = AdaptiveConcurrency(min(initial_concurrency, max_concurrency), max_concurrency)
+        self._request_timeout = request_timeout
+        self._max_retries = max_retries
+
+    async def fetch(self, player, session, url, data, result_key="suite"):
+        """
+        Invokes the Lambda once.
+        :param result_key: Key of the result in the response body
+        :return: (result, or None if the invocation failed, error message, True if the invocation should be retried)
+        """
+        try:
+            async with session.post(url, json=data,
+                                    timeout=aiohttp.ClientTimeout(total=self._request_timeout)) as response:
+                try:
+                    body = await response.json(content_type=None)
+                except ValueError:
+                    body = None
+
+                if response.status != 200:
+                    error = body.get("error", body) if isinstance(body, dict) else body
+                    return None, "Lambda error %d: %s" % (response.status, error), \
+                        response.status in self.RETRY_STATUSES
+
+                if not isinstance(body, dict) or result_key not in body:
+                    return None, "Lambda response without a %s" % result_key, True
+
+                return body[result_key], None, False
+        except asyncio.TimeoutError:
+            return None, "Lambda timed out after %d sec" % self._request_timeout, True
+        except aiohttp.ClientError as e:
+            return None, "Lambda request failed: %s" % e, True
+
+    async def _invoke(self, session, player, request_body, result_key):
+        """
+        Invokes the Lambda, retrying throttled, failed and timed out invocations.
+        :return: (result, or None if every attempt failed, error message of the last attempt)
+        """
+        error = None
 
-                return simc_response
+        for attempt in range(self._max_retries + 1):
+            if attempt:
+                delay = random.uniform(0, min(self.RETRY_MAX_DELAY_SEC, self.RETRY_BASE_DELAY_SEC * 2 ** attempt))
+                logger.debug("Retrying Lambda sims of %s in %.1f sec (attempt %d)", player, delay, attempt + 1)
+                await asyncio.sleep(delay)
 
-            return await response.json()
+            await self._concurrency.acquire()
 
-    async def call_lambda(self, session, player, realm_slug, region, iterations, raiding_stats):
+            result, error, retry = None, None, False
+            url = None
+
+            try:
+                url = await self.acquire_url(session)
+
+                if url is None:
+                    result, error, retry = None, "No healthy sim endpoint", True
+                else:
+                    result, error, retry = await self.fetch(player, session, url, request_body, result_key)
+            finally:
+                if url is not None:
+                    self.release_url(url, failed=retry)
+
+                # no endpoint to send to says nothing about how much load the endpoints take
+                await self._concurrency.release(throttled=retry and url is not None)
+
+            if result is not None:
+                return result, None
+
+            logger.warning("Lambda sims of %s failed: %s (concurrency limit now %d)", player, error,
+                           self._concurrency.limit)
+
+            if not retry:
+                break
+
+        return None, error
+
+    async def acquire_url(self, session):
+        """
+        Picks the url the next invocation is sent to.
+        :return: url, or None if there is no endpoint to send it to
+        """
+        return self._urls["lambda"]["production"]
+
+    def release_url(self, url, failed):
+        """
+        Ends an invocation sent to a url from acquire_url.
+        :param failed: True if the invocation was throttled, failed or timed out
+        """
+        pass
+
+    async def call_lambda(self, session, player, realm_slug, region, iterations, raiding_stats, target_error=None):
         request_body = {
             "sim_params": {
                 "character_name": player,
                 "realm_slug": realm_slug,
                 "region": region,
                 "iterations": iterations,
-                "raiding_stats": raiding_stats
+                "raiding_stats": raiding_stats,
+                "target_error": target_error,
+                "screening": self._screening
             }
         }
-        resp = await self.fetch(player, session, self._urls["lambda"]["production"], request_body)
 
-        print(resp)
+        suite, error = await self._invoke(session, player, request_body, "suite")
+
+        if suite is None:
+            return {"player_name": player, "error": error}
+
+        return suite
+
+    async def run_sim_result(self, character_name, realm_slug, region, spec, talent_string, iterations,
+                             simc_stderr=False, fight_style=None, target_error=None):
+        """
+        Runs one sim as a Lambda invocation, with SimulationCraft.run_sim_result's interface.
+        Only usable while this connector runs suites with work_unit "sim".
+        :return: Result dict of SimulationCraft.run_sim_result, False if the sim failed
+        """
+        job = SimJob(character_name, realm_slug, region, spec, talent_string, fight_style, iterations, target_error)
 
-        return resp
+        if job in self._sim_results:
+            return self._sim_results[job]
 
-        # TODO notify of completion here
+        if self._simc is not None:
+            cached = self._simc.cached_result(job)
 
-    def queue_sim(self, sim_coro, *args, **kwargs):
-        self.sim_args.append(args)
+            if cached is not None:
+                self._sim_results[job] = cached
 
-    async def _run(self):
+                return cached
+
+        if job in self._sims_in_flight:
+            # an identical sim is already being invoked, wait for it
+            return await asyncio.shield(self._sims_in_flight[job])
+
+        future = self.loop.create_future()
+        self._sims_in_flight[job] = future
+
+        try:
+            result, error = await self._invoke(self._client_session, character_name, {"sim_job": job._asdict()},
+                                               "result")
+
+            if result is None:
+                # not memoized, a later suite may try again
+                result = False
+            else:
+                self._sim_results[job] = result
+
+                if self._simc is not None:
+                    self._simc.store_result(job, result)
+
+            future.set_result(result)
+
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            # mark the exception as retrieved, in case no other suite waits on it
+            future.exception()
+            raise
+        finally:
+            del self._sims_in_flight[job]
+
+    async def run_sim(self, *args, **kwargs):
+        result = await self.run_sim_result(*args, **kwargs)
+
+        return result["dps"] if result else False
+
+    def queue_sim(self, sim_coro, *args, priority=0, **kwargs):
+        # every suite starts at once, so priority is not needed
+        self.queued_sims.append((sim_coro, args, kwargs))
+
+    async def _run_suite(self, session, sim_coro, args, kwargs):
+        if self.work_unit == "sim":
+            return await sim_coro(*args, simc=self, **kwargs)
+
+        return await self.call_lambda(session, *args)
+
+    async def _call_and_notify(self, session, queued, on_complete):
+        suite = await self._run_suite(session, *queued)
+
+        if on_complete is not None:
+            on_complete(suite)
+
+        return suite
+
+    def _session(self):
+        # the adaptive limit, not the connection pool, caps requests in flight
+        self._client_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self._concurrency.maximum))
+
+        return self._client_session
+
+    async def _run(self, on_complete=None):
         tasks = []
 
-        async with aiohttp.ClientSession() as session:
-            for args in self.sim_args:
-                task = asyncio.ensure_future(self.call_lambda(session, *args))
+        async with self._session() as session:
+            for queued in self.queued_sims:
+                task = asyncio.ensure_future(self._call_and_notify(session, queued, on_complete))
                 tasks.append(task)
 
             return await asyncio.gather(*tasks)
 
-    def get_completed_sims(self):
+    def get_completed_sims(self, on_complete=None):
         try:
-            future = asyncio.ensure_future(self._run())
+            future = asyncio.ensure_future(self._run(on_complete))
 
             # blocks until complete
-            raw = self.loop.run_until_complete(future)
-
-            return [x["suite"] for x in raw]
+            return self.loop.run_until_complete(future)
         finally:
-            self.loop.close()
-            asyncio.set_event_loop(self._old_loop)
+            self.close()
+
+    async def completed_sims(self):
+        async with self._session() as session:
+            tasks = [asyncio.ensure_future(self._run_suite(session, *queued)) for queued in self.queued_sims]
+
+            try:
+                for task in asyncio.as_completed(tasks):
+                    yield await task
+            finally:
+                # the caller may stop iterating early
+                for task in tasks:
+                    task.cancel()
+
+                if tasks:
+                    await asyncio.wait(tasks)
+
+    def close(self):
+        self.loop.close()
+        asyncio.set_event_loop(self._old_loop)
@@ -1,26 +1,138 @@
 import asyncio
-
+import heapq
+import itertools
+import logging
+import os
 import sys
 
 from src.connectors.simcraft_connectors.simcraft_connector import SimcraftConnector
 
+logger = logging.getLogger("SimBot")
+
 
 # noinspection PyCompatibility
 class LocalSimcraftConnector(SimcraftConnector):
-    def __init__(self):
+    # seconds between checks of a concurrency_limit that is holding sims back
+    LIMIT_CHECK_INTERVAL_SEC = 0.1
+
+    def __init__(self, max_concurrent_sims=None, concurrency_limit=None):
+        """
+        Runs queued sims on this machine, with at most max_concurrent_sims running at once.
+        Each queued sim suite runs its simc processes one at a time, so this caps the number of simc subprocesses.
+        :param max_concurrent_sims: Concurrency cap, defaults to the number of CPUs
+        :param concurrency_limit: Optional function returning the current cap, at most max_concurrent_sims, e.g. this
+                                  job's share of a simc budget shared with other jobs. Checked before each sim starts.
+        """
         super().__init__()
 
-        self.loop = asyncio.get_event_loop()
-        self.running_sims = []
+        if sys.platform == 'win32':
+            # proactor loop set by super, needed for subprocesses
+            self.loop = asyncio.get_event_loop()
+        else:
+            # fresh loop, so the connector also works off the main thread and after a previous connector closed its loop
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+
+        self.max_concurrent_sims = max_concurrent_sims or os.cpu_count() or 1
+        self._concurrency_limit = concurrency_limit
+
+        # heap of (priority, sequence number, sim coroutine function, args, kwargs)
+        # sequence number keeps equal priorities FIFO
+        self._run_queue = []
+        self._sequence = itertools.count()
+
+        self.num_queued = 0
+        self.num_running = 0
+        self.num_finished = 0
+
+    def queue_sim(self, sim_coro, *args, priority=0, **kwargs):
+        heapq.heappush(self._run_queue, (priority, next(self._sequence), sim_coro, args, kwargs))
+        self.num_queued += 1
+
+    def get_status(self):
+        """
+        Counters for queued (not yet started), running, and finished sims.
+        :return: dict of counters
+        """
+        return {
+            "queued": self.num_queued,
+            "running": self.num_running,
+            "finished": self.num_finished,
+            "max_concurrent": self.max_concurrent_sims
+        }
+
+    async def _wait_for_slot(self):
+        if self._concurrency_limit is None:
+            return
+
+        # at least one sim runs, so a job always makes progress
+        while self.num_running and self.num_running >= self._concurrency_limit():
+            await asyncio.sleep(self.LIMIT_CHECK_INTERVAL_SEC)
+
+    async def _worker(self, results, on_complete):
+        while self._run_queue:
+            await self._wait_for_slot()
+
+            if not self._run_queue:
+                # other workers took the remaining sims meanwhile
+                break
+
+            _, sequence, sim_coro, args, kwargs = heapq.heappop(self._run_queue)
+            self.num_queued -= 1
+            self.num_running += 1
 
-    def queue_sim(self, sim_coro, *args, **kwargs):
-        self.running_sims.append(sim_coro(*args, **kwargs))
+            try:
+                results[sequence] = await sim_coro(*args, **kwargs)
+            finally:
+                self.num_running -= 1
+                self.num_finished += 1
 
-    def get_completed_sims(self):
+            logger.debug("Sim scheduler status: %s", self.get_status())
+
+            if on_complete is not None:
+                on_complete(results[sequence])
+
+    async def _run(self, on_complete=None):
+        results = {}
+        num_workers = min(self.max_concurrent_sims, len(self._run_queue))
+
+        logger.info("Running %d sims, %d at a time", len(self._run_queue), self.max_concurrent_sims)
+
+        await asyncio.gather(*[self._worker(results, on_complete) for _ in range(num_workers)])
+
+        # results in the order they were queued
+        return [results[sequence] for sequence in sorted(results)]
+
+    def get_completed_sims(self, on_complete=None):
         try:
             # blocks until complete
-            results = self.loop.run_until_complete(asyncio.gather(*self.running_sims))
+            return self.loop.run_until_complete(self._run(on_complete))
+        finally:
+            self.close()
 
-            return results
+    async def completed_sims(self):
+        num_sims = len(self._run_queue)
+        completed = asyncio.Queue()
+        runner = asyncio.ensure_future(self._run(completed.put_nowait))
+
+        try:
+            for _ in range(num_sims):
+                next_result = asyncio.ensure_future(completed.get())
+                await asyncio.wait([next_result, runner], return_when=asyncio.FIRST_COMPLETED)
+
+                if not next_result.done() and runner.exception() is not None:
+                    # a sim raised, no more results are coming
+                    next_result.cancel()
+                    raise runner.exception()
+
+                yield await next_result
+
+            await runner
         finally:
-            self.loop.close()
+            if not runner.done():
+                # the caller stopped iterating early
+                runner.cancel()
+                await asyncio.wait([runner])
+
+    def close(self):
+        self.loop.close()
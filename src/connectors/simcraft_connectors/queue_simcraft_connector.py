@@ -0,0 +1,136 @@
+import json
+import logging
+
+import asyncio
+
+from src.api.simcraft import SimJob
+from src.connectors.simcraft_connectors.simcraft_connector import SimcraftConnector
+
+logger = logging.getLogger("SimBot")
+
+
+class QueueSimcraftConnector(SimcraftConnector):
+    # seconds between looking for finished jobs
+    POLL_INTERVAL_SEC = 0.2
+
+    # sim suites run on this connector start all their sims at once
+    parallel = True
+
+    def __init__(self, job_queue, max_age=None):
+        """
+        Runs queued sim suites here, putting each of their distinct sims on a durable JobQueue for worker processes
+        (python -m src.job_queue worker) to run. Sims that finished before, e.g. in a run that died, are not run again.
+        :param job_queue: JobQueue
+        :param max_age: Seconds a finished sim is reused for, like the sim cache's ttl. Workers import characters
+                        from the armory, so this is also how long a gear change goes unseen. None for as long as the
+                        queue keeps it.
+        """
+        super().__init__()
+
+        self._old_loop = asyncio.get_event_loop()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        self._job_queue = job_queue
+        self._max_age = max_age
+
+        # (sim coroutine function, args, kwargs)
+        self.queued_sims = []
+        # job key to future of its result, for jobs waiting on the queue
+        self._waiting = {}
+        self._poller = None
+
+    @staticmethod
+    def job_key(job):
+        return json.dumps(job)
+
+    async def run_sim_result(self, character_name, realm_slug, region, spec, talent_string, iterations,
+                             simc_stderr=False, fight_style=None, target_error=None):
+        """
+        Runs one sim on the job queue, with SimulationCraft.run_sim_result's interface.
+        :return: Result dict of SimulationCraft.run_sim_result, False if the sim failed
+        """
+        job = SimJob(character_name, realm_slug, region, spec, talent_string, fight_style, iterations, target_error)
+        job_key = self.job_key(job)
+
+        if job_key not in self._waiting:
+            self._job_queue.enqueue(job_key, job._asdict(), max_age=self._max_age)
+            self._waiting[job_key] = self.loop.create_future()
+
+            if self._poller is None or self._poller.done():
+                self._poller = asyncio.ensure_future(self._poll())
+
+        # identical sims of other suites wait on the same job
+        return await asyncio.shield(self._waiting[job_key])
+
+    async def run_sim(self, *args, **kwargs):
+        result = await self.run_sim_result(*args, **kwargs)
+
+        return result["dps"] if result else False
+
+    async def _poll(self):
+        while self._waiting:
+            for job_key, result in self._job_queue.results(self._waiting).items():
+                future = self._waiting.pop(job_key)
+
+                if not future.done():
+                    future.set_result(result)
+
+            await asyncio.sleep(self.POLL_INTERVAL_SEC)
+
+    def queue_sim(self, sim_coro, *args, priority=0, **kwargs):
+        # every suite starts at once, so priority is not needed
+        self.queued_sims.append((sim_coro, args, kwargs))
+
+    async def _call_and_notify(self, sim_coro, args, kwargs, on_complete):
+        suite = await sim_coro(*args, simc=self, **kwargs)
+
+        if on_complete is not None:
+            on_complete(suite)
+
+        return suite
+
+    async def _run(self, on_complete=None):
+        logger.info("Queueing the sims of %d suites", len(self.queued_sims))
+
+        try:
+            return await asyncio.gather(*[self._call_and_notify(*queued, on_complete) for queued in self.queued_sims])
+        finally:
+            await self._stop_polling()
+
+    def get_completed_sims(self, on_complete=None):
+        try:
+            # blocks until complete
+            return self.loop.run_until_complete(self._run(on_complete))
+        finally:
+            self.close()
+
+    async def completed_sims(self):
+        tasks = [asyncio.ensure_future(sim_coro(*args, simc=self, **kwargs))
+                 for sim_coro, args, kwargs in self.queued_sims]
+
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield await task
+        finally:
+            # the caller may stop iterating early
+            for task in tasks:
+                task.cancel()
+
+            if tasks:
+                await asyncio.wait(tasks)
+
+            await self._stop_polling()
+
+    async def _stop_polling(self):
+        # queued jobs stay on the queue, a later run picks up their results
+        if self._poller is not None:
+            self._poller.cancel()
+            await asyncio.wait([self._poller])
+
+        self._waiting = {}
+
+    def close(self):
+        self._job_queue.close()
+        self.loop.close()
+        asyncio.set_event_loop(self._old_loop)
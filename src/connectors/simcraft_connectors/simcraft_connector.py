@@ -8,12 +8,52 @@ class SimcraftConnector:
         if sys.platform == 'win32':
             asyncio.set_event_loop(asyncio.ProactorEventLoop())
 
-    def queue_sim(self, sim_func, *args, **kwargs):
+    def queue_sim(self, sim_func, *args, priority=0, **kwargs):
+        """
+        Queues a unit of sim work to be run by get_completed_sims.
+        :param sim_func: Coroutine function to run
+        :param args: Arguments to sim_func
+        :param priority: Lower values are started first. Connectors that do not schedule may ignore this.
+        :param kwargs: Keyword arguments to sim_func
+        """
         pass
 
-    def get_completed_sims(self):
+    def get_completed_sims(self, on_complete=None):
         """
         Blocks until all queued sims are complete
+        :param on_complete: Optional function called with the data of each sim as soon as it completes
         :return: List of data from completed sims
         """
         pass
+
+    async def completed_sims(self):
+        """
+        Runs the queued sims on this connector's loop.
+        :return: Async iterator of data from completed sims, in the order they complete
+        """
+        pass
+
+    def cancel(self):
+        """
+        Stops the connector's sims as soon as possible, from any thread. Every task on the connector's loop is
+        cancelled, which kills running simc processes and aborts requests in flight, and the run raises
+        asyncio.CancelledError. Does nothing once the connector is closed.
+        """
+        try:
+            self.loop.call_soon_threadsafe(self._cancel_tasks)
+        except RuntimeError:
+            # loop already closed, nothing left to stop
+            pass
+
+    def _cancel_tasks(self):
+        # asyncio.all_tasks needs Python 3.7, Task.all_tasks is gone in 3.9
+        all_tasks = getattr(asyncio, "all_tasks", None) or asyncio.Task.all_tasks
+
+        for task in all_tasks(self.loop):
+            task.cancel()
+
+    def close(self):
+        """
+        Releases the connector's event loop. Called by get_completed_sims, and when done with completed_sims.
+        """
+        pass
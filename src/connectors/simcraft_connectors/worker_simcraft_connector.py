@@ -0,0 +1,114 @@
+import logging
+import time
+
+import aiohttp
+import asyncio
+
+from src.connectors.simcraft_connectors.lambda_simcraft_connector import LambdaSimcraftConnector
+
+logger = logging.getLogger("SimBot")
+
+
+class WorkerSimcraftConnector(LambdaSimcraftConnector):
+    # seconds a worker that failed a request, or its health check, is left alone before it is checked again
+    HEALTH_CHECK_INTERVAL_SEC = 5
+    HEALTH_CHECK_TIMEOUT_SEC = 2
+
+    def __init__(self, urls, request_timeout=300, max_retries=3, work_unit="sim", screening=None, simc=None):
+        """
+        Runs queued sims on our own HTTP sim workers (simc_worker/server.py), which answer the same requests as the
+        Lambda endpoint. Each request goes to the healthy worker with the fewest requests outstanding.
+        A worker is health checked before its first request, and again after a request to it fails.
+        :param urls: urls.json contents, with the worker urls under "workers"
+        :param request_timeout: Seconds a request may take before it is retried
+        :param max_retries: Retries of a request that failed or timed out, usually on another worker
+        :param work_unit: "suite" or "sim", see LambdaSimcraftConnector
+        :param screening: Two-pass options of suites, see LambdaSimcraftConnector
+        :param simc: SimulationCraft whose sim cache sims are looked up in, see LambdaSimcraftConnector
+        """
+        workers = urls.get("workers", [])
+
+        if not workers:
+            raise RuntimeError("No sim workers listed in urls.json")
+
+        # workers run one sim at a time, so there is no point in more requests than workers
+        super().__init__(urls, max_concurrency=len(workers), initial_concurrency=len(workers),
+                         request_timeout=request_timeout, max_retries=max_retries, work_unit=work_unit,
+                         screening=screening, simc=simc)
+
+        self.workers = workers
+        # worker url to requests sent and not yet answered
+        self.outstanding = {url: 0 for url in workers}
+        # worker url to time it is due for a health check, workers not listed are healthy
+        self._check_due = {url: 0 for url in workers}
+        # worker url to its health check in progress, which every request picking a worker meanwhile shares
+        self._health_checks = {}
+
+    async def check_health(self, session, url):
+        """
+        :return: True if the worker answered its health check
+        """
+        try:
+            async with session.get(url.rstrip("/") + "/health",
+                                   timeout=aiohttp.ClientTimeout(total=self.HEALTH_CHECK_TIMEOUT_SEC)) as response:
+                return response.status == 200
+        except (asyncio.TimeoutError, aiohttp.ClientError):
+            return False
+
+    async def _check_worker(self, session, url):
+        try:
+            healthy = await self.check_health(session, url)
+        finally:
+            del self._health_checks[url]
+
+        if healthy:
+            self._check_due.pop(url, None)
+        else:
+            logger.warning("Sim worker %s failed its health check", url)
+            self._check_due[url] = time.monotonic() + self.HEALTH_CHECK_INTERVAL_SEC
+
+    def _start_due_checks(self, session):
+        now = time.monotonic()
+
+        for url, due_at in self._check_due.items():
+            if due_at <= now and url not in self._health_checks:
+                self._health_checks[url] = asyncio.ensure_future(self._check_worker(session, url))
+
+    async def acquire_url(self, session):
+        self._start_due_checks(session)
+
+        healthy = [url for url in self.workers if url not in self._check_due]
+
+        # with no idle worker known to be healthy, wait for the checks in progress rather than fail the request, or
+        # pile it onto the first worker that passed while the others are still being checked
+        while self._health_checks and all(self.outstanding[url] for url in healthy):
+            await asyncio.wait(list(self._health_checks.values()), return_when=asyncio.FIRST_COMPLETED)
+            healthy = [url for url in self.workers if url not in self._check_due]
+
+        if not healthy:
+            return None
+
+        # least outstanding requests, ties go to the first listed worker
+        url = min(healthy, key=lambda worker: self.outstanding[worker])
+        self.outstanding[url] += 1
+
+        return url
+
+    def release_url(self, url, failed):
+        self.outstanding[url] -= 1
+
+        if failed and url not in self._check_due:
+            # check the worker is still up before sending it more
+            self._check_due[url] = time.monotonic()
+
+    def close(self):
+        # a failed worker's check may still be running when the run ends
+        checks = list(self._health_checks.values())
+
+        for check in checks:
+            check.cancel()
+
+        if checks:
+            self.loop.run_until_complete(asyncio.wait(checks))
+
+        super().close()
@@ -0,0 +1,308 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger("SimBot")
+
+
+class JobQueue:
+    QUEUED = "queued"
+    LEASED = "leased"
+    DONE = "done"
+    FAILED = "failed"
+
+    # seconds between removing old jobs while queueing and claiming
+    PURGE_INTERVAL_SEC = 60
+
+    def __init__(self, db_path, lease_sec=300, max_attempts=3, retention=24 * 3600):
+        """
+        Durable queue of sim jobs in a SQLite database, shared by the processes that queue sims and the worker
+        processes that run them. Finished jobs are kept, so a run that died can be started again without losing
+        the sims that already finished.
+
+        A claimed job is leased to its worker. If the worker does not complete it before the lease expires, e.g.
+        because it crashed, the job is given to another worker.
+        :param db_path: Path of the SQLite database file, created if it does not exist
+        :param lease_sec: Seconds a worker has to complete a claimed job, more than any sim takes
+        :param max_attempts: Leases a job gets before it is failed, so a job that crashes workers is given up on
+        :param retention: Seconds finished jobs are kept after they finish
+        """
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+
+        self._lease_sec = lease_sec
+        self._max_attempts = max_attempts
+        self._retention = retention
+        self._next_purge = 0
+
+        self._lock = threading.Lock()
+        # transactions are explicit, claims must be atomic between processes
+        self._conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False, isolation_level=None)
+
+        with self._lock:
+            # readers don't block the writer, with many workers polling
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS sim_jobs (job_key TEXT PRIMARY KEY, job TEXT NOT NULL, "
+                               "priority INTEGER NOT NULL, state TEXT NOT NULL, attempts INTEGER NOT NULL, "
+                               "worker TEXT, lease_expires REAL, result TEXT, created REAL NOT NULL, "
+                               "finished REAL)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS sim_jobs_claim ON sim_jobs (state, priority, created)")
+
+    def _transaction(self, func):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+
+            try:
+                value = func(self._conn)
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+            self._conn.execute("COMMIT")
+
+            return value
+
+    def enqueue(self, job_key, job, priority=0, max_age=None):
+        """
+        Queues a job, unless a job with the same key is queued, running or done.
+        A failed job is queued again, as is a done job that finished more than max_age seconds ago.
+        :param job_key: Identifies the job, jobs with equal keys are run once
+        :param job: JSON serializable job
+        :param priority: Lower values are claimed first
+        :param max_age: Seconds a done job's result is reused for, None for as long as it is kept
+        :return: State of the job after queueing it
+        """
+        now = time.time()
+        stale_before = now - max_age if max_age is not None else 0
+
+        def enqueue(conn):
+            self._purge_every_interval(conn, now)
+
+            conn.execute("INSERT OR IGNORE INTO sim_jobs (job_key, job, priority, state, attempts, created) "
+                         "VALUES (?, ?, ?, ?, 0, ?)", (job_key, json.dumps(job), priority, self.QUEUED, now))
+            conn.execute("UPDATE sim_jobs SET state = ?, attempts = 0, worker = NULL, result = NULL, finished = NULL, "
+                         "created = ? WHERE job_key = ? AND (state = ? OR (state = ? AND finished < ?))",
+                         (self.QUEUED, now, job_key, self.FAILED, self.DONE, stale_before))
+
+            return conn.execute("SELECT state FROM sim_jobs WHERE job_key = ?", (job_key,)).fetchone()[0]
+
+        return self._transaction(enqueue)
+
+    def claim(self, worker):
+        """
+        Leases the next job to a worker.
+        :param worker: Name of the worker claiming
+        :return: (job key, job), or None if no job is waiting
+        """
+        now = time.time()
+
+        def claim(conn):
+            self._purge_every_interval(conn, now)
+
+            # jobs whose lease ran out too often are given up on
+            conn.execute("UPDATE sim_jobs SET state = ?, finished = ? WHERE state = ? AND lease_expires < ? AND "
+                         "attempts >= ?", (self.FAILED, now, self.LEASED, now, self._max_attempts))
+
+            row = conn.execute("SELECT job_key, job, state, worker FROM sim_jobs WHERE state = ? OR "
+                               "(state = ? AND lease_expires < ?) ORDER BY priority, created LIMIT 1",
+                               (self.QUEUED, self.LEASED, now)).fetchone()
+
+            if row is None:
+                return None
+
+            job_key, job, state, previous_worker = row
+
+            if state == self.LEASED:
+                logger.warning("Lease of job %s by %s expired, giving it to %s", job_key, previous_worker, worker)
+
+            conn.execute("UPDATE sim_jobs SET state = ?, worker = ?, lease_expires = ?, attempts = attempts + 1 "
+                         "WHERE job_key = ?", (self.LEASED, worker, now + self._lease_sec, job_key))
+
+            return job_key, json.loads(job)
+
+        return self._transaction(claim)
+
+    def complete(self, job_key, worker, result):
+        """
+        Stores the result of a claimed job. A falsy result fails the job, so it is run again if queued again.
+        :param job_key:
+        :param worker: Name of the worker that ran the job
+        :param result: JSON serializable result
+        """
+        state = self.DONE if result else self.FAILED
+
+        def complete(conn):
+            # a worker whose lease expired may still finish first, its result is as good as any
+            conn.execute("UPDATE sim_jobs SET state = ?, worker = ?, result = ?, finished = ? "
+                         "WHERE job_key = ? AND state != ?",
+                         (state, worker, json.dumps(result), time.time(), job_key, self.DONE))
+
+        self._transaction(complete)
+
+    def results(self, job_keys):
+        """
+        :param job_keys:
+        :return: dict of job key to result, for the finished jobs among job_keys. Failed jobs' results are False.
+        """
+        results = {}
+        job_keys = list(job_keys)
+
+        with self._lock:
+            # stay below SQLite's limit on query parameters
+            for i in range(0, len(job_keys), 500):
+                chunk = job_keys[i:i + 500]
+                rows = self._conn.execute("SELECT job_key, state, result FROM sim_jobs WHERE state IN (?, ?) AND "
+                                          "job_key IN (%s)" % ",".join("?" * len(chunk)),
+                                          [self.DONE, self.FAILED] + chunk).fetchall()
+
+                for job_key, state, result in rows:
+                    results[job_key] = json.loads(result) if state == self.DONE else False
+
+        return results
+
+    def purge(self):
+        """
+        Removes jobs that finished longer than the retention period ago.
+        :return: Number of jobs removed
+        """
+        return self._transaction(lambda conn: self._purge(conn, time.time()))
+
+    def _purge(self, conn, now):
+        self._next_purge = now + self.PURGE_INTERVAL_SEC
+
+        return conn.execute("DELETE FROM sim_jobs WHERE state IN (?, ?) AND finished < ?",
+                            (self.DONE, self.FAILED, now - self._retention)).rowcount
+
+    def _purge_every_interval(self, conn, now):
+        # the queue is purged by whoever uses it, busy workers are never idle long enough to do it
+        if now >= self._next_purge:
+            self._purge(conn, now)
+
+    def status(self, window_sec=300):
+        """
+        :param window_sec: Seconds of finished jobs throughput is measured over
+        :return: dict of job counts by state, expired leases, and jobs per minute finished by each worker
+        """
+        now = time.time()
+
+        with self._lock:
+            counts = dict(self._conn.execute("SELECT state, COUNT(*) FROM sim_jobs GROUP BY state").fetchall())
+            expired = self._conn.execute("SELECT COUNT(*) FROM sim_jobs WHERE state = ? AND lease_expires < ?",
+                                         (self.LEASED, now)).fetchone()[0]
+            finished = self._conn.execute("SELECT worker, COUNT(*) FROM sim_jobs WHERE state IN (?, ?) AND "
+                                          "finished >= ? GROUP BY worker",
+                                          (self.DONE, self.FAILED, now - window_sec)).fetchall()
+
+        return {
+            "queued": counts.get(self.QUEUED, 0),
+            "leased": counts.get(self.LEASED, 0),
+            "expired_leases": expired,
+            "done": counts.get(self.DONE, 0),
+            "failed": counts.get(self.FAILED, 0),
+            "jobs_per_minute": {worker: count * 60 / window_sec for worker, count in finished}
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def run_worker(job_queue, simc, worker, poll_interval=1.0, exit_when_idle=False):
+    """
+    Runs queued sims until stopped.
+    :param job_queue: JobQueue
+    :param simc: SimulationCraft running the sims
+    :param worker: Name of this worker
+    :param poll_interval: Seconds to wait before looking for jobs again when none are queued
+    :param exit_when_idle: Return once no job is queued, instead of waiting for more
+    :return: Number of jobs run
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    num_jobs = 0
+
+    try:
+        while True:
+            claimed = job_queue.claim(worker)
+
+            if claimed is None:
+                if exit_when_idle:
+                    return num_jobs
+
+                job_queue.purge()
+                time.sleep(poll_interval)
+                continue
+
+            job_key, job = claimed
+
+            try:
+                result = loop.run_until_complete(simc.run_sim_result(**job))
+            except Exception:
+                logger.exception("Sim job %s failed", job_key)
+                result = False
+
+            # the queue keeps finished jobs, the worker need not
+            simc.forget_results()
+
+            job_queue.complete(job_key, worker, result)
+            num_jobs += 1
+    finally:
+        loop.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SimBot job queue')
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    worker_parser = subparsers.add_parser("worker", help="Run queued sims")
+    worker_parser.add_argument('db_path', type=str, help='Job queue database')
+    worker_parser.add_argument('simc_location', type=str, help='Absolute path of SimulationCraft CLI executable')
+    worker_parser.add_argument('config_path', type=str, help='Config directory containing boss_profiles.json')
+    worker_parser.add_argument('--simcraft_timeout', type=int, default=5, help='Timeout, in seconds, of each sim')
+    worker_parser.add_argument('--lease', type=int, default=300,
+                               help='Seconds a claimed sim may take before it is given to another worker')
+    worker_parser.add_argument('--name', type=str, default="%s-%d" % (socket.gethostname(), os.getpid()),
+                               help='Worker name shown by status')
+    worker_parser.add_argument('--poll_interval', type=float, default=1.0,
+                               help='Seconds between looking for sims while none are queued')
+    worker_parser.add_argument('--exit_when_idle', action='store_true', help='Exit once no sim is queued')
+
+    status_parser = subparsers.add_parser("status", help="Show queue depth and worker throughput")
+    status_parser.add_argument('db_path', type=str, help='Job queue database')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    if args.command == "status":
+        job_queue = JobQueue(args.db_path)
+        print(json.dumps(job_queue.status(), indent=2, sort_keys=True))
+        job_queue.close()
+        return
+
+    from src.api.simcraft import SimulationCraft
+
+    job_queue = JobQueue(args.db_path, lease_sec=args.lease)
+    simc = SimulationCraft(args.simc_location, args.simcraft_timeout, args.config_path, output_format="json")
+
+    logger.info("Worker %s running sims from %s", args.name, args.db_path)
+
+    try:
+        num_jobs = run_worker(job_queue, simc, args.name, args.poll_interval, args.exit_when_idle)
+        logger.info("Worker %s ran %d sims", args.name, num_jobs)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        job_queue.close()
+
+
+if __name__ == '__main__':
+    main()
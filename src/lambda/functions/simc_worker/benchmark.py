@@ -0,0 +1,102 @@
+"""
+Reports cold and warm latency of the simc worker's handler.
+
+Every run starts a fresh process, like a new Lambda container: the first call there, including importing the worker,
+is the cold start, the following calls are warm.
+
+    python benchmark.py --simc /path/to/simc --profiles ../../../../config/boss_profiles.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "..", ".."))
+
+
+def sim_job_event(iterations):
+    return {
+        "body": json.dumps({
+            "sim_job": {
+                "character_name": "Redrimer",
+                "realm_slug": "arthas",
+                "region": "US",
+                "spec": "fire",
+                "talent_string": "1111111",
+                "fight_style": "Patchwerk",
+                "iterations": iterations,
+                "target_error": None
+            }
+        })
+    }
+
+
+def measure(args):
+    """
+    Runs in a fresh process.
+    :return: (cold seconds, list of warm seconds)
+    """
+    start = time.perf_counter()
+
+    sys.path.insert(0, ROOT)
+    import main
+
+    main.SIMC_PATH = args.simc
+    main.LOCAL_FILENAME = args.profiles
+
+    def call(iterations):
+        result = main.handle(sim_job_event(iterations), None)
+
+        if result["statusCode"] != 200:
+            raise RuntimeError(result["body"])
+
+    call(args.iterations)
+    cold = time.perf_counter() - start
+
+    warm = []
+
+    for i in range(args.warm_calls):
+        start = time.perf_counter()
+        # a different sim every time, in case the worker caches finished sims
+        call(args.iterations + i + 1)
+        warm.append(time.perf_counter() - start)
+
+    return cold, warm
+
+
+def run():
+    parser = argparse.ArgumentParser(description="Cold and warm latency of the simc worker's handler")
+    parser.add_argument('--simc', type=str, default="./lib/simc", help='simc executable')
+    parser.add_argument('--profiles', type=str, default=os.path.join(ROOT, "config", "boss_profiles.json"),
+                        help='boss_profiles.json')
+    parser.add_argument('--iterations', type=int, default=10, help='Iterations of each sim')
+    parser.add_argument('--runs', type=int, default=5, help='Fresh processes, i.e. cold starts, to measure')
+    parser.add_argument('--warm_calls', type=int, default=5, help='Warm calls in each process')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure(args)))
+        return
+
+    cold = []
+    warm = []
+
+    for _ in range(args.runs):
+        out = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--child"] + sys.argv[1:],
+                                      cwd=os.path.dirname(os.path.abspath(__file__)))
+        run_cold, run_warm = json.loads(out.decode('utf-8').splitlines()[-1])
+        cold.append(run_cold)
+        warm.extend(run_warm)
+
+    print("cold: median %.3fs, max %.3fs (%d runs)" % (statistics.median(cold), max(cold), len(cold)))
+
+    if warm:
+        print("warm: median %.3fs, max %.3fs (%d calls)" % (statistics.median(warm), max(warm), len(warm)))
+
+
+if __name__ == '__main__':
+    run()
@@ -3,26 +3,27 @@ import json
 import os
 import traceback
 from asyncio import get_event_loop
+from queue import Queue
 
 import sys
 
-import boto3
-import botocore
-
-from src.api.simcraft import SimulationCraft
-from src.simbot import SimcraftBot
-from src.simbot_config import SimBotConfig
-
 BUCKET_NAME = 'heanthor-simbot'  # replace with your bucket name
 KEY = 'boss_profiles.json'  # replace with your object key
 LOCAL_FILENAME = '/tmp/boss_profiles.json'
 
-s3 = boto3.resource('s3')
+SIMC_PATH = './lib/simc'
+
+# kept between warm invocations of the same container, filled in on first use
+_warm = {}
 
 
 def get_profiles():
+    # boto3 is slow to import, and only needed by the first invocation of a container
+    import boto3
+    import botocore
+
     try:
-        s3.Bucket(BUCKET_NAME).download_file(KEY, LOCAL_FILENAME)
+        boto3.resource('s3').Bucket(BUCKET_NAME).download_file(KEY, LOCAL_FILENAME)
 
     except botocore.exceptions.ClientError as e:
         if e.response['Error']['Code'] == "404":
@@ -31,6 +32,64 @@ def get_profiles():
             raise
 
 
+def boss_profiles():
+    if "profiles" not in _warm:
+        if not os.path.exists(LOCAL_FILENAME):
+            # grab profiles from s3
+            get_profiles()
+
+        with open(LOCAL_FILENAME, 'r') as f:
+            _warm["profiles"] = json.loads(f.read())
+
+    return _warm["profiles"]
+
+
+def simulationcraft():
+    if "simc" not in _warm:
+        from src.api.simcraft import SimulationCraft
+
+        _warm["simc"] = SimulationCraft(SIMC_PATH, 5, None, output_format="json", boss_profiles=boss_profiles())
+
+    simc = _warm["simc"]
+    # identical sims are only shared within a request, a warm container must not answer with DPS from before a
+    # gear change, nor keep the sims of every guild it ever ran
+    simc.forget_results()
+
+    return simc
+
+
+def simbot():
+    simc = simulationcraft()
+
+    if "simbot" not in _warm:
+        from src.simbot import SimcraftBot
+        from src.simbot_config import SimBotConfig
+
+        sbc = SimBotConfig()
+        # guild and realm come with each suite request
+        sbc.init_args(
+            "",
+            "",
+            SIMC_PATH,
+            True,  # the sim is "local" on lambda
+            write_logs=False,
+            cache_path="/tmp/cache",  # only /tmp is writable on lambda
+            # suites are cached by the caller, and profiles and talents are resolved there
+            talent_cache_ttl=0,
+            character_profile_ttl=0,
+            suite_cache_ttl=0,
+            result_retention=0
+        )
+
+        _warm["simbot"] = SimcraftBot(sbc, None, None, simc, boss_profiles())
+
+    sb = _warm["simbot"]
+    # nobody consumes progress events on lambda, don't let them pile up between invocations
+    sb.event_queue = Queue()
+
+    return sb
+
+
 def response(message, status_code):
     return {
         'statusCode': int(status_code),
@@ -43,43 +102,50 @@ def response(message, status_code):
     }
 
 
+def handle_sim_job(job):
+    """
+    Runs a single sim of a suite assembled by the caller.
+    :param job: SimJob fields
+    """
+    try:
+        result = get_event_loop().run_until_complete(simulationcraft().run_sim_result(**job))
+        return response({"result": result}, 200)
+    except Exception as e:
+        print(traceback.format_exc())
+        return response({"error": str(e)}, 500)
+
+
 def handle(event, context):
-    os.environ['PATH'] = os.environ['PATH'] + ':' + os.getenv('LAMBDA_TASK_ROOT', '')
+    if "path_set" not in _warm:
+        os.environ['PATH'] = os.environ['PATH'] + ':' + os.getenv('LAMBDA_TASK_ROOT', '')
+        _warm["path_set"] = True
 
     try:
         body = json.loads(event["body"])
+
+        if "sim_job" in body:
+            return handle_sim_job(body["sim_job"])
+
         params = body["sim_params"]
     except Exception:
         return response({"error": "Invalid parameters provided"}, 500)
 
-    if not os.path.exists(LOCAL_FILENAME):
-        # grab profiles from s3
-        get_profiles()
-
-    with open(LOCAL_FILENAME, 'r') as f:
-        profile_dict = json.loads(f.read())
-
-    sbc = SimBotConfig()
-    sbc.init_args(
-        "",
-        params["realm_slug"],
-        "./lib/simc",
-        True,  # the sim is "local" on lambda
-        simc_iter=params["iterations"],
-        write_logs=False
-    )
-
-    sc = SimulationCraft("./lib/simc", 5, "/tmp")
-    sb = SimcraftBot(sbc, None, None, sc, profile_dict)
-
     loop = get_event_loop()
-    promise = sb.sim_single_suite(
-        params["character_name"],
-        params["realm_slug"],
-        params["raiding_stats"]
-    )
 
     try:
+        sb = simbot()
+        # the warm SimcraftBot serves every guild run, each with its own two-pass options
+        sb.set_screening_options(params.get("screening"))
+
+        promise = sb.sim_single_suite(
+            params["character_name"],
+            params["realm_slug"],
+            params["region"],
+            params["iterations"],
+            params["raiding_stats"],
+            params.get("target_error")
+        )
+
         suite = loop.run_until_complete(promise)
         return response({"suite": suite}, 200)
     except Exception as e:
@@ -0,0 +1,119 @@
+"""
+Serves the simc worker handler over HTTP, for running sims on our own machines instead of Lambda.
+Requests and responses are the same as the Lambda endpoint's: POST a sim_params or sim_job body to any path.
+GET /health answers 200 while the worker is up.
+
+Each worker runs one sim at a time, start one per core:
+
+    python server.py --port 8081 --simc /usr/local/bin/simc --profiles ../../../../config/boss_profiles.json
+
+and list every worker's url under "workers" in urls.json.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import socketserver
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "..", "..")))
+
+import main
+
+logger = logging.getLogger("SimBot")
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    # http.server.ThreadingHTTPServer, which needs Python 3.7
+    daemon_threads = True
+
+
+class WorkerRequestHandler(BaseHTTPRequestHandler):
+    # the handler keeps warm state that is not thread safe, requests are handled one at a time
+    handle_lock = threading.Lock()
+
+    # requests received and not yet answered, reported by /health
+    stats_lock = threading.Lock()
+    num_outstanding = 0
+    num_handled = 0
+    started_at = time.time()
+
+    def do_GET(self):
+        if self.path.rstrip("/") != "/health":
+            self.respond(404, {"error": "Not found"})
+            return
+
+        self.respond(200, {
+            "status": "ok",
+            "outstanding": WorkerRequestHandler.num_outstanding,
+            "handled": WorkerRequestHandler.num_handled,
+            "uptime": time.time() - WorkerRequestHandler.started_at
+        })
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode('utf-8')
+
+        with self.stats_lock:
+            WorkerRequestHandler.num_outstanding += 1
+
+        try:
+            with self.handle_lock:
+                # every request gets its own thread, and the handler needs a loop to run sims on
+                loop = asyncio.new_event_loop()
+                asyncio.set_event_loop(loop)
+
+                try:
+                    result = main.handle({"body": body}, None)
+                finally:
+                    loop.close()
+        finally:
+            with self.stats_lock:
+                WorkerRequestHandler.num_outstanding -= 1
+                WorkerRequestHandler.num_handled += 1
+
+        self.respond(result["statusCode"], result["body"])
+
+    def respond(self, status, body):
+        data = (body if isinstance(body, str) else json.dumps(body)).encode('utf-8')
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+def run():
+    parser = argparse.ArgumentParser(description='HTTP sim worker')
+    parser.add_argument('--host', type=str, default="0.0.0.0", help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8081, help='Port to listen on')
+    parser.add_argument('--simc', type=str, default=main.SIMC_PATH, help='simc executable')
+    parser.add_argument('--profiles', type=str, default=main.LOCAL_FILENAME,
+                        help='boss_profiles.json, downloaded from S3 if missing')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    main.SIMC_PATH = args.simc
+    main.LOCAL_FILENAME = args.profiles
+
+    server = ThreadingHTTPServer((args.host, args.port), WorkerRequestHandler)
+    logger.info("Sim worker listening on %s:%d", args.host, args.port)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    run()
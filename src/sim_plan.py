@@ -0,0 +1,63 @@
+from collections import Counter
+
+
+class SimPlan:
+    # rough CPU cost of a fight style relative to Patchwerk, more targets and movement cost more
+    FIGHT_STYLE_COST = {
+        "Patchwerk": 1.0,
+        "LightMovement": 1.1,
+        "HeavyMovement": 1.2,
+        "Ultraxion": 1.2,
+        "HelterSkelter": 1.5,
+        "Beastlord": 2.0,
+        "HecticAddCleave": 2.5,
+    }
+
+    # CPU seconds each simc process spends starting up and importing the armory profile
+    SIMC_STARTUP_CPU_SECONDS = 1.0
+
+    def __init__(self, cpu_seconds_per_iteration):
+        """
+        Collects the sims of a guild run, collapsing duplicates, to estimate its cost before running it.
+        :param cpu_seconds_per_iteration: CPU seconds one Patchwerk iteration takes
+        """
+        self._cpu_seconds_per_iteration = cpu_seconds_per_iteration
+
+        self.players = set()
+        self.num_requested = 0
+        # distinct SimJob to True if its result is already cached
+        self.jobs = {}
+
+    def add(self, job, cached):
+        """
+        :param job: SimJob
+        :param cached: True if the sim's result is already cached and costs nothing to run
+        """
+        self.players.add(job.character_name)
+        self.num_requested += 1
+        self.jobs[job] = cached
+
+    def estimate_cpu_seconds(self, job):
+        # sims with a target error stop early, so for them this is an upper bound
+        return self.SIMC_STARTUP_CPU_SECONDS + job.iterations * self._cpu_seconds_per_iteration * \
+                                               self.FIGHT_STYLE_COST.get(job.fight_style, 1.0)
+
+    def jobs_to_run(self):
+        return [job for job, cached in self.jobs.items() if not cached]
+
+    def summary(self):
+        """
+        :return: dict of the number of players, sims requested by all sim suites, distinct sims, distinct sims
+                 already cached, sims left to run, their estimated CPU seconds, and sims to run per fight style
+        """
+        to_run = self.jobs_to_run()
+
+        return {
+            "players": len(self.players),
+            "sims_requested": self.num_requested,
+            "distinct_jobs": len(self.jobs),
+            "cached_jobs": len(self.jobs) - len(to_run),
+            "jobs_to_run": len(to_run),
+            "estimated_cpu_seconds": sum(self.estimate_cpu_seconds(job) for job in to_run),
+            "jobs_by_fight_style": dict(Counter(job.fight_style for job in to_run))
+        }
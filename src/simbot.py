@@ -1,3 +1,5 @@
+import asyncio
+import hashlib
 import json
 import logging
 import os
@@ -8,14 +10,23 @@ import unicodedata
 
 from enum import Enum
 from queue import Queue
-import _thread
 
+from src.api import ReportableError
 from src.api.battlenet import BattleNet
-from src.api.simcraft import SimulationCraft
+from src.api.simcraft import SimJob, SimulationCraft
 from src.api.warcraftlogs import WarcraftLogs, WarcraftLogsError
+from src.cache.profile_store import ProfileStore
+from src.cache.result_store import ResultStore
+from src.cache.sim_cache import SimCache
+from src.cache.sqlite_cache import SqliteCache
+from src.cache.talent_store import TalentStore
+from src.job_queue import JobQueue
 from src.connectors.simcraft_connectors.lambda_simcraft_connector import LambdaSimcraftConnector
 from src.connectors.simcraft_connectors.local_simcraft_connector import LocalSimcraftConnector
-from src.simbot_config import SimBotConfig
+from src.connectors.simcraft_connectors.queue_simcraft_connector import QueueSimcraftConnector
+from src.connectors.simcraft_connectors.worker_simcraft_connector import WorkerSimcraftConnector
+from src.sim_plan import SimPlan
+from src.simbot_config import SimBotConfig, get_script_path
 
 logger = logging.getLogger("SimBot")
 
@@ -25,6 +36,10 @@ class SimBotError(Enum):
     NO_KILLS_LOGGED = "No kills logged for this boss."
 
 
+class SimCancelled(ReportableError):
+    pass
+
+
 # noinspection PyCompatibility
 class SimcraftBot:
     def __init__(self, config, bnet=None, warcr=None, simc=None, profiles=None):
@@ -33,18 +48,17 @@ class SimcraftBot:
         :param config: SimbotConfig
         """
         # create simbot with realm and guild info
-        with open(os.path.join(config.params["config_path"], "keys.json"), 'r') as f:
-            f = json.loads(f.read())
-            warcraft_logs_public = f["warcraftlogs"]["public"]
-            battlenet_pub = f["battlenet"]["public"]
-            battlenet_sec = f["battlenet"]["secret"]
+        self._config = config
 
         if profiles is None:
             with open(os.path.join(config.params["config_path"], "boss_profiles.json"), 'r') as f:
                 self._profiles = json.loads(f.read())
+        else:
+            self._profiles = profiles
 
-        with open(os.path.join(config.params["config_path"], "urls.json"), 'r') as f:
-            self._urls = json.loads(f.read())
+        # keys.json and urls.json are read on first use, sim workers need neither
+        self._keys = None
+        self._urls = None
 
         self._guild = config.params["guildname"]
         self._realm = config.params["realm"]
@@ -53,14 +67,35 @@ class SimcraftBot:
         self._num_weeks = config.params["weeks_to_examine"]
         self._max_level = config.params["max_level"]
         self._sim_iterations = config.params["simcraft_iterations"]
-        self._local_sim = config.params["local_sim"]
+        self._sim_target_error = config.params["sim_target_error"]
+        self._sim_cache_ttl = config.params["sim_cache_ttl"]
+        self._screening_iterations = config.params["screening_iterations"]
+        self._screening_threshold = config.params["screening_threshold"]
+        self._screening_margin = config.params["screening_margin"]
+        self._screening_max_error = config.params["screening_max_error"]
+        self._sim_backend = self.get_sim_backend(config)
+        self._max_concurrent_sims = config.params["max_concurrent_sims"]
+        self._warcraftlogs_concurrency = config.params["warcraftlogs_concurrency"]
+        self._battlenet_concurrency = config.params["battlenet_concurrency"]
+        self._lambda_max_concurrency = config.params["lambda_max_concurrency"]
+        self._lambda_timeout = config.params["lambda_timeout"]
+        self._lambda_max_retries = config.params["lambda_max_retries"]
+        self._lambda_work_unit = config.params["lambda_work_unit"]
+        self._sim_cpu_seconds_per_iteration = config.params["sim_cpu_seconds_per_iteration"]
 
         self._blizzard_locale = "en_US"
 
-        self._bnet = bnet or BattleNet(battlenet_pub)
-        self._warcr = warcr or WarcraftLogs(warcraft_logs_public)
+        # created on first use
+        self._bnet = bnet
+        self._warcr = warcr
+        self._talent_store = self.create_talent_store(config)
+        self._character_profile_store = self.create_character_profile_store(config)
+        self._suite_cache = self.create_suite_cache(config)
+        self._result_store = self.create_result_store(config)
         self._simc = simc or SimulationCraft(config.params["simc_location"], config.params["simcraft_timeout"],
-                                             config.params["config_path"])
+                                             config.params["config_path"], self.create_sim_cache(config),
+                                             config.params["simc_batch_size"],
+                                             output_format=config.params["simc_output_format"])
 
         # all players in guild
         self._players_in_guild = []
@@ -68,31 +103,115 @@ class SimcraftBot:
         # alert thread for sim progress
         self.event_queue = Queue()
 
+        # optional function returning the most local sims to run at once right now, set by a scheduler sharing the
+        # machine between several guild runs
+        self.concurrency_limit = None
+
         # set by another thread to indicate processing should stop early and result is not wanted
         self._cancelFlag = False
+        # connector running this bot's sims, stopped by cancel_sim
+        self._connector = None
+
+    @property
+    def bnet(self):
+        if self._bnet is None:
+            self._bnet = BattleNet(self.api_keys()["battlenet"]["public"], self.create_roster_cache(self._config),
+                                   self._config.params["roster_cache_ttl"])
+
+        return self._bnet
+
+    @property
+    def warcr(self):
+        if self._warcr is None:
+            self._warcr = WarcraftLogs(self.api_keys()["warcraftlogs"]["public"])
+
+        return self._warcr
+
+    @property
+    def urls(self):
+        if self._urls is None:
+            with open(os.path.join(self._config.params["config_path"], "urls.json"), 'r') as f:
+                self._urls = json.loads(f.read())
+
+        return self._urls
+
+    def api_keys(self):
+        """
+        :return: keys.json contents
+        """
+        if self._keys is None:
+            with open(os.path.join(self._config.params["config_path"], "keys.json"), 'r') as f:
+                self._keys = json.loads(f.read())
+
+        return self._keys
 
     def cancel_sim(self):
         """
-        Causes any running sim job to be cancelled at the earliest opportunity.
+        Cancels any running sim job, from any thread. Sims still queued are dropped, running simc processes are
+        killed and requests in flight are aborted, so run_all_sims raises SimCancelled right away.
         :return:
         """
         self._cancelFlag = True
 
-    def run_all_sims(self):
+        connector = self._connector
+
+        if connector is not None:
+            connector.cancel()
+
+    def run_all_sims(self, on_result=None):
         """
-        Run sims for each DPS player in the guild.
+        Run sims for each DPS player in the guild, storing the report in the result store if there is one.
+        :param on_result: Optional function called with each player's result, and the guild average so far,
+                          as soon as the player is done
         :return: Guild sim report
         """
+        start = time.time()
+
+        # playername, sim results
+        guild_sims = {}
+        guild_avg = 0.0
+
+        for item, guild_avg in self.iter_all_sims():
+            guild_sims[item["player_name"]] = item
+
+            if on_result is not None:
+                on_result(item, guild_avg)
+
+        guild_sims["guild_avg"] = guild_avg
+
+        if self._result_store is not None:
+            self._result_store.put(self._region, self._realm, self._guild, self._difficulty, self._num_weeks,
+                                   guild_sims, self.run_params(), start)
+
+        return guild_sims
+
+    def run_params(self):
+        """
+        :return: Settings a guild run's report depends on, stored with the report
+        """
+        return {
+            "max_level": self._max_level,
+            "iterations": self._sim_iterations,
+            "target_error": self._sim_target_error,
+            "screening_iterations": self._screening_iterations,
+            "screening_threshold": self._screening_threshold,
+            "sim_backend": self._sim_backend,
+            "simc_version": self._simc.simc_version
+        }
+
+    def iter_all_sims(self):
+        """
+        Run sims for each DPS player in the guild, yielding each player's result as soon as it is done,
+        in the order players finish.
+        :return: Generator of (player result, average performance of the players finished so far)
+        """
         logger.info("Starting sims for guild %s, realm %s, region %s", self._guild, self._realm, self._region)
 
-        names, self._players_in_guild = self._bnet.get_guild_members(self._realm, self._guild, self._blizzard_locale,
+        names, self._players_in_guild = self.bnet.get_guild_members(self._realm, self._guild, self._blizzard_locale,
                                                                      self._max_level)
 
-        if not self._warcr.has_talent_data():
-            self._warcr.set_talent_data(self._bnet.get_all_talents(self._blizzard_locale))
+        self.load_talent_data()
 
-        # playername, sim results
-        guild_sims = {}
         # average dps
         guild_percents = []
         # only run sims for 110 dps players
@@ -104,41 +223,212 @@ class SimcraftBot:
             "num_sims": num_sims
         })
 
-        if self._local_sim:
-            sc = LocalSimcraftConnector()
+        if self._sim_backend == "local":
+            sc = LocalSimcraftConnector(self._max_concurrent_sims, self.concurrency_limit)
+        elif self._sim_backend == "queue":
+            sc = QueueSimcraftConnector(self.create_job_queue(self._config), self._sim_cache_ttl)
+        elif self._sim_backend == "workers":
+            sc = WorkerSimcraftConnector(self.urls, request_timeout=self._lambda_timeout,
+                                         max_retries=self._lambda_max_retries, work_unit=self._lambda_work_unit,
+                                         screening=self.screening_options(), simc=self._simc)
         else:
-            sc = LambdaSimcraftConnector(self._urls)
+            sc = LambdaSimcraftConnector(self.urls, self._lambda_max_concurrency,
+                                         request_timeout=self._lambda_timeout, max_retries=self._lambda_max_retries,
+                                         work_unit=self._lambda_work_unit, screening=self.screening_options(),
+                                         simc=self._simc)
 
-        for player in names["DPS"]:
-            # if self._cancelFlag:
-            #     # kill this simbot in the hottest loop
-            #     logger.debug("Cancelled job for %s", player["name"])
-            #     _thread.exit()
-            self.sim_single_character(player["name"], player["realm"], sc)
+        completed_sims = None
+        # set before checking the flag, so a concurrent cancel_sim either sees the connector or is seen here
+        self._connector = sc
 
-        all_results = sc.get_completed_sims()
+        try:
+            self.check_cancelled(self._guild)
 
-        for item in all_results:
-            guild_sims[item["player_name"]] = item
+            # fetch every player's parses concurrently before any sims are queued
+            all_parses = self.run_until_complete(sc, self.fetch_guild_parses(names["DPS"]))
 
-            if item and "error" not in item:
-                guild_percents.append(item["average_performance"])
-                logger.debug("Finished all sims for character %s in %.2f sec", item["player_name"],
-                             item["elapsed_time"])
-            else:
-                logger.debug("Skipped player %s", item["player_name"])
+            if self._character_profile_store is not None:
+                self.run_until_complete(sc, self.fetch_character_profiles(names["DPS"], all_parses))
 
-                self.event_queue.put({
-                    "player": item["player_name"],
-                    "done": True
-                })
+            skipped, reused, to_sim, fingerprints = self.sort_players(names["DPS"], all_parses)
 
-        guild_sims["guild_avg"] = sum(guild_percents) / len(guild_percents) if len(guild_percents) > 0 else 0.0
+            if reused:
+                logger.info("Reusing the suites of %d unchanged players", len(reused))
 
-        return guild_sims
+            plan = self.plan_sims([player for player, _ in to_sim], [stats for _, stats in to_sim]).summary()
+            logger.info("Running %d distinct sims (%d cached) for %d players, estimated %.0f CPU seconds",
+                        plan["jobs_to_run"], plan["cached_jobs"], plan["players"], plan["estimated_cpu_seconds"])
+
+            for player, raiding_stats in to_sim:
+                self.queue_suite(player["name"], player["realm"], raiding_stats, sc)
+
+            for item in skipped + reused:
+                yield self.player_done(item, guild_percents)
+
+            completed_sims = sc.completed_sims()
+
+            while True:
+                try:
+                    item = self.run_until_complete(sc, completed_sims.__anext__())
+                except StopAsyncIteration:
+                    break
+
+                if item["player_name"] in fingerprints and self.can_store_suite(item):
+                    cache_key, fingerprint = fingerprints[item["player_name"]]
+                    self._suite_cache.put(cache_key, {"fingerprint": fingerprint, "suite": item})
+
+                yield self.player_done(item, guild_percents)
+        finally:
+            if completed_sims is not None:
+                # stops sims still running if the caller stopped iterating early
+                sc.loop.run_until_complete(completed_sims.aclose())
+
+            self._connector = None
+            sc.close()
+
+    def run_until_complete(self, simc_connector, awaitable):
+        """
+        Runs an awaitable on a connector's loop.
+        :raises SimCancelled: if cancel_sim stopped it
+        """
+        try:
+            return simc_connector.loop.run_until_complete(awaitable)
+        except asyncio.CancelledError:
+            self.check_cancelled(self._guild)
+            raise
+
+    def sort_players(self, players, all_parses):
+        """
+        Sorts players by what a guild run does with them.
+        :param players: DPS players, as returned by BattleNet.get_guild_members
+        :param all_parses: Parses of each player, as returned by WarcraftLogs.get_parses_for_players
+        :return: (results of players whose parses failed,
+                  stored suites of players whose sim inputs did not change,
+                  list of (player, parses) to sim,
+                  dict of player name to (suite cache key, fingerprint) of players to sim)
+        """
+        skipped = []
+        reused = []
+        to_sim = []
+        fingerprints = {}
+
+        for player, raiding_stats in zip(players, all_parses):
+            if isinstance(raiding_stats, WarcraftLogsError):
+                skipped.append({"player_name": player["name"], "error": str(raiding_stats)})
+            elif raiding_stats:
+                stored_suite = None
+
+                if self._suite_cache is not None:
+                    cache_key, fingerprint = self.suite_fingerprint(player, raiding_stats)
+                    stored_suite = self.stored_suite(cache_key, fingerprint, self.suite_max_age(player))
+                    fingerprints[player["name"]] = (cache_key, fingerprint)
+
+                if stored_suite is not None:
+                    reused.append(stored_suite)
+                else:
+                    to_sim.append((player, raiding_stats))
+
+        return skipped, reused, to_sim, fingerprints
+
+    def suite_fingerprint(self, player, raiding_stats):
+        """
+        Identifies everything a player's suite depends on: their kills (with spec and talents), their character
+        profile, the simc build and the sim settings. Gear changes are only seen through the character profile,
+        see suite_max_age.
+        :param player: DPS player, as returned by BattleNet.get_guild_members
+        :param raiding_stats: Result of WarcraftLogs.get_all_parses
+        :return: (suite cache key, fingerprint)
+        """
+        realm_slug = self.realm_slug(player["realm"])
+
+        cache_key = json.dumps([player["name"].lower(), realm_slug.lower(), self._region.upper(), self._difficulty,
+                                int(self._num_weeks)])
+
+        # only what sim_single_suite reads from each kill, rankings of old kills shift over time
+        kills = {boss_name: sorted([kill["dps"], kill["spec"], kill["talents"]] for kill in stats)
+                 for boss_name, stats in raiding_stats.items()}
+
+        fingerprint = json.dumps([
+            kills,
+            self._simc.character_profile(player["name"], realm_slug, self._region)[1],
+            self._simc.simc_version,
+            {boss_name: self._profiles[boss_name] for boss_name, stats in raiding_stats.items() if stats},
+            self._sim_iterations,
+            self._sim_target_error,
+            [self._screening_iterations, self._screening_threshold, self._screening_margin,
+             self._screening_max_error]
+        ], sort_keys=True)
+
+        return cache_key, hashlib.sha1(fingerprint.encode('utf-8')).hexdigest()
+
+    def suite_max_age(self, player):
+        """
+        Without a local character profile the fingerprint does not change with the player's gear, so their suite
+        is reused no longer than a sim result would be.
+        :param player: DPS player, as returned by BattleNet.get_guild_members
+        :return: Seconds the player's stored suite may be reused for, None for as long as the suite cache keeps it
+        """
+        if self._simc.character_profile(player["name"], self.realm_slug(player["realm"]), self._region)[1] is None:
+            return self._sim_cache_ttl
+
+        return None
+
+    def stored_suite(self, cache_key, fingerprint, max_age=None):
+        """
+        :param max_age: Seconds since it was stored the suite may be reused for, None for no limit
+        :return: The stored suite of a player, if its fingerprint matches and it is not too old, otherwise None
+        """
+        stored = self._suite_cache.get(cache_key)
+
+        if stored is None or stored["fingerprint"] != fingerprint:
+            return None
+
+        if max_age is not None and time.time() - self._suite_cache.get_entry(cache_key)[1] > max_age:
+            return None
+
+        logger.debug("Reusing stored suite of player %s", stored["suite"]["player_name"])
+
+        return dict(stored["suite"], reused=True)
+
+    @staticmethod
+    def can_store_suite(suite):
+        """
+        Whether a suite may be reused by later runs. Failed sims, e.g. a Lambda invocation out of retries, are
+        simmed again rather than served from the suite cache.
+        :param suite: Result of sim_single_suite
+        :return: False if the suite, or a boss of it, failed for any reason but the player having no kills
+        """
+        if "error" in suite:
+            return False
+
+        return all(boss.get("error", SimBotError.NO_KILLS_LOGGED.value) == SimBotError.NO_KILLS_LOGGED.value
+                   for boss in suite["bosses"])
+
+    def player_done(self, item, guild_percents):
+        """
+        Records a player's result in the guild average, and announces it on the event queue.
+        :param item: Result of sim_single_suite, or a dict of player_name and error
+        :param guild_percents: Average performance of every player finished so far, appended to
+        :return: (item, guild average performance so far)
+        """
+        if "error" not in item:
+            guild_percents.append(item["average_performance"])
+            logger.debug("Finished all sims for character %s in %.2f sec", item["player_name"],
+                         item["elapsed_time"])
+        else:
+            logger.debug("Skipped player %s", item["player_name"])
+
+        guild_avg = sum(guild_percents) / len(guild_percents) if len(guild_percents) > 0 else 0.0
+
+        self.event_queue.put({
+            "player": item["player_name"],
+            "done": True,
+            "result": item,
+            "guild_avg": guild_avg
+        })
+
+        return item, guild_avg
 
-    # TODO this can be async as well
-    # warcraftlogs can be queried async, but we only spawn async sim processes if data is found
     def sim_single_character(self, player_name, realm, simc_connector):
         """
         Runs full suite of sims on specific character and realm, using the given locale.
@@ -147,24 +437,22 @@ class SimcraftBot:
         :return:
         """
         if not self._players_in_guild:
-            _, self._players_in_guild = self._bnet.get_guild_members(self._realm, self._guild, self._blizzard_locale,
+            _, self._players_in_guild = self.bnet.get_guild_members(self._realm, self._guild, self._blizzard_locale,
                                                                      self._max_level)
 
         if player_name not in self._players_in_guild:
             logger.error("Player %s not in guild %s", player_name, self._guild)
             return False
 
-        if not self._warcr.has_talent_data():
-            self._warcr.set_talent_data(self._bnet.get_all_talents(self._blizzard_locale))
+        self.load_talent_data()
 
         try:
-            raiding_stats = self._warcr.get_all_parses(player_name, self.realm_slug(realm), self._region,
+            raiding_stats = self.warcr.get_all_parses(player_name, self.realm_slug(realm), self._region,
                                                        "dps", self._difficulty, int(self._num_weeks))
         except WarcraftLogsError as e:
             return {"error": str(e)}
 
-        simc_connector.queue_sim(self.sim_single_suite, player_name, self.realm_slug(realm), self._region,
-                                 self._sim_iterations, raiding_stats)
+        self.queue_suite(player_name, realm, raiding_stats, simc_connector)
 
         # self.event_queue.put({
         #     "player": player_name,
@@ -173,14 +461,43 @@ class SimcraftBot:
 
         return True
 
+    def load_talent_data(self):
+        """
+        Gives WarcraftLogs the Bnet talent data it needs, from the talent store if there is one.
+        """
+        if self.warcr.has_talent_data():
+            return
+
+        if self._talent_store is None:
+            self.warcr.set_talent_data(self.bnet.get_all_talents(self._blizzard_locale))
+        else:
+            self.warcr.set_talent_data(*self._talent_store.get(self._blizzard_locale, self.bnet.get_all_talents))
+
+    def queue_suite(self, player_name, realm, raiding_stats, simc_connector):
+        """
+        Queues the sim suite of a player whose parses have been fetched.
+        :param player_name:
+        :param realm:
+        :param raiding_stats: Result of WarcraftLogs.get_all_parses
+        :param simc_connector:
+        """
+        # players with the most bosses to sim are started first, so they don't end up as the tail of the run
+        simc_connector.queue_sim(self.sim_single_suite, player_name, self.realm_slug(realm), self._region,
+                                 self._sim_iterations, raiding_stats, self._sim_target_error,
+                                 priority=-len(raiding_stats))
+
     # unit of work to be parallelized
-    async def sim_single_suite(self, player, realm_slug, region, iterations, raiding_stats):
+    async def sim_single_suite(self, player, realm_slug, region, iterations, raiding_stats, target_error=None,
+                               simc=None):
         """
         Produces report on single character's average sims in the form:
          {
          boss name: {"average_dps": _,
                      "num_fights": _,
                       "sim_dps": _,
+                      "sim_dps_error": _, (with json simc output)
+                      "sim_iterations": _, (with json simc output)
+                      "sim_stage": _, ("screening" or "refined", in two-pass mode)
                       "percent_potential": _
                       },
          "average_performance": _,
@@ -191,113 +508,462 @@ class SimcraftBot:
         :param player:
         :param realm:
         :param raiding_stats:
+        :param target_error: DPS error, in percent of DPS, each sim runs until. iterations is then the maximum.
+        :param simc: Runs the sims, with SimulationCraft.run_sim_result's interface. Defaults to local simc.
         :return:
         """
-        # each sim is a character, talents, and fight configuration
-        #   tag (<character_name><talent string><fight config>)
-        sim_cache = {}
-        # used to calculate average performance
-        scores_lst = []
+        simc = simc or self._simc
+
+        # in two-pass mode every boss is first screened with a few iterations, then only sims whose result is
+        # close to the screening threshold, or too imprecise, are refined with iterations and target_error
+        screening = self._screening_iterations is not None
+        first_iterations, first_target_error = self.first_pass_options(iterations, target_error)
+
         scores = {}
         start = time.time()
 
         scores["bosses"] = []
 
-        for boss_name, stats in raiding_stats.items():
-            average_dps = 0.0
-            average_percentage = 0.0
-            average_ilvl = 0.0
+        # bosses are simmed grouped by fight profile, so concurrent suites can share simc batches
+        # the report keeps the original boss order
+        boss_order = {boss_name: i for i, boss_name in enumerate(raiding_stats)}
 
-            max_dps = 0.0
-            max_dps_talents = []
-            max_dps_spec = ""
+        # bosses with kills, as (boss name, kills, summarized kills, distinct sim)
+        # bosses sharing spec, talents and fight profile share one sim
+        boss_sims = []
 
+        for boss_name, stats in raiding_stats.items():
             if not stats:
                 # no kills for this boss on record, but other kills are still present
                 scores["bosses"].append({"boss_name": boss_name, "error": SimBotError.NO_KILLS_LOGGED.value})
-                continue
 
-            for kill in stats:
-                if self._cancelFlag:
-                    # kill this simbot in the hottest loop
-                    logger.debug("Cancelled job for %s" % player)
-                    _thread.exit()
-
-                if kill["dps"] > max_dps:
-                    max_dps = kill["dps"]
-                    max_dps_spec = kill["spec"].lower()
-                    max_dps_talents = kill["talents"]
-                average_dps += kill["dps"]
-                average_percentage += kill["historical_percent"]
-                average_ilvl += kill["ilvl"]
-
-            average_dps /= len(stats)
-            average_percentage /= len(stats)
-            average_ilvl /= len(stats)
-
-            if max_dps_spec == "beastmastery":
-                max_dps_spec = "beast_mastery"
-
-            fight_profile = self._profiles[boss_name]
-            tag = hash("%s%s%s" % (player, max_dps_spec, fight_profile))
-
-            # actually run sim
-            if tag not in sim_cache:
-                sim_results = await self._simc.run_sim(player,
-                                                       realm_slug,
-                                                       region,
-                                                       max_dps_spec,
-                                                       ''.join(str(x) for x in max_dps_talents),
-                                                       iterations)
-
-                if not sim_results:
-                    # simcraft error, results are invalid
-                    scores["bosses"].append({"boss_name": boss_name, "error": SimBotError.SIMCRAFT_ERROR.value})
-                    sim_cache[tag] = SimBotError.SIMCRAFT_ERROR
-
-                    continue
-
-                sim_cache[tag] = sim_results
-            else:
-                if isinstance(sim_cache[tag], SimBotError):
-                    scores["bosses"].append({"boss_name": boss_name, "error": sim_cache[tag]})
+        # bosses without kills, e.g. of older tiers, may have no fight profile
+        for boss_name, stats in sorted(((boss_name, stats) for boss_name, stats in raiding_stats.items() if stats),
+                                       key=lambda item: self._profiles[item[0]]):
+            kills = self.summarize_kills(stats)
+            boss_sims.append((boss_name, stats, kills,
+                              (kills["spec"], kills["talent_string"], self._profiles[boss_name])))
 
-                    continue
-                logger.debug("Using cached sim (%s) for player %s spec %s fight config %s", sim_cache[tag], player,
-                             max_dps_spec,
-                             fight_profile)
-                sim_results = sim_cache[tag]
+        def sim_done(sim):
+            # add message to be consumed
+            for boss_name, _, _, boss_sim in boss_sims:
+                if boss_sim == sim:
+                    self.event_queue.put({
+                        "player": player,
+                        "boss": boss_name,
+                        "done": False
+                    })
+
+        sim_results = await self.run_distinct_sims(simc, player, realm_slug, region,
+                                                   [sim for _, _, _, sim in boss_sims], first_iterations,
+                                                   first_target_error, sim_done)
+
+        # (boss scores, distinct sim) of screened bosses to sim again
+        to_refine = []
+
+        for boss_name, stats, kills, sim in boss_sims:
+            sim_result = sim_results[sim]
+            average_dps = kills["average_dps"]
+
+            if not sim_result:
+                # simcraft error, results are invalid
+                scores["bosses"].append({"boss_name": boss_name, "error": SimBotError.SIMCRAFT_ERROR.value})
+                continue
 
             # result is calculated
-            performance_percent = (average_dps / sim_results) * 100
-
-            # add message to be consumed
-            self.event_queue.put({
-                "player": player,
-                "boss": boss_name,
-                "done": False
-            })
+            boss_scores = {
+                "boss_name": boss_name,
+                "average_dps": average_dps,
+                "num_fights": len(stats)
+            }
+            boss_scores.update(self.sim_scores(average_dps, sim_result))
 
             logger.info("[%s] Average dps (%d fight%s) %d vs sim %d on %s (%d%% of potential)" % (
-                player, len(stats), "" if len(stats) == 1 else "s", average_dps, sim_results, boss_name,
-                performance_percent))
+                player, len(stats), "" if len(stats) == 1 else "s", average_dps, boss_scores["sim_dps"], boss_name,
+                boss_scores["percent_potential"]))
 
-            scores["bosses"].append({
-                "boss_name": boss_name,
-                "average_dps": average_dps,
-                "num_fights": len(stats),
-                "sim_dps": sim_results,
-                "percent_potential": performance_percent
-            })
+            if screening:
+                boss_scores["sim_stage"] = "screening"
 
-            scores_lst.append(performance_percent)
+                if self.needs_refinement(boss_scores):
+                    to_refine.append((boss_scores, sim))
 
+            scores["bosses"].append(boss_scores)
+
+        refined_results = await self.run_distinct_sims(simc, player, realm_slug, region,
+                                                       [sim for _, sim in to_refine], iterations, target_error)
+
+        for boss_scores, sim in to_refine:
+            sim_result = refined_results[sim]
+
+            if not sim_result:
+                # the screening result is still usable
+                logger.warning("[%s] Refinement sim failed on %s, keeping screening result", player,
+                               boss_scores["boss_name"])
+                continue
+
+            boss_scores.update(self.sim_scores(boss_scores["average_dps"], sim_result))
+            boss_scores["sim_stage"] = "refined"
+
+            logger.info("[%s] Refined sim %d on %s (%d%% of potential)" % (
+                player, boss_scores["sim_dps"], boss_scores["boss_name"], boss_scores["percent_potential"]))
+
+        scores_lst = [boss["percent_potential"] for boss in scores["bosses"] if "percent_potential" in boss]
+
+        scores["bosses"].sort(key=lambda boss: boss_order[boss["boss_name"]])
         scores["average_performance"] = sum(scores_lst) / len(scores_lst) if len(scores_lst) != 0 else 0
         scores["elapsed_time"] = time.time() - start
         scores["player_name"] = player
 
         return scores
 
+    async def run_distinct_sims(self, simc, player, realm_slug, region, sims, iterations, target_error,
+                                sim_done=None):
+        """
+        Runs each distinct sim of a player once. Sims run one at a time, unless simc runs sims in parallel.
+        :param simc: SimulationCraft, or a remote sim runner with the same run_sim_result
+        :param sims: List of (spec, talent string, fight profile), may contain duplicates
+        :param sim_done: Optional function called with each sim once it is done
+        :return: dict of (spec, talent string, fight profile) to result of run_sim_result, False if the sim failed
+        """
+        distinct_sims = list(dict.fromkeys(sims))
+
+        def run_sim(sim):
+            spec, talent_string, fight_profile = sim
+
+            return simc.run_sim_result(player, realm_slug, region, spec, talent_string, iterations,
+                                       fight_style=fight_profile, target_error=target_error)
+
+        results = {}
+
+        if simc.parallel:
+            self.check_cancelled(player)
+
+            for sim, result in zip(distinct_sims, await asyncio.gather(*[run_sim(sim) for sim in distinct_sims])):
+                results[sim] = result
+
+                if sim_done is not None:
+                    sim_done(sim)
+        else:
+            for sim in distinct_sims:
+                # kill this simbot in the hottest loop
+                self.check_cancelled(player)
+
+                results[sim] = await run_sim(sim)
+
+                if sim_done is not None:
+                    sim_done(sim)
+
+        return results
+
+    def check_cancelled(self, player):
+        if self._cancelFlag:
+            logger.debug("Cancelled job for %s" % player)
+            raise SimCancelled("Job cancelled.")
+
+    @staticmethod
+    def sim_scores(average_dps, sim_result):
+        """
+        :param average_dps: Player's average DPS on the boss
+        :param sim_result: Result of SimulationCraft.run_sim_result
+        :return: dict of sim_dps and percent_potential, and sim_dps_error and sim_iterations if simc reported them
+        """
+        sim_scores = {
+            "sim_dps": sim_result["dps"],
+            "percent_potential": (average_dps / sim_result["dps"]) * 100
+        }
+
+        # precision simc actually reached, only known with json output
+        if "dps_error" in sim_result:
+            sim_scores["sim_dps_error"] = sim_result["dps_error"]
+            sim_scores["sim_iterations"] = sim_result["iterations"]
+
+        return sim_scores
+
+    def screening_options(self):
+        """
+        :return: dict of the two-pass options, as named in SimBotConfig, or None in one-pass mode
+        """
+        if self._screening_iterations is None:
+            return None
+
+        return {
+            "screening_iterations": self._screening_iterations,
+            "screening_threshold": self._screening_threshold,
+            "screening_margin": self._screening_margin,
+            "screening_max_error": self._screening_max_error
+        }
+
+    def set_screening_options(self, screening):
+        """
+        Switches two-pass mode for the following suites, e.g. to those of the guild run a sim worker serves.
+        :param screening: dict of the two-pass options, as returned by screening_options, None for one pass
+        """
+        if screening is None:
+            self._screening_iterations = None
+            return
+
+        self._screening_iterations = screening["screening_iterations"]
+        self._screening_threshold = screening["screening_threshold"]
+        self._screening_margin = screening["screening_margin"]
+        self._screening_max_error = screening["screening_max_error"]
+
+    def first_pass_options(self, iterations, target_error):
+        """
+        :return: (iterations, target error) of the first sim of each boss, the screening sim in two-pass mode
+        """
+        if self._screening_iterations is None:
+            return iterations, target_error
+
+        return self._screening_iterations, None
+
+    def needs_refinement(self, boss_scores):
+        """
+        Whether a screening result could land on the other side of the screening threshold, or is too imprecise.
+        :param boss_scores: Per-boss entry of sim_single_suite
+        :return: True if the boss should be simmed again with full iterations
+        """
+        if abs(boss_scores["percent_potential"] - self._screening_threshold) <= self._screening_margin:
+            return True
+
+        return "sim_dps_error" in boss_scores and \
+               boss_scores["sim_dps_error"] / boss_scores["sim_dps"] * 100 > self._screening_max_error
+
+    @staticmethod
+    def summarize_kills(stats):
+        """
+        Summarizes a player's kills of one boss. The best kill's spec and talents are what gets simmed.
+        :param stats: Non-empty list of kills from WarcraftLogs.get_all_parses
+        :return: dict of average_dps, num_fights, spec, talent_string
+        """
+        best_kill = max(stats, key=lambda kill: kill["dps"])
+        spec = best_kill["spec"].lower()
+
+        if spec == "beastmastery":
+            spec = "beast_mastery"
+
+        return {
+            "average_dps": sum(kill["dps"] for kill in stats) / len(stats),
+            "num_fights": len(stats),
+            "spec": spec,
+            "talent_string": ''.join(str(x) for x in best_kill["talents"])
+        }
+
+    def plan_suite(self, player, realm_slug, region, iterations, raiding_stats, target_error=None):
+        """
+        The sims sim_single_suite will run for a player.
+        :return: List of SimJob, one per boss with kills
+        """
+        jobs = []
+
+        for boss_name, stats in raiding_stats.items():
+            if stats:
+                kills = self.summarize_kills(stats)
+                jobs.append(SimJob(player, realm_slug, region, kills["spec"], kills["talent_string"],
+                                   self._profiles[boss_name], iterations, target_error))
+
+        return jobs
+
+    def plan_sims(self, players, all_parses):
+        """
+        Collects every sim the guild run needs.
+        :param players: DPS players, as returned by BattleNet.get_guild_members
+        :param all_parses: Parses of each player, as returned by WarcraftLogs.get_parses_for_players
+        :return: SimPlan
+        """
+        plan = SimPlan(self._sim_cpu_seconds_per_iteration)
+        # in two-pass mode only screening sims are planned, refinements depend on their results
+        iterations, target_error = self.first_pass_options(self._sim_iterations, self._sim_target_error)
+        # suites invoked whole and queued sims run where this sim cache is not
+        uses_sim_cache = self._sim_backend == "local" or \
+            (self._sim_backend in ("lambda", "workers") and self._lambda_work_unit == "sim")
+
+        for player, raiding_stats in zip(players, all_parses):
+            if not raiding_stats or isinstance(raiding_stats, WarcraftLogsError):
+                continue
+
+            for job in self.plan_suite(player["name"], self.realm_slug(player["realm"]), self._region, iterations,
+                                       raiding_stats, target_error):
+                plan.add(job, uses_sim_cache and self._simc.is_cached(job))
+
+        return plan
+
+    def plan_all_sims(self):
+        """
+        Dry run of run_all_sims. Fetches parses, but runs no sims.
+        :return: Summary of the sims run_all_sims would run, see SimPlan.summary, and the number of players
+                 whose stored suite would be reused
+        """
+        names, self._players_in_guild = self.bnet.get_guild_members(self._realm, self._guild, self._blizzard_locale,
+                                                                     self._max_level)
+
+        self.load_talent_data()
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+
+        try:
+            all_parses = loop.run_until_complete(self.fetch_guild_parses(names["DPS"]))
+
+            # profile hashes are part of the sim cache key
+            if self._character_profile_store is not None:
+                loop.run_until_complete(self.fetch_character_profiles(names["DPS"], all_parses))
+        finally:
+            loop.close()
+
+        _, reused, to_sim, _ = self.sort_players(names["DPS"], all_parses)
+
+        summary = self.plan_sims([player for player, _ in to_sim], [stats for _, stats in to_sim]).summary()
+        summary["reused_players"] = len(reused)
+
+        return summary
+
+    async def fetch_guild_parses(self, players):
+        """
+        Fetches every player's parses concurrently.
+        :param players: DPS players, as returned by BattleNet.get_guild_members
+        :return: See WarcraftLogs.get_parses_for_players
+        """
+        return await self.warcr.get_parses_for_players(
+            [(player["name"], self.realm_slug(player["realm"])) for player in players], self._region, "dps",
+            self._difficulty, int(self._num_weeks), self._warcraftlogs_concurrency)
+
+    async def fetch_character_profiles(self, players, all_parses):
+        """
+        Makes sure every player with parses has a fresh local profile, downloading missing ones concurrently,
+        and has simc sim players from their local profile. Players whose profile cannot be downloaded are
+        still imported from the armory by simc.
+        :param players: DPS players, as returned by BattleNet.get_guild_members
+        :param all_parses: Parses of each player, as returned by WarcraftLogs.get_parses_for_players
+        """
+        to_fetch = []
+
+        for player, raiding_stats in zip(players, all_parses):
+            if not raiding_stats or isinstance(raiding_stats, WarcraftLogsError):
+                continue
+
+            realm_slug = self.realm_slug(player["realm"])
+            stored = self._character_profile_store.get(self._region, realm_slug, player["name"])
+
+            if stored is None:
+                to_fetch.append((player["name"], realm_slug))
+            else:
+                self._simc.set_character_profile(player["name"], realm_slug, self._region, *stored)
+
+        if not to_fetch:
+            return
+
+        logger.info("Downloading %d character profiles", len(to_fetch))
+
+        profiles = await self.bnet.get_characters(to_fetch, self._region, self._blizzard_locale,
+                                                   self._battlenet_concurrency)
+
+        for (name, realm_slug), profile in zip(to_fetch, profiles):
+            if profile is not None:
+                stored = self._character_profile_store.put(self._region, realm_slug, name, profile)
+                self._simc.set_character_profile(name, realm_slug, self._region, *stored)
+
+    @staticmethod
+    def create_sim_cache(config):
+        """
+        Opens the persistent sim cache configured in config, if enabled.
+        :param config: SimbotConfig
+        :return: SimCache, or None if sim caching is disabled
+        """
+        if not config.params["sim_cache_ttl"]:
+            return None
+
+        return SimCache(os.path.join(get_script_path(), config.params["cache_path"], "sim_cache.db"),
+                        config.params["sim_cache_ttl"], config.params["sim_cache_max_entries"])
+
+    @staticmethod
+    def create_roster_cache(config):
+        """
+        Opens the persistent guild roster cache configured in config, if enabled.
+        :param config: SimbotConfig
+        :return: SqliteCache, or None if roster caching is disabled
+        """
+        if not config.params["roster_cache_ttl"]:
+            return None
+
+        # stale rosters are kept, so they can be revalidated instead of downloaded again
+        return SqliteCache(os.path.join(get_script_path(), config.params["cache_path"], "roster_cache.db"),
+                           "guild_rosters", max_entries=1000)
+
+    @staticmethod
+    def create_suite_cache(config):
+        """
+        Opens the persistent store of finished player suites configured in config, if enabled.
+        :param config: SimbotConfig
+        :return: SqliteCache, or None if every player is simmed on every run
+        """
+        if not config.params["suite_cache_ttl"]:
+            return None
+
+        return SqliteCache(os.path.join(get_script_path(), config.params["cache_path"], "suite_cache.db"),
+                           "player_suites", config.params["suite_cache_ttl"], max_entries=10000)
+
+    @staticmethod
+    def create_result_store(config):
+        """
+        Opens the persistent store of guild reports configured in config, if enabled.
+        :param config: SimbotConfig
+        :return: ResultStore, or None if reports are not stored
+        """
+        if not config.params["result_retention"]:
+            return None
+
+        return ResultStore(os.path.join(get_script_path(), config.params["cache_path"], "results.db"),
+                           config.params["result_retention"])
+
+    @staticmethod
+    def create_job_queue(config):
+        """
+        Opens the job queue of the queue sim backend configured in config.
+        :param config: SimbotConfig
+        :return: JobQueue
+        """
+        return JobQueue(config.params["job_queue_path"] or
+                        os.path.join(get_script_path(), config.params["cache_path"], "job_queue.db"))
+
+    @staticmethod
+    def create_talent_store(config):
+        """
+        Opens the on-disk Bnet talent data store configured in config, if enabled.
+        :param config: SimbotConfig
+        :return: TalentStore, or None if talent data is always downloaded
+        """
+        if not config.params["talent_cache_ttl"]:
+            return None
+
+        return TalentStore(os.path.join(get_script_path(), config.params["cache_path"]),
+                           config.params["talent_cache_ttl"], config.params["talent_data_version"])
+
+    @staticmethod
+    def create_character_profile_store(config):
+        """
+        Opens the on-disk character profile store configured in config, if enabled.
+        :param config: SimbotConfig
+        :return: ProfileStore, or None if simc imports characters from the armory itself
+        """
+        if not config.params["character_profile_ttl"] or SimcraftBot.get_sim_backend(config) != "local":
+            # remote sims cannot read local files
+            return None
+
+        return ProfileStore(os.path.join(get_script_path(), config.params["cache_path"], "profiles"),
+                            config.params["character_profile_ttl"])
+
+    @staticmethod
+    def get_sim_backend(config):
+        """
+        :param config: SimbotConfig
+        :return: "local", "lambda", "workers" or "queue"
+        """
+        if config.params["sim_backend"] is not None:
+            return config.params["sim_backend"]
+
+        return "local" if config.params["local_sim"] else "lambda"
+
     @staticmethod
     def realm_slug(realm):
         """
@@ -317,7 +983,17 @@ if __name__ == '__main__':
     sb = SimcraftBot(sbc)
 
     start = time.time()
-    print(json.dumps(sb.run_all_sims()))
+
+    if sbc.params["plan"]:
+        print(json.dumps(sb.plan_all_sims()))
+    else:
+        def report_player(item, guild_avg):
+            if "error" not in item:
+                logger.info("%s done, %.0f%% of potential (guild average so far %.0f%%)", item["player_name"],
+                            item["average_performance"], guild_avg)
+
+        print(json.dumps(sb.run_all_sims(report_player)))
+
     end = time.time() - start
 
     logger.info("App finished in %.2f seconds (%.2f minutes)", end, end / 60)
@@ -61,10 +61,51 @@ class SimBotConfig:
                             help='True to run sims locally, false to run sims on Lambda')
         parser.add_argument('config_path', type=str, default='/',
                             help="Path (relative to __file__) of config directory (including /config")
+        parser.add_argument('--sim_backend', type=str, default=None, nargs="?",
+                            choices=["local", "lambda", "workers", "queue"],
+                            help='Where sims run: locally, on Lambda, on the HTTP sim workers listed in urls.json, or '
+                                 'on a durable job queue served by "python -m src.job_queue worker" processes. '
+                                 'Defaults to local or lambda, following local_sim.')
+        parser.add_argument('--job_queue_path', type=str, default=None, nargs="?",
+                            help='Job queue database of the queue sim backend. Defaults to job_queue.db in cache_path.')
         parser.add_argument('--simcraft_timeout', type=int, default=5, nargs="?",
                             help='Timeout, in seconds, of each individual simulation.')
         parser.add_argument('--simcraft_iterations', type=int, default=100, nargs="?",
                             help='Simcraft iterations')
+        parser.add_argument('--sim_target_error', type=float, default=None, nargs="?",
+                            help='DPS error, in percent of DPS, each sim runs until. simcraft_iterations then only '
+                                 'caps the iterations of a sim.')
+        parser.add_argument('--screening_iterations', type=int, default=None, nargs="?",
+                            help='Two-pass mode: iterations of the screening sim every boss gets first. Only sims near '
+                                 'the screening threshold, or too imprecise, are simmed again with full iterations.')
+        parser.add_argument('--screening_threshold', type=float, default=80, nargs="?",
+                            help='Percent of potential the two-pass mode decides on')
+        parser.add_argument('--screening_margin', type=float, default=10, nargs="?",
+                            help='Screening results within this many percent of potential of the threshold are refined')
+        parser.add_argument('--screening_max_error', type=float, default=1.0, nargs="?",
+                            help='Screening results with a larger DPS error, in percent of DPS, are refined')
+        parser.add_argument('--max_concurrent_sims', type=int, default=None, nargs="?",
+                            help='Maximum simc processes to run at once locally. Defaults to the number of CPUs.')
+        parser.add_argument('--sim_cpu_seconds_per_iteration', type=float, default=0.0013, nargs="?",
+                            help='CPU seconds of one Patchwerk iteration, used to estimate the cost of a run')
+        parser.add_argument('--plan', action='store_true',
+                            help='Print the sims a run would need and their estimated cost, without running them')
+        parser.add_argument('--simc_batch_size', type=int, default=1, nargs="?",
+                            help='Maximum sims to pack into one simc process. 1 runs every sim in its own process.')
+        parser.add_argument('--simc_output_format', type=str, default="json", nargs="?", choices=["json", "text"],
+                            help='Read sim results from a simc json2 report, or scrape them from the text report')
+        parser.add_argument('--warcraftlogs_concurrency', type=int, default=8, nargs="?",
+                            help='Maximum WarcraftLogs requests in flight at once')
+        parser.add_argument('--battlenet_concurrency', type=int, default=8, nargs="?",
+                            help='Maximum Battle.net character requests in flight at once')
+        parser.add_argument('--lambda_max_concurrency', type=int, default=100, nargs="?",
+                            help='Most Lambda invocations in flight at once. Throttling lowers it temporarily.')
+        parser.add_argument('--lambda_timeout', type=int, default=300, nargs="?",
+                            help='Seconds a Lambda invocation may take before it is retried')
+        parser.add_argument('--lambda_max_retries', type=int, default=3, nargs="?",
+                            help='Retries of a throttled, failed or timed out Lambda invocation')
+        parser.add_argument('--lambda_work_unit', type=str, default="sim", nargs="?", choices=["suite", "sim"],
+                            help='Run a whole sim suite per Lambda invocation, or a single sim')
         parser.add_argument('--region', type=str, default="US", nargs="?", choices=["US", "EU", "KR", "TW", "CN"],
                             help='Region where guild exists.')
         parser.add_argument('--raid_difficulty', type=str, default="heroic", nargs="?",
@@ -83,6 +124,29 @@ class SimBotConfig:
                             help="Save logs in separate files, or overwrite single file.")
         parser.add_argument('--log_path', type=str, default="../logs", nargs='?',
                             help="Path (relative to __file__) to save logs to (excluding /<filename>.log)")
+        parser.add_argument('--cache_path', type=str, default="../cache", nargs='?',
+                            help="Path (relative to __file__) of the directory holding persistent caches")
+        parser.add_argument('--sim_cache_ttl', type=int, default=12 * 3600, nargs='?',
+                            help="Seconds to reuse a sim result for. 0 disables the sim cache.")
+        parser.add_argument('--sim_cache_max_entries', type=int, default=10000, nargs='?',
+                            help="Maximum sim results to keep in the sim cache")
+        parser.add_argument('--roster_cache_ttl', type=int, default=6 * 3600, nargs='?',
+                            help="Seconds to use a cached guild roster before checking it for changes. "
+                                 "0 disables the roster cache.")
+        parser.add_argument('--talent_cache_ttl', type=int, default=7 * 24 * 3600, nargs='?',
+                            help="Seconds to use stored Battle.net talent data before downloading it again. "
+                                 "0 always downloads it.")
+        parser.add_argument('--character_profile_ttl', type=int, default=3600, nargs='?',
+                            help="Seconds to sim a character from its stored Battle.net profile before downloading "
+                                 "it again. 0 has simc import characters from the armory.")
+        parser.add_argument('--suite_cache_ttl', type=int, default=7 * 24 * 3600, nargs='?',
+                            help="Seconds to reuse a player's finished suite while their kills, profile and the sim "
+                                 "settings are unchanged. 0 sims every player on every run.")
+        parser.add_argument('--result_retention', type=int, default=30 * 24 * 3600, nargs='?',
+                            help="Seconds to keep the reports of finished guild runs in results.db in cache_path. "
+                                 "0 does not store reports.")
+        parser.add_argument('--talent_data_version', type=str, default=None, nargs='?',
+                            help="Game patch of the talent data, e.g. 7.3.5. Changing it downloads talents again.")
 
         self.params = vars(parser.parse_args())
 
@@ -91,7 +155,16 @@ class SimBotConfig:
     def init_args(self, guildname, realm, simc_location, local_sim=True, config_path="", simc_timeout=5, simc_iter=100,
                   region="US",
                   raid_difficulty="heroic", blizzard_locale="en_US", max_level=110, weeks_to_examine=3,
-                  persist_logs=False, log_path="../logs", write_logs=True):
+                  persist_logs=False, log_path="../logs", write_logs=True, max_concurrent_sims=None,
+                  cache_path="../cache", sim_cache_ttl=12 * 3600, sim_cache_max_entries=10000,
+                  warcraftlogs_concurrency=8, roster_cache_ttl=6 * 3600, talent_cache_ttl=7 * 24 * 3600,
+                  talent_data_version=None, simc_batch_size=1, sim_cpu_seconds_per_iteration=0.0013, plan=False,
+                  simc_output_format="json", sim_target_error=None,
+                  screening_iterations=None, screening_threshold=80, screening_margin=10, screening_max_error=1.0,
+                  character_profile_ttl=3600, battlenet_concurrency=8, suite_cache_ttl=7 * 24 * 3600,
+                  lambda_max_concurrency=100, lambda_timeout=300, lambda_max_retries=3,
+                  lambda_work_unit="sim", sim_backend=None,
+                  job_queue_path=None, result_retention=30 * 24 * 3600):
         """
 
         :param guildname: The guild name to run sims for (in quotes)
@@ -109,12 +182,47 @@ class SimBotConfig:
         :param persist_logs: Save logs in separate files, or overwrite single file.
         :param log_path: Path (relative to __file__) to save logs to (excluding /<filename>.log)
         :param write_logs: Save logs to file
+        :param max_concurrent_sims: Maximum simc processes to run at once locally. Defaults to the number of CPUs.
+        :param cache_path: Path (relative to __file__) of the directory holding persistent caches
+        :param sim_cache_ttl: Seconds to reuse a sim result for. 0 disables the sim cache.
+        :param sim_cache_max_entries: Maximum sim results to keep in the sim cache
+        :param warcraftlogs_concurrency: Maximum WarcraftLogs requests in flight at once
+        :param roster_cache_ttl: Seconds to use a cached guild roster before checking it for changes. 0 disables.
+        :param talent_cache_ttl: Seconds to use stored Battle.net talent data before downloading it again. 0 disables.
+        :param talent_data_version: Game patch of the talent data. Changing it downloads talents again.
+        :param simc_batch_size: Maximum sims to pack into one simc process. 1 runs every sim in its own process.
+        :param sim_cpu_seconds_per_iteration: CPU seconds of one Patchwerk iteration, to estimate the cost of a run
+        :param plan: Only report the sims a run would need and their estimated cost
+        :param simc_output_format: "json" reads sim results from a simc json2 report, "text" from the text report
+        :param sim_target_error: DPS error, in percent of DPS, each sim runs until. simc_iter then caps iterations.
+        :param screening_iterations: Two-pass mode: iterations of the screening sim every boss gets first.
+                                     None sims every boss once with simc_iter.
+        :param screening_threshold: Percent of potential the two-pass mode decides on
+        :param screening_margin: Screening results within this many percent of potential of the threshold are refined
+        :param screening_max_error: Screening results with a larger DPS error, in percent of DPS, are refined
+        :param character_profile_ttl: Seconds to sim a character from its stored Battle.net profile before
+                                      downloading it again. 0 has simc import characters from the armory.
+        :param battlenet_concurrency: Maximum Battle.net character requests in flight at once
+        :param lambda_max_concurrency: Most Lambda invocations in flight at once. Throttling lowers it temporarily.
+        :param lambda_timeout: Seconds a Lambda invocation may take before it is retried
+        :param lambda_max_retries: Retries of a throttled, failed or timed out Lambda invocation
+        :param lambda_work_unit: "suite" to run a player's sims in one Lambda invocation, "sim" to run each sim in its
+                                 own invocation. Also applies to HTTP sim workers.
+        :param sim_backend: "local", "lambda", "workers" (HTTP sim workers listed in urls.json) or "queue" (durable job
+                            queue, see src.job_queue). None follows local_sim.
+        :param job_queue_path: Job queue database of the queue sim backend, None for job_queue.db in cache_path
+        :param suite_cache_ttl: Seconds to reuse a player's finished suite while their kills, profile and the sim
+                                settings are unchanged. 0 sims every player on every run.
+        :param result_retention: Seconds to keep the reports of finished guild runs in results.db in cache_path.
+                                 0 does not store reports.
         """
 
         self.params["guildname"] = guildname
         self.params["realm"] = realm
         self.params["simc_location"] = simc_location
         self.params["local_sim"] = local_sim
+        self.params["sim_backend"] = sim_backend
+        self.params["job_queue_path"] = job_queue_path
         self.params["simcraft_timeout"] = simc_timeout
         self.params["simcraft_iterations"] = simc_iter
         self.params["region"] = region
@@ -126,5 +234,30 @@ class SimBotConfig:
         self.params["log_path"] = log_path
         self.params["config_path"] = config_path
         self.params["write_logs"] = write_logs
+        self.params["max_concurrent_sims"] = max_concurrent_sims
+        self.params["cache_path"] = cache_path
+        self.params["sim_cache_ttl"] = sim_cache_ttl
+        self.params["sim_cache_max_entries"] = sim_cache_max_entries
+        self.params["warcraftlogs_concurrency"] = warcraftlogs_concurrency
+        self.params["roster_cache_ttl"] = roster_cache_ttl
+        self.params["talent_cache_ttl"] = talent_cache_ttl
+        self.params["talent_data_version"] = talent_data_version
+        self.params["simc_batch_size"] = simc_batch_size
+        self.params["sim_cpu_seconds_per_iteration"] = sim_cpu_seconds_per_iteration
+        self.params["plan"] = plan
+        self.params["simc_output_format"] = simc_output_format
+        self.params["sim_target_error"] = sim_target_error
+        self.params["screening_iterations"] = screening_iterations
+        self.params["screening_threshold"] = screening_threshold
+        self.params["screening_margin"] = screening_margin
+        self.params["screening_max_error"] = screening_max_error
+        self.params["character_profile_ttl"] = character_profile_ttl
+        self.params["battlenet_concurrency"] = battlenet_concurrency
+        self.params["suite_cache_ttl"] = suite_cache_ttl
+        self.params["result_retention"] = result_retention
+        self.params["lambda_max_concurrency"] = lambda_max_concurrency
+        self.params["lambda_timeout"] = lambda_timeout
+        self.params["lambda_max_retries"] = lambda_max_retries
+        self.params["lambda_work_unit"] = lambda_work_unit
 
         self.init_logger(persist_logs, log_path, write_logs)
\ No newline at end of file
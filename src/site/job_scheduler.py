@@ -0,0 +1,498 @@
+import heapq
+import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+from multiprocessing.connection import wait
+
+from src.api import ReportableError
+from src.simbot import SimcraftBot
+
+logger = logging.getLogger("SimBot")
+
+
+class JobRejected(ReportableError):
+    pass
+
+
+class JobMessages:
+    def __init__(self, conn):
+        """
+        Sends a job's messages to the scheduler, from any thread of the job's process.
+        Every job has a pipe of its own, so a job killed halfway through a message only cuts its own pipe short.
+        :param conn: Sending end of the job's pipe
+        """
+        self._conn = conn
+        self._lock = threading.Lock()
+
+    def put(self, message):
+        with self._lock:
+            self._conn.send(message)
+
+
+class JobEvents:
+    def __init__(self, job_id, messages):
+        """
+        Stands in for SimcraftBot.event_queue in a job's process, tagging the job's progress events with its ID.
+        :param job_id:
+        :param messages: JobMessages of the job
+        """
+        self._job_id = job_id
+        self._messages = messages
+
+    def put(self, message):
+        self._messages.put((self._job_id, "event", message))
+
+
+def run_job(job_id, config, share, cancel_event, messages):
+    """
+    Runs a guild sim in its job's process.
+    :param job_id:
+    :param config: SimBotConfig of the guild sim
+    :param share: multiprocessing.Value with the number of sims the job may run at once right now
+    :param cancel_event: multiprocessing.Event set when the job is cancelled, which stops its sims right away
+    :param messages: JobMessages the job's progress events, then its result or error, are put on, as
+                     (job ID, "event", event), (job ID, "result", result) or (job ID, "error", (message, reportable))
+    """
+    if hasattr(os, "setpgrp"):
+        # the job's simc processes join its process group, so a job that is killed takes its sims with it
+        os.setpgrp()
+        signal.signal(signal.SIGTERM, lambda signum, frame: os.killpg(0, signal.SIGKILL))
+
+    sb = SimcraftBot(config)
+    sb.event_queue = JobEvents(job_id, messages)
+    sb.concurrency_limit = lambda: share.value
+
+    def cancel_on_event():
+        cancel_event.wait()
+        sb.cancel_sim()
+
+    threading.Thread(target=cancel_on_event, daemon=True).start()
+
+    try:
+        messages.put((job_id, "result", sb.run_all_sims()))
+    except ReportableError as e:
+        messages.put((job_id, "error", (str(e), True)))
+    except Exception as e:
+        logger.exception(e)
+        messages.put((job_id, "error", (str(e), False)))
+
+
+def run_job_process(target, job_id, config, share, cancel_event, conn):
+    """
+    Entry point of a job's process, running target with run_job's arguments.
+    :param conn: Sending end of the job's pipe to the scheduler
+    """
+    target(job_id, config, share, cancel_event, JobMessages(conn))
+
+
+class SchedulerJob:
+    def __init__(self, job_id, config, priority, sequence, context=multiprocessing):
+        """
+        A guild sim submitted to a JobScheduler. Its result is available once ready.
+        :param context: multiprocessing context the job's process is started from
+        """
+        self.job_id = job_id
+        self.config = config
+        self.priority = priority
+        self.sequence = sequence
+
+        self.share = context.Value('i', 1)
+        self.cancel_event = context.Event()
+
+        # None until the starter thread started it
+        self.process = None
+        # receiving end of the pipe the job's process sends its messages on
+        self.reader = None
+
+        # e.g. client IDs of everyone waiting for this job, see JobScheduler.subscribe. Replaced, never changed, so
+        # it can be read without the scheduler's lock.
+        self.subscribers = frozenset()
+        # progress events sent so far, replayed to subscribers that join late
+        self.events = []
+
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+
+    def ready(self):
+        return self._done.is_set()
+
+    def get(self, timeout=None):
+        """
+        :param timeout: Seconds to wait for the job to end, None to wait as long as it takes
+        :return: Result of SimcraftBot.run_all_sims
+        """
+        if not self._done.wait(timeout):
+            raise TimeoutError("Job %s is not done" % self.job_id)
+
+        if self._error is not None:
+            raise self._error
+
+        return self._result
+
+    def finish(self, result=None, error=None):
+        self._result = result
+        self._error = error
+        self._done.set()
+
+
+class JobScheduler:
+    # seconds a cancelled job has to stop its sims, before it is killed with them
+    CANCEL_GRACE_SEC = 1
+
+    def __init__(self, simc_budget=None, max_running_jobs=None, max_queued_jobs=10, on_event=None, on_done=None,
+                 target=run_job):
+        """
+        Runs guild sims in their own processes, sharing a budget of simc processes between the running jobs.
+        Every running job gets an equal share of the budget, rebalanced as jobs start and end. Jobs beyond
+        max_running_jobs wait in priority order, and jobs beyond max_queued_jobs are rejected.
+
+        Job processes are spawned rather than forked, as the site forking while its other threads hold locks
+        would leave those locks held for good in the job, and a starter thread starts them outside the scheduler's
+        lock. Each job reports on a pipe of its own. A monitor thread moves messages from the pipes to one queue,
+        drained by a single dispatcher thread that calls on_event and on_done as soon as a message arrives, in the
+        order each job sent them.
+        :param simc_budget: simc processes all jobs together may run at once, defaults to the number of CPUs
+        :param max_running_jobs: Jobs running at once, defaults to, and at most, simc_budget
+        :param max_queued_jobs: Jobs waiting to run, more are rejected
+        :param on_event: Optional function called with a job, each of its progress events, including its queue
+                         position while it waits, and the job's subscribers when the event was sent
+        :param on_done: Optional function called with a job once its result or error is available
+        :param target: Function each job's process runs, with run_job's arguments
+        """
+        self.simc_budget = simc_budget or os.cpu_count() or 1
+        self.max_running_jobs = min(max_running_jobs or self.simc_budget, self.simc_budget)
+        self.max_queued_jobs = max_queued_jobs
+
+        self._on_event = on_event
+        self._on_done = on_done
+        self._target = target
+        self._context = multiprocessing.get_context("spawn")
+
+        self._lock = threading.Lock()
+        # heap of (priority, sequence number, job)
+        self._waiting = []
+        # job ID to job, for jobs whose process is running, or about to be started
+        self._running = {}
+        # jobs in _running the starter thread has yet to start
+        self._starting = queue.Queue()
+        # job ID to job, for jobs submitted and not yet reported done
+        self._jobs = {}
+        self._sequence = itertools.count()
+
+        # messages of all jobs, see run_job, plus (job ID, "exit", None) once a job's process ended
+        self._messages = queue.Queue()
+
+        # wakes the monitor thread up when a job's process started
+        self._wakeup_reader, self._wakeup_writer = self._context.Pipe(duplex=False)
+
+        threading.Thread(target=self._start_processes, daemon=True).start()
+        threading.Thread(target=self._dispatch_messages, daemon=True).start()
+        threading.Thread(target=self._monitor_processes, daemon=True).start()
+
+    def submit(self, job_id, config, priority=0):
+        """
+        Runs a guild sim as soon as the budget allows.
+        :param job_id:
+        :param config: SimBotConfig of the guild sim
+        :param priority: Lower values are started first
+        :return: SchedulerJob
+        :raises JobRejected: if too many jobs are waiting
+        """
+        with self._lock:
+            return self._submit(job_id, config, priority)
+
+    def _submit(self, job_id, config, priority):
+        """
+        Called holding the lock.
+        """
+        if len(self._waiting) >= self.max_queued_jobs and len(self._running) >= self.max_running_jobs:
+            logger.warning("Rejected job %s, %d jobs running and %d waiting", job_id, len(self._running),
+                           len(self._waiting))
+            raise JobRejected("Too many guild sims are running right now, try again in a few minutes.")
+
+        job = SchedulerJob(job_id, config, priority, next(self._sequence), self._context)
+        heapq.heappush(self._waiting, (priority, job.sequence, job))
+        self._jobs[job_id] = job
+
+        self._schedule()
+
+        return job
+
+    def subscribe(self, job_id, config, subscriber, priority=0):
+        """
+        Attaches a subscriber to the job with this ID, submitting the job unless it is already waiting or running,
+        so identical requests share one job. A job is only cancelled once its last subscriber leaves.
+        :param job_id: Identifies the job's work, e.g. the guild and settings it sims
+        :param config: SimBotConfig of the guild sim, unused if the job is already submitted
+        :param subscriber: e.g. the ID of a client waiting for the result
+        :param priority: Lower values are started first
+        :return: (SchedulerJob, progress events the job sent before the subscriber joined)
+        :raises JobRejected: if the job has to be submitted and too many jobs are waiting, or the job is being
+                             cancelled
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+
+            if job is None:
+                job = self._submit(job_id, config, priority)
+            elif job.cancel_event.is_set():
+                raise JobRejected("This guild sim was just cancelled, try again in a moment.")
+            else:
+                logger.info("Subscriber %s joined job %s, %d subscribers", subscriber, job_id,
+                            len(job.subscribers) + 1)
+
+            job.subscribers = job.subscribers | {subscriber}
+
+            return job, list(job.events)
+
+    def unsubscribe(self, job_id, subscriber):
+        """
+        Detaches a subscriber from a job, cancelling the job if no subscribers are left.
+        :return: True if the subscriber was attached to the job
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+
+            if job is None or subscriber not in job.subscribers:
+                return False
+
+            job.subscribers = job.subscribers - {subscriber}
+
+            if not job.subscribers:
+                self._cancel(job_id)
+
+            return True
+
+    def position(self, job):
+        """
+        :return: 0 if the job is running or done, otherwise its place among the waiting jobs, starting at 1
+        """
+        with self._lock:
+            waiting = [waiting_job for _, _, waiting_job in sorted(self._waiting)]
+
+        return waiting.index(job) + 1 if job in waiting else 0
+
+    def cancel(self, job_id):
+        """
+        Cancels a waiting job, or stops a running job and its sims, giving its share of the budget to the other jobs.
+        :return: True if the job was found
+        """
+        with self._lock:
+            return self._cancel(job_id)
+
+    def _cancel(self, job_id):
+        """
+        Called holding the lock.
+        """
+        if job_id in self._running:
+            job = self._running[job_id]
+            job.cancel_event.set()
+
+            timer = threading.Timer(self.CANCEL_GRACE_SEC, self._kill, args=(job,))
+            timer.daemon = True
+            timer.start()
+
+            return True
+
+        for i, (_, _, job) in enumerate(self._waiting):
+            if job.job_id == job_id:
+                del self._waiting[i]
+                heapq.heapify(self._waiting)
+
+                job.cancel_event.set()
+                self._messages.put((job_id, "error", ("Job cancelled.", True)))
+                self._schedule()
+
+                return True
+
+        return False
+
+    def _kill(self, job):
+        """
+        Kills a cancelled job that did not stop by itself, with the sims it started.
+        """
+        if job.process is None:
+            # not started yet, it sees it is cancelled once it is
+            timer = threading.Timer(self.CANCEL_GRACE_SEC, self._kill, args=(job,))
+            timer.daemon = True
+            timer.start()
+
+            return
+
+        if not job.process.is_alive():
+            return
+
+        logger.warning("Job %s did not stop within %d sec of being cancelled, killing it", job.job_id,
+                       self.CANCEL_GRACE_SEC)
+
+        try:
+            os.killpg(job.process.pid, signal.SIGKILL)
+        except (AttributeError, OSError):
+            # no process groups on this platform, or the job did not start its own
+            job.process.kill()
+
+    def status(self):
+        with self._lock:
+            return {
+                "running": {job_id: job.share.value for job_id, job in self._running.items()},
+                "waiting": len(self._waiting),
+                "simc_budget": self.simc_budget
+            }
+
+    def _schedule(self):
+        """
+        Hands waiting jobs the budget allows to the starter thread, then rebalances shares. Called holding the lock.
+        """
+        while self._waiting and len(self._running) < self.max_running_jobs:
+            _, _, job = heapq.heappop(self._waiting)
+
+            self._running[job.job_id] = job
+            self._starting.put(job)
+
+            logger.info("Starting job %s, %d jobs running and %d waiting", job.job_id, len(self._running),
+                        len(self._waiting))
+
+        if self._running:
+            # budget split evenly, jobs first in line get the remainder
+            running = sorted(self._running.values(), key=lambda running_job: (running_job.priority,
+                                                                              running_job.sequence))
+            share, remainder = divmod(self.simc_budget, len(running))
+
+            for i, job in enumerate(running):
+                job.share.value = share + (1 if i < remainder else 0)
+
+        for position, (_, _, job) in enumerate(sorted(self._waiting)):
+            self._messages.put((job.job_id, "event", {"queued": True, "position": position + 1}))
+
+    def _start_processes(self):
+        """
+        Starts the process of each job _schedule hands over, without holding the lock, as starting one takes a while.
+        """
+        while True:
+            job = self._starting.get()
+            reader, writer = self._context.Pipe(duplex=False)
+
+            try:
+                process = self._context.Process(target=run_job_process, daemon=True,
+                                                args=(self._target, job.job_id, job.config, job.share,
+                                                      job.cancel_event, writer))
+                process.start()
+            except Exception as e:
+                logger.exception(e)
+                reader.close()
+
+                with self._lock:
+                    del self._running[job.job_id]
+                    self._messages.put((job.job_id, "error", (str(e), False)))
+                    self._schedule()
+
+                continue
+            finally:
+                # only the job holds the sending end, so the pipe ends when the job does
+                writer.close()
+
+            with self._lock:
+                job.reader = reader
+                job.process = process
+                self._wakeup_writer.send(None)
+
+    def _receive(self, job, until_closed=False):
+        """
+        Moves messages of a job from its pipe to the dispatcher.
+        :param until_closed: Read until the pipe ends, once the job's process ended, rather than one message
+        """
+        try:
+            while not job.reader.closed and job.reader.poll():
+                self._messages.put(job.reader.recv())
+
+                if not until_closed:
+                    return
+        except EOFError:
+            # the job ended, maybe killed halfway through a message
+            pass
+        except Exception as e:
+            logger.exception(e)
+
+        if until_closed:
+            job.reader.close()
+
+    def _monitor_processes(self):
+        """
+        Moves each job's messages to the dispatcher, and reports its process ending, after everything it sent.
+        """
+        while True:
+            with self._lock:
+                # jobs still starting are waited for once the starter thread wakes this thread up
+                started = [job for job in self._running.values() if job.process is not None]
+                sentinels = {job.process.sentinel: job for job in started}
+                readers = {job.reader: job for job in started}
+
+            for ready in wait(list(sentinels) + list(readers) + [self._wakeup_reader]):
+                if ready is self._wakeup_reader:
+                    ready.recv()
+                    continue
+
+                if ready in readers:
+                    self._receive(readers[ready])
+                    continue
+
+                job = sentinels[ready]
+                job.process.join()
+                self._receive(job, until_closed=True)
+
+                with self._lock:
+                    del self._running[job.job_id]
+                    # everything the job sent was read off its pipe above, so this comes after it
+                    self._messages.put((job.job_id, "exit", None))
+
+                    logger.info("Job %s ended, %d jobs running and %d waiting", job.job_id, len(self._running),
+                                len(self._waiting))
+
+                    self._schedule()
+
+    def _dispatch_messages(self):
+        while True:
+            job_id, kind, payload = self._messages.get()
+
+            with self._lock:
+                job = self._jobs.get(job_id)
+
+                if job is None:
+                    # already reported done
+                    continue
+
+                if kind != "event":
+                    del self._jobs[job_id]
+                elif not payload.get("queued"):
+                    # subscribers joining from now on get this event from subscribe, not from on_event
+                    job.events.append(payload)
+
+                subscribers = job.subscribers
+
+            try:
+                if kind == "event":
+                    if self._on_event is not None:
+                        self._on_event(job, payload, subscribers)
+                    continue
+
+                if kind == "result":
+                    job.finish(result=payload)
+                elif kind == "error":
+                    message, reportable = payload
+                    job.finish(error=ReportableError(message) if reportable else RuntimeError(message))
+                elif job.cancel_event.is_set():
+                    # process ended without a result
+                    job.finish(error=ReportableError("Job cancelled."))
+                else:
+                    job.finish(error=RuntimeError("Sim job stopped unexpectedly."))
+
+                if self._on_done is not None:
+                    self._on_done(job)
+            except Exception as e:
+                # a failing callback must not stop other jobs' messages
+                logger.exception(e)
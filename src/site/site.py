@@ -1,7 +1,3 @@
-import threading
-
-import time
-
 from flask import json, jsonify
 
 from flask import Flask
@@ -9,11 +5,13 @@ from flask import render_template, request
 from flask_socketio import SocketIO
 
 from src.api import ReportableError
-from src.simbot import SimBotConfig, SimcraftBot
-
-from multiprocessing.pool import ThreadPool
+from src.cache.result_store import ResultStore
+from src.simbot import SimBotConfig
+from src.simbot_config import get_script_path
+from src.site.job_scheduler import JobRejected, JobScheduler
 
 import logging
+import os
 
 # import eventlet
 # eventlet.monkey_patch()
@@ -40,25 +38,25 @@ sockets = {}
 client_socket = {}
 # socket ID to client ID
 socket_client = {}
-# reference to SimcraftBot objects
+# client ID to the SchedulerJob it subscribed to, clients asking for the same guild sim share its job
 all_running_jobs = {}
 
 with open('simbot_params.json', 'r') as f:
     saved_params = json.loads(f.read())
 
 
-# thread target
-def check_sim_status(queue, client_id):
+# scheduler callback, called on its dispatcher thread
+def report_job_event(job, message, subscribers):
     with app.test_request_context():
-        while True:
-            # print("Eventlet thread started")
-            message = queue.get()
-            print("MESSAGE IN SITE: " + str(message))
-            # with app.app_context():
-            #     socketio.emit("progressbar", json.dumps(message))
-            # send message to correct client
-            client_socket[client_id].emit("progressbar", message)
-            queue.task_done()
+        print("MESSAGE IN SITE: " + str(message))
+        # with app.app_context():
+        #     socketio.emit("progressbar", json.dumps(message))
+        # send message to every client waiting for the job
+        for client_id in subscribers:
+            sock = client_socket.get(client_id)
+
+            if sock is not None:
+                sock.emit("progressbar", message)
 
 
 # def report_sim_update(message):
@@ -67,77 +65,102 @@ def check_sim_status(queue, client_id):
 #         socketio.emit("progressbar", json.dumps(message))
 
 
-# thread to check task progress.
-# cycle through all running tasks, query their status
-# if ready, send a socketio message to that client, along with the data
-def check_task_progress():
-    logger.debug("Task progress thread started")
+# scheduler callback, called on its dispatcher thread as soon as a job's result or error is available
+# send a socketio message to every client waiting for the job, along with the data
+def report_job_result(job):
+    try:
+        result = job.get()
+
+        response = {
+            "status": "success",
+            "message": "Sim complete",
+            "data": result  # result is a dict
+        }
+    except Exception as e:
+        if isinstance(e, ReportableError):
+            # These exceptions have user-friendly messages
+            msg = str(e)
+        else:
+            msg = "Error while processing sim."
+        logger.exception(e)
+        response = {
+            "status": "error",
+            "message": msg
+        }
 
     with app.test_request_context():
-        while True:
-            for client_id, (task, simbot_obj) in list(all_running_jobs.items()):
-                # ############ DEBUG #############
-                with open("simbot_output.json", 'r') as f:
-                    result = json.loads(f.read())
-
-                sock = client_socket[client_id]
-                sock.emit("guild-result", {
-                    "status": "success",
-                    "message": "Sim complete",
-                    "data": result  # result is a dict
-                })
-
+        for client_id in job.subscribers:
+            # job is done, or dead now. clients that cancelled are already removed
+            if all_running_jobs.get(client_id) is job:
                 del all_running_jobs[client_id]
 
-                continue
-                # ############ END DEBUG #############
+            sock = client_socket.get(client_id)
 
+            if sock is not None:
+                sock.emit("guild-result", response)
 
-                if task.ready():
-                    sock = client_socket[client_id]
 
-                    try:
-                        result = task.get()
+@app.route("/")
+def main():
+    return render_template("main.html")
 
-                        sock.emit("guild-result", {
-                            "status": "success",
-                            "message": "Sim complete",
-                            "data": result  # result is a dict
-                        })
 
-                        # task is done
-                        del all_running_jobs[client_id]
-                    except Exception as e:
-                        if isinstance(e, ReportableError):
-                            # These exceptions have user-friendly messages
-                            msg = str(e)
-                        else:
-                            msg = "Error while processing sim."
-                        logger.exception(e)
-                        sock.emit("guild-result", {
-                            "status": "error",
-                            "message": msg
-                        })
+# reports of finished guild sims, written by the job processes
+result_retention = saved_params.get("result_retention", 30 * 24 * 3600)
+result_store = ResultStore(os.path.join(get_script_path(), saved_params.get("cache_path", "../cache"), "results.db"),
+                           result_retention) if result_retention else None
 
-                        # task is dead now
-                        del all_running_jobs[client_id]
-            # can tune this for faster response
-            time.sleep(0.1)
 
+@app.route("/results/<region>/<realm>/<guild>", methods=["GET"])
+def guild_results(region=None, realm=None, guild=None):
+    # latest stored report, so dashboards don't need to sim the guild again
+    stored = None
 
-@app.route("/")
-def main():
-    return render_template("main.html")
+    if result_store is not None:
+        stored = result_store.latest(region, realm, guild, request.args.get("difficulty"),
+                                     request.args.get("weeks", type=int))
+
+    if stored is None:
+        response = jsonify({
+            "status": "error",
+            "message": "No results stored for this guild."
+        })
+        response.status_code = 404
+
+        return response
+
+    if stored["etag"] in request.if_none_match:
+        # client already has this report
+        response = app.response_class(status=304)
+    else:
+        response = jsonify({
+            "status": "success",
+            "message": "Stored results",
+            "started": stored["started"],
+            "finished": stored["finished"],
+            "params": stored["params"],
+            "data": stored["report"]
+        })
+
+    response.set_etag(stored["etag"])
+    # clients revalidate every time, a new run changes the report
+    response.cache_control.no_cache = True
 
+    return response
 
-pool = ThreadPool(processes=1)
+
+# guild sims run in their own processes, sharing the machine's simc budget. Job processes are spawned, so they import
+# this module again as __mp_main__, and have no use for a scheduler of their own.
+scheduler = JobScheduler(saved_params.get("simc_budget"), saved_params.get("max_running_jobs"),
+                         saved_params.get("max_queued_jobs", 10), report_job_event, report_job_result) \
+    if __name__ != "__mp_main__" else None
 
 
 @app.route("/all_sims/", methods=["POST"])
 def all_sims():
-    job_id = request.form.get('jobID')
+    client_id = request.form.get('jobID')
 
-    if job_id in all_running_jobs:
+    if client_id in all_running_jobs:
         return jsonify({
             "status": "error",
             "message": "Job already started."
@@ -150,26 +173,39 @@ def all_sims():
     realm = request.form.get('realm')
 
     sbc = SimBotConfig()
-    sbc.init_args(guild, realm, saved_params["simc_location"], saved_params["config_path"],
-                  saved_params["simc_timeout"], region, difficulty, weeks_to_examine=weeks,
-                  log_path=saved_params["log_path"])
+    sbc.init_args(guild, realm, saved_params["simc_location"], config_path=saved_params["config_path"],
+                  simc_timeout=saved_params["simc_timeout"], region=region, raid_difficulty=difficulty,
+                  weeks_to_examine=weeks, log_path=saved_params["log_path"],
+                  cache_path=saved_params.get("cache_path", "../cache"), result_retention=result_retention)
 
-    sb = SimcraftBot(sbc)
+    # identical guild sims share one job
+    job_id = json.dumps(ResultStore.guild_key(region, realm, guild) + (difficulty, weeks))
 
-    # TODO multiple jobs
+    try:
+        job, events = scheduler.subscribe(job_id, sbc, client_id)
+    except JobRejected as e:
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        })
+
+    all_running_jobs[client_id] = job
 
-    threading.Thread(target=check_sim_status, args=(sb.event_queue, job_id), daemon=True).start()
+    if job.ready():
+        # finished meanwhile, the client was sent the result already
+        all_running_jobs.pop(client_id, None)
 
-    # TODO return from this immediately, but keep the result going, send it back later
-    async_result = pool.apply_async(sb.run_all_sims)
-    all_running_jobs[job_id] = (async_result, sb)
+    # catch up on the progress of a job other clients started
+    if events and client_id in client_socket:
+        for event in events:
+            client_socket[client_id].emit("progressbar", event)
 
-    logger.debug("Queued task for client %s", job_id)
-    # result = sb.run_all_sims()
+    logger.debug("Client %s subscribed to job %s", client_id, job_id)
 
     return jsonify({
         "status": "success",
-        "message": "Task queued,"
+        "message": "Task queued,",
+        "position": scheduler.position(job)
     })
 
 
@@ -186,11 +222,8 @@ def cancel_job(job_id=None):
             "message": "Job to delete not found"
         })
 
-    job, simbot_obj = all_running_jobs[job_id]
-
-    # cause sim to stop at next opportunity
-    simbot_obj.cancel_sim()
-    del all_running_jobs[job_id]
+    # stops the sim and its simc processes, unless other clients wait for it
+    scheduler.unsubscribe(all_running_jobs.pop(job_id).job_id, job_id)
 
     print("Cancel complete of job %s" % job_id)
 
@@ -208,13 +241,21 @@ def client_connected():
 
 @socketio.on('disconnect')
 def client_disconnected():
-    # cancel the job associated with this client
+    # leave the job associated with this client, killing its sims if no other client waits for it
     # there will only ever be one job per client
     print("Client disconnected")
-    if socket_client[request.sid] in all_running_jobs:
+    sockets.pop(request.sid, None)
+    client_id = socket_client.pop(request.sid, None)
+
+    if client_id is None:
+        # client never shook hands, so it has no job
+        return
+
+    client_socket.pop(client_id, None)
+
+    if client_id in all_running_jobs:
         # client has a job
-        all_running_jobs[socket_client[request.sid]][1].cancel_sim()
-        del all_running_jobs[socket_client[request.sid]]
+        scheduler.unsubscribe(all_running_jobs.pop(client_id).job_id, client_id)
 
 
 @socketio.on('handshake')
@@ -226,6 +267,4 @@ def handshake_client(data):
 if __name__ == "__main__":
     SimBotConfig.init_logger(False, saved_params["log_path"])
 
-    # task response thread
-    threading.Thread(target=check_task_progress).start()
     socketio.run(app, debug=True)
@@ -1,3 +1,5 @@
+import json
+
 from src.api.battlenet import BattleNet
 
 
@@ -6,11 +8,12 @@ from test.mocks.request_mock import RequestMock
 
 
 class BattleNetMock(BattleNet):
-    def __init__(self, guild_response, talent_response):
+    def __init__(self, guild_response, talent_response, character_response=None):
         super().__init__("")
 
         self.guild_response = guild_response
         self.talent_response = talent_response
+        self.character_response = character_response
 
     def bnet_request(self, req_func, *args, **kwargs):
         """
@@ -25,4 +28,16 @@ class BattleNetMock(BattleNet):
         elif "talents" in url:
             return RequestMock(self.talent_response)
         else:
-            raise Exception("Unable to mock endpoint %s" % url)
\ No newline at end of file
+            raise Exception("Unable to mock endpoint %s" % url)
+
+    async def bnet_request_async(self, session, url, params):
+        """
+        Mock async API call, answering character requests with the provided response, 404 if there is none
+        """
+        if "character" not in url:
+            raise Exception("Unable to mock endpoint %s" % url)
+
+        if self.character_response is None:
+            return 404, {"status": "nok", "reason": "Character not found."}
+
+        return 200, json.loads(self.character_response)
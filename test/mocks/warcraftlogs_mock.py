@@ -54,3 +54,8 @@ class WarcraftLogsMock(WarcraftLogs):
             return RequestMock(to_return)
         else:
             raise Exception("Unable to mock endpoint %s" % url)
+
+    async def warcraftlogs_request_async(self, session, url, params):
+        r = self.warcraftlogs_request(None, url, params=params)
+
+        return r.status_code, r.json()
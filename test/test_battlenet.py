@@ -0,0 +1,101 @@
+# PyCharm workaround
+from __future__ import absolute_import
+
+import asyncio
+import os
+import tempfile
+import unittest
+
+from src.cache.sqlite_cache import SqliteCache
+from test.mocks.battlenet_mock import BattleNetMock
+from test.mocks.request_mock import RequestMock
+
+with open("bnet_guild.json", 'rb') as f:
+    bnet_guild = f.read().decode('utf-8')
+
+
+class CountingBattleNetMock(BattleNetMock):
+    def __init__(self, *args):
+        super().__init__(*args)
+
+        self.requests = []
+        self.not_modified = False
+
+    def bnet_request(self, req_func, *args, **kwargs):
+        self.requests.append(kwargs.get("headers", {}))
+
+        if self.not_modified:
+            r = RequestMock("{}")
+            r.status_code = 304
+
+            return r
+
+        r = super().bnet_request(req_func, *args, **kwargs)
+        r.headers = {"Last-Modified": "Sat, 17 Mar 2018 04:00:00 GMT"}
+
+        return r
+
+
+class TestBattleNet(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache = SqliteCache(os.path.join(self.tmp_dir.name, "roster_cache.db"), "guild_rosters")
+
+    def tearDown(self):
+        self.cache.close()
+        self.tmp_dir.cleanup()
+
+    def test_roster_cache(self):
+        bnet = CountingBattleNetMock(bnet_guild, "{}")
+        bnet._roster_cache = self.cache
+        bnet._roster_ttl = 60
+
+        names, basic_names = bnet.get_guild_members("Arthas", "Guild", "en_US", 110)
+        cached_names, cached_basic_names = bnet.get_guild_members("Arthas", "Guild", "en_US", 110)
+
+        self.assertEqual(1, len(bnet.requests))
+        self.assertEqual(names["DPS"], cached_names["DPS"])
+        self.assertEqual(basic_names, cached_basic_names)
+
+        # a different level is a different roster
+        bnet.get_guild_members("Arthas", "Guild", "en_US", 100)
+        self.assertEqual(2, len(bnet.requests))
+
+    def test_stale_roster_revalidated(self):
+        bnet = CountingBattleNetMock(bnet_guild, "{}")
+        bnet._roster_cache = self.cache
+        bnet._roster_ttl = 0
+
+        names, _ = bnet.get_guild_members("Arthas", "Guild", "en_US", 110)
+
+        bnet.not_modified = True
+        cached_names, _ = bnet.get_guild_members("Arthas", "Guild", "en_US", 110)
+
+        self.assertEqual("Sat, 17 Mar 2018 04:00:00 GMT", bnet.requests[1]["If-Modified-Since"])
+        self.assertEqual(names["DPS"], cached_names["DPS"])
+
+    def test_get_characters(self):
+        bnet = BattleNetMock(bnet_guild, "{}", '{"name": "Redrimer", "items": {}}')
+        loop = asyncio.new_event_loop()
+
+        try:
+            profiles = loop.run_until_complete(bnet.get_characters([("Redrimer", "arthas")], "US", "en_US", 2))
+        finally:
+            loop.close()
+
+        self.assertEqual([{"name": "Redrimer", "items": {}}], profiles)
+
+        bnet.character_response = None
+        loop = asyncio.new_event_loop()
+
+        try:
+            profiles = loop.run_until_complete(bnet.get_characters([("Redrimer", "arthas")], "US", "en_US", 2))
+        finally:
+            loop.close()
+
+        # missing characters are None, so simc falls back to the armory
+        self.assertEqual([None], profiles)
+
+
+if __name__ == '__main__':
+    unittest.main()
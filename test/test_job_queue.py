@@ -0,0 +1,160 @@
+# PyCharm workaround
+from __future__ import absolute_import
+
+import asyncio
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from src.connectors.simcraft_connectors.queue_simcraft_connector import QueueSimcraftConnector
+from src.job_queue import JobQueue, run_worker
+
+
+class FakeSimulationCraft:
+    def __init__(self):
+        self.jobs = []
+
+    async def run_sim_result(self, **job):
+        self.jobs.append(job)
+
+        if job["fight_style"] == "broken":
+            return False
+
+        return {"dps": 1000 * job["iterations"]}
+
+    def forget_results(self):
+        pass
+
+
+class TestJobQueue(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp_dir.name, "job_queue.db")
+        self.queue = JobQueue(self.db_path)
+
+    def tearDown(self):
+        self.queue.close()
+        self.tmp_dir.cleanup()
+
+    def test_claim_and_complete(self):
+        self.assertEqual("queued", self.queue.enqueue("a", {"n": 1}, priority=1))
+        self.queue.enqueue("b", {"n": 2})
+        # equal keys are queued once
+        self.queue.enqueue("b", {"n": 2})
+
+        # lower priority first
+        self.assertEqual(("b", {"n": 2}), self.queue.claim("w1"))
+        self.assertEqual(("a", {"n": 1}), self.queue.claim("w2"))
+        self.assertIsNone(self.queue.claim("w1"))
+
+        self.queue.complete("b", "w1", {"dps": 1})
+        self.queue.complete("a", "w2", False)
+
+        self.assertEqual({"b": {"dps": 1}, "a": False}, self.queue.results(["a", "b", "c"]))
+
+        # done jobs are not run again, failed ones are
+        self.assertEqual("done", self.queue.enqueue("b", {"n": 2}))
+        self.assertEqual("queued", self.queue.enqueue("a", {"n": 1}))
+
+        status = self.queue.status()
+        self.assertEqual(1, status["queued"])
+        self.assertEqual(1, status["done"])
+        self.assertEqual({"w1"}, set(status["jobs_per_minute"]))
+
+    def test_lease_expires(self):
+        queue = JobQueue(self.db_path, lease_sec=0.05, max_attempts=2)
+        queue.enqueue("a", {"n": 1})
+
+        self.assertEqual("a", queue.claim("crashed")[0])
+        self.assertIsNone(queue.claim("w1"))
+
+        time.sleep(0.1)
+        self.assertEqual(1, queue.status()["expired_leases"])
+        # given to another worker once the lease expired
+        self.assertEqual("a", queue.claim("w1")[0])
+
+        time.sleep(0.1)
+        # out of attempts
+        self.assertIsNone(queue.claim("w2"))
+        self.assertEqual({"a": False}, queue.results(["a"]))
+
+        queue.close()
+
+    def test_connector(self):
+        async def suite(player, realm_slug, region, iterations, raiding_stats, simc=None):
+            results = await asyncio.gather(*[simc.run_sim_result(player, realm_slug, region, "Fire", "1111111",
+                                                                 iterations, fight_style=fight_style)
+                                             for fight_style in ["Patchwerk", "Patchwerk", "broken"]])
+
+            return {"player_name": player, "results": results}
+
+        simc = FakeSimulationCraft()
+        stop = threading.Event()
+
+        def worker():
+            worker_queue = JobQueue(self.db_path)
+
+            while not stop.is_set():
+                run_worker(worker_queue, simc, "w1", exit_when_idle=True)
+                time.sleep(0.01)
+
+            worker_queue.close()
+
+        worker_thread = threading.Thread(target=worker)
+        worker_thread.start()
+
+        try:
+            sc = QueueSimcraftConnector(JobQueue(self.db_path))
+            sc.POLL_INTERVAL_SEC = 0.01
+            sc.queue_sim(suite, "a", "arthas", "US", 100, {})
+            sc.queue_sim(suite, "b", "arthas", "US", 100, {})
+            suites = sc.get_completed_sims()
+        finally:
+            stop.set()
+            worker_thread.join()
+
+        self.assertEqual([{"dps": 100000}, {"dps": 100000}, False], suites[0]["results"])
+        # the identical Patchwerk sims of a suite ran once
+        self.assertEqual(4, len(simc.jobs))
+
+        # a later run gets finished sims from the queue, without a worker
+        async def finished_suite(player, realm_slug, region, iterations, raiding_stats, simc=None):
+            return await simc.run_sim_result(player, realm_slug, region, "Fire", "1111111", iterations,
+                                             fight_style="Patchwerk")
+
+        sc = QueueSimcraftConnector(JobQueue(self.db_path))
+        sc.POLL_INTERVAL_SEC = 0.01
+        sc.queue_sim(finished_suite, "a", "arthas", "US", 100, {})
+
+        self.assertEqual([{"dps": 100000}], sc.get_completed_sims())
+
+    def test_max_age(self):
+        self.queue.enqueue("a", {"n": 1})
+        self.queue.complete(self.queue.claim("w1")[0], "w1", {"dps": 1})
+
+        self.assertEqual("done", self.queue.enqueue("a", {"n": 1}, max_age=3600))
+
+        time.sleep(0.01)
+        # too old to reuse, e.g. with a sim cache ttl of 0
+        self.assertEqual("queued", self.queue.enqueue("a", {"n": 1}, max_age=0))
+        self.assertEqual({}, self.queue.results(["a"]))
+
+    def test_purge_while_busy(self):
+        queue = JobQueue(self.db_path, retention=0.05)
+        queue.PURGE_INTERVAL_SEC = 0
+        queue.enqueue("a", {"n": 1})
+        queue.enqueue("b", {"n": 2})
+        queue.complete(queue.claim("w1")[0], "w1", {"dps": 1})
+
+        time.sleep(0.1)
+        # the old job is removed by the next claim, without the worker ever being idle
+        self.assertEqual("b", queue.claim("w1")[0])
+        self.assertEqual(0, queue.status()["done"])
+
+        queue.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,198 @@
+# PyCharm workaround
+from __future__ import absolute_import
+
+import os
+import struct
+import sys
+import threading
+import time
+import unittest
+
+from src.api import ReportableError
+from src.site.job_scheduler import JobRejected, JobScheduler
+
+
+def fake_job(job_id, config, share, cancel_event, messages):
+    # runs until cancelled, or for config seconds
+    messages.put((job_id, "event", {"start": True}))
+    cancel_event.wait(config)
+
+    if not cancel_event.is_set():
+        messages.put((job_id, "result", {"share": share.value}))
+
+
+def stubborn_job(job_id, config, share, cancel_event, messages):
+    # ignores being cancelled
+    time.sleep(config)
+    messages.put((job_id, "result", {}))
+
+
+def cut_short_job(job_id, config, share, cancel_event, messages):
+    if job_id != "cut_short":
+        return fake_job(job_id, config, share, cancel_event, messages)
+
+    # the start of a message, as a job killed halfway through sending it leaves behind, then ignores being cancelled
+    os.write(messages._conn.fileno(), struct.pack("!i", 1000) + b"cut short")
+    time.sleep(config)
+
+
+def failing_job(job_id, config, share, cancel_event, messages):
+    messages.put((job_id, "error", ("No guild found.", True)))
+
+
+class TestJobScheduler(unittest.TestCase):
+    def test_fair_share(self):
+        scheduler = JobScheduler(simc_budget=5, max_running_jobs=2, target=fake_job)
+
+        first = scheduler.submit("first", 0.5)
+        second = scheduler.submit("second", 0.1)
+
+        # first in line gets the remainder
+        self.assertEqual({"first": 3, "second": 2}, scheduler.status()["running"])
+
+        second.get(5)
+        # results arrive before the process has exited, the budget goes to the job still running once it has
+        deadline = time.monotonic() + 5
+        while len(scheduler.status()["running"]) > 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual({"first": 5}, scheduler.status()["running"])
+        self.assertEqual({"share": 5}, first.get(5))
+
+    def test_admission(self):
+        events = []
+        scheduler = JobScheduler(simc_budget=2, max_running_jobs=1, max_queued_jobs=2, target=fake_job,
+                                 on_event=lambda job, event, subscribers: events.append((job.job_id, event)))
+
+        running = scheduler.submit("running", 10)
+        low = scheduler.submit("low", 0.01, priority=1)
+        high = scheduler.submit("high", 0.01, priority=0)
+
+        # queue is full
+        with self.assertRaises(JobRejected):
+            scheduler.submit("rejected", 0.01)
+
+        self.assertEqual(0, scheduler.position(running))
+        self.assertEqual(1, scheduler.position(high))
+        self.assertEqual(2, scheduler.position(low))
+
+        self.assertTrue(scheduler.cancel("running"))
+
+        with self.assertRaises(ReportableError):
+            running.get(5)
+
+        # higher priority started first
+        high.get(5)
+        self.assertFalse(low.ready())
+        low.get(5)
+
+        # waiting clients are told their position, which drops when a higher priority job is queued
+        self.assertEqual([("low", {"queued": True, "position": 1}),
+                          ("high", {"queued": True, "position": 1}), ("low", {"queued": True, "position": 2})],
+                         [event for event in events if event[1].get("queued")][:3])
+        # events of a job arrive in order, before it is done
+        self.assertEqual([("running", {"start": True}), ("high", {"start": True}), ("low", {"start": True})],
+                         [event for event in events if event[1].get("start")])
+
+    def test_cancel_waiting(self):
+        scheduler = JobScheduler(simc_budget=1, target=fake_job)
+
+        running = scheduler.submit("running", 10)
+        waiting = scheduler.submit("waiting", 0.01)
+
+        scheduler.cancel("waiting")
+
+        with self.assertRaises(ReportableError):
+            waiting.get(5)
+
+        scheduler.cancel("running")
+        time.sleep(0.01)
+        self.assertFalse(scheduler.cancel("missing"))
+
+        with self.assertRaises(ReportableError):
+            running.get(5)
+
+    def test_kill_cancelled(self):
+        scheduler = JobScheduler(simc_budget=2, target=stubborn_job)
+
+        stubborn = scheduler.submit("stubborn", 30)
+        scheduler.submit("other", 30)
+
+        start = time.monotonic()
+        scheduler.cancel("stubborn")
+
+        with self.assertRaisesRegex(ReportableError, "Job cancelled."):
+            stubborn.get(5)
+
+        # killed once its grace period is over
+        self.assertLess(time.monotonic() - start, JobScheduler.CANCEL_GRACE_SEC + 2)
+
+        deadline = time.monotonic() + 5
+        while len(scheduler.status()["running"]) > 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        # its share of the budget goes to the other job
+        self.assertEqual({"other": 2}, scheduler.status()["running"])
+
+        scheduler.cancel("other")
+
+    @unittest.skipIf(sys.platform == 'win32', "writes to the job's pipe directly")
+    def test_kill_mid_message(self):
+        scheduler = JobScheduler(simc_budget=2, target=cut_short_job)
+
+        cut_short = scheduler.submit("cut_short", 30)
+        scheduler.cancel("cut_short")
+
+        # other jobs' messages still arrive, on their own pipes, and the killed job's share goes to them
+        other = scheduler.submit("other", JobScheduler.CANCEL_GRACE_SEC + 1)
+        self.assertEqual({"share": 2}, other.get(10))
+
+        with self.assertRaisesRegex(ReportableError, "Job cancelled."):
+            cut_short.get(5)
+
+    def test_subscribe(self):
+        events = []
+        scheduler = JobScheduler(simc_budget=2, target=fake_job,
+                                 on_event=lambda job, event, subscribers: events.append((event, subscribers)))
+
+        job, replay = scheduler.subscribe("guild", 10, "officer1")
+        self.assertEqual([], replay)
+
+        deadline = time.monotonic() + 5
+        while not events and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual([({"start": True}, frozenset({"officer1"}))], events)
+
+        # identical requests share the running job, and catch up on its progress
+        same_job, replay = scheduler.subscribe("guild", 10, "officer2")
+        self.assertIs(job, same_job)
+        self.assertEqual([{"start": True}], replay)
+        self.assertEqual({"guild": 2}, scheduler.status()["running"])
+
+        # only cancelled once everyone left
+        self.assertTrue(scheduler.unsubscribe("guild", "officer1"))
+        self.assertFalse(scheduler.unsubscribe("guild", "officer1"))
+        self.assertFalse(job.cancel_event.is_set())
+
+        self.assertTrue(scheduler.unsubscribe("guild", "officer2"))
+
+        with self.assertRaisesRegex(ReportableError, "Job cancelled."):
+            job.get(5)
+
+        # a new request starts a new job
+        new_job, _ = scheduler.subscribe("guild", 0.01, "officer1")
+        self.assertIsNot(job, new_job)
+        self.assertEqual({"share": 2}, new_job.get(5))
+        self.assertEqual(frozenset({"officer1"}), new_job.subscribers)
+
+    def test_error(self):
+        done = threading.Event()
+        scheduler = JobScheduler(simc_budget=1, target=failing_job, on_done=lambda job: done.set())
+
+        job = scheduler.submit("failing", None)
+        self.assertTrue(done.wait(5))
+
+        with self.assertRaisesRegex(ReportableError, "No guild found."):
+            job.get(0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,239 @@
+# PyCharm workaround
+from __future__ import absolute_import
+
+import asyncio
+import threading
+import time
+import unittest
+
+from aiohttp import web
+
+from src.api.rate_limiter import AdaptiveConcurrency
+from src.api.simcraft import SimJob
+from src.connectors.simcraft_connectors.lambda_simcraft_connector import LambdaSimcraftConnector
+from src.simbot import SimcraftBot, SimBotConfig
+
+
+class FakeSimCache:
+    def __init__(self, results):
+        """
+        Stands in for the sim cache of a SimulationCraft.
+        :param results: dict of SimJob to cached result
+        """
+        self.results = results
+
+    def cached_result(self, job):
+        return self.results.get(job)
+
+    def store_result(self, job, result):
+        self.results[job] = result
+
+
+class TestLambdaSimcraftConnector(unittest.TestCase):
+    def setUp(self):
+        self.requests = {}
+        # sim_params of each player's last suite request
+        self.sim_params = {}
+        # every sim_job requested
+        self.sim_jobs = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def handle(self, request):
+        body = await request.json()
+
+        if "sim_job" in body:
+            return await self.handle_sim_job(body["sim_job"])
+
+        params = body["sim_params"]
+        player = params["character_name"]
+        self.requests[player] = self.requests.get(player, 0) + 1
+        self.sim_params[player] = params
+
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+        try:
+            await asyncio.sleep(0.01)
+
+            if player == "throttled" and self.requests[player] == 1:
+                return web.json_response({"message": "Rate Exceeded."}, status=429)
+            elif player == "broken":
+                return web.json_response({"error": "Invalid parameters provided"}, status=400)
+            elif player == "slow":
+                await asyncio.sleep(1)
+
+            return web.json_response({"suite": {"player_name": player, "average_performance": 100}})
+        finally:
+            self.in_flight -= 1
+
+    async def handle_sim_job(self, job):
+        self.sim_jobs.append(job)
+        key = (job["character_name"], job["fight_style"])
+        self.requests[key] = self.requests.get(key, 0) + 1
+
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+        try:
+            await asyncio.sleep(0.01)
+
+            if job["fight_style"] == "broken":
+                return web.json_response({"result": False})
+
+            return web.json_response({"result": {"dps": 1000 * job["iterations"]}})
+        finally:
+            self.in_flight -= 1
+
+    @staticmethod
+    async def fake_suite(player, realm_slug, region, iterations, fight_styles, simc=None):
+        results = await asyncio.gather(*[simc.run_sim_result(player, realm_slug, region, "Fire", "1111111",
+                                                             iterations, fight_style=fight_style)
+                                         for fight_style in fight_styles])
+
+        return {"player_name": player, "results": results}
+
+    def run_connector(self, players, sim_coro=None, cancel_after=None, queue_suite=None, **kwargs):
+        sc = LambdaSimcraftConnector({}, **kwargs)
+        sc.RETRY_BASE_DELAY_SEC = 0.01
+
+        if cancel_after is not None:
+            threading.Timer(cancel_after, sc.cancel).start()
+
+        async def run():
+            app = web.Application()
+            app.router.add_post("/sim", self.handle)
+            runner = web.AppRunner(app)
+            await runner.setup()
+            site = web.TCPSite(runner, "127.0.0.1", 0)
+            await site.start()
+
+            port = site._server.sockets[0].getsockname()[1]
+            sc._urls = {"lambda": {"production": "http://127.0.0.1:%d/sim" % port}}
+
+            try:
+                return await sc._run()
+            finally:
+                await runner.cleanup()
+
+        for player in players:
+            if queue_suite is not None:
+                queue_suite(player, sc)
+            else:
+                sc.queue_sim(sim_coro, player, "arthas", "US", 100, {})
+
+        try:
+            return sc.loop.run_until_complete(run())
+        finally:
+            sc.close()
+
+    def test_failures_isolated(self):
+        results = self.run_connector(["ok", "throttled", "broken", "slow"], request_timeout=0.5, max_retries=1)
+
+        self.assertEqual({"player_name": "ok", "average_performance": 100}, results[0])
+        # throttled once, then retried
+        self.assertEqual({"player_name": "throttled", "average_performance": 100}, results[1])
+        self.assertEqual(2, self.requests["throttled"])
+        # client errors are not retried
+        self.assertIn("error", results[2])
+        self.assertEqual(1, self.requests["broken"])
+        # timed out on every attempt
+        self.assertIn("error", results[3])
+        self.assertEqual(2, self.requests["slow"])
+
+    def test_concurrency_limit(self):
+        self.run_connector(["player%d" % i for i in range(20)], max_concurrency=4, initial_concurrency=2)
+
+        self.assertLessEqual(self.max_in_flight, 4)
+
+    def test_sim_fan_out(self):
+        async def suite(player, realm_slug, region, iterations, raiding_stats, simc=None):
+            # both suites of "a" ask for the same sims
+            return await self.fake_suite(player.rstrip("2"), realm_slug, region, iterations,
+                                         ["Patchwerk", "Patchwerk", "HecticAddCleave", "broken"], simc)
+
+        results = self.run_connector(["a", "a2", "b"], sim_coro=suite, work_unit="sim", max_retries=0)
+
+        self.assertEqual([{"dps": 100000}, {"dps": 100000}, {"dps": 100000}, False], results[0]["results"])
+        self.assertEqual(results[0], results[1])
+        # every distinct sim is invoked once, whichever suites need it
+        self.assertEqual(1, self.requests[("a", "Patchwerk")])
+        self.assertEqual(1, self.requests[("a", "HecticAddCleave")])
+        self.assertEqual(1, self.requests[("b", "Patchwerk")])
+        self.assertEqual(6, sum(self.requests.values()))
+
+    def test_sim_cache(self):
+        async def suite(player, realm_slug, region, iterations, raiding_stats, simc=None):
+            return await self.fake_suite(player, realm_slug, region, iterations, ["Patchwerk", "HecticAddCleave"],
+                                         simc)
+
+        cached = SimJob("a", "arthas", "US", "Fire", "1111111", "Patchwerk", 100, None)
+        sim_cache = FakeSimCache({cached: {"dps": 1}})
+
+        results = self.run_connector(["a"], sim_coro=suite, work_unit="sim", simc=sim_cache)
+
+        # cached sims are not invoked, invoked ones are cached
+        self.assertEqual([{"dps": 1}, {"dps": 100000}], results[0]["results"])
+        self.assertNotIn(("a", "Patchwerk"), self.requests)
+        self.assertEqual({"dps": 100000}, sim_cache.results[cached._replace(fight_style="HecticAddCleave")])
+
+    def test_suite_params(self):
+        screening = {"screening_iterations": 10, "screening_threshold": 80, "screening_margin": 10,
+                     "screening_max_error": 1.0}
+
+        self.run_connector(["ok"], screening=screening)
+
+        # the invoked suite runs in two passes too
+        self.assertEqual(screening, self.sim_params["ok"]["screening"])
+
+    def test_target_error(self):
+        sbc = SimBotConfig()
+        sbc.init_args("TestGuild_NoAPI", "TestRealm_NoAPI", "simc", config_path='../config', write_logs=False,
+                      sim_target_error=0.5, sim_cache_ttl=0, talent_cache_ttl=0, roster_cache_ttl=0,
+                      character_profile_ttl=0, suite_cache_ttl=0, result_retention=0)
+        # every sim runs on the connector, the SimcraftBot's own simc is never used
+        sb = SimcraftBot(sbc, None, None, FakeSimCache({}), {"Garothi Worldbreaker": "Ultraxion"})
+        raiding_stats = {"Garothi Worldbreaker": [{"dps": 100000, "spec": "Fire", "talents": "1111111"}]}
+
+        def queue_suite(player, sc):
+            sb.queue_suite(player, "Arthas", raiding_stats, sc)
+
+        # suites invoked whole, and each sim of suites run here
+        self.run_connector(["ok"], queue_suite=queue_suite)
+        self.assertEqual(0.5, self.sim_params["ok"]["target_error"])
+
+        self.run_connector(["ok"], queue_suite=queue_suite, work_unit="sim")
+        self.assertEqual([0.5], [job["target_error"] for job in self.sim_jobs])
+
+    def test_cancel(self):
+        start = time.monotonic()
+
+        # requests in flight are aborted, not waited for until they time out
+        with self.assertRaises(asyncio.CancelledError):
+            self.run_connector(["slow"] * 5, cancel_after=0.2)
+
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(5, self.requests["slow"])
+
+    def test_aimd(self):
+        concurrency = AdaptiveConcurrency(4, 8)
+        loop = asyncio.new_event_loop()
+
+        async def call(throttled):
+            await concurrency.acquire()
+            await concurrency.release(throttled)
+
+        try:
+            for _ in range(4):
+                loop.run_until_complete(call(False))
+
+            self.assertAlmostEqual(5, concurrency.limit, delta=0.2)
+
+            loop.run_until_complete(call(True))
+            self.assertAlmostEqual(2.5, concurrency.limit, delta=0.2)
+        finally:
+            loop.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+# PyCharm workaround
+from __future__ import absolute_import
+
+import asyncio
+import threading
+import time
+import unittest
+
+from src.connectors.simcraft_connectors.local_simcraft_connector import LocalSimcraftConnector
+
+
+class TestLocalSimcraftConnector(unittest.TestCase):
+    def setUp(self):
+        self.running = 0
+        self.max_running = 0
+        self.start_order = []
+
+    async def fake_suite(self, name, duration=0.01):
+        self.start_order.append(name)
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+
+        await asyncio.sleep(duration)
+
+        self.running -= 1
+
+        return name
+
+    def test_concurrency_cap(self):
+        sc = LocalSimcraftConnector(max_concurrent_sims=3)
+
+        for i in range(10):
+            sc.queue_sim(self.fake_suite, i)
+
+        self.assertEqual(10, sc.get_status()["queued"])
+
+        results = sc.get_completed_sims()
+
+        self.assertEqual(list(range(10)), results)
+        self.assertEqual(3, self.max_running)
+        self.assertEqual({"queued": 0, "running": 0, "finished": 10, "max_concurrent": 3}, sc.get_status())
+
+    def test_concurrency_limit(self):
+        limit = [2]
+        sc = LocalSimcraftConnector(max_concurrent_sims=4, concurrency_limit=lambda: limit[0])
+        sc.LIMIT_CHECK_INTERVAL_SEC = 0.001
+
+        def on_complete(result):
+            # another job ended, this one gets a bigger share of the budget
+            limit[0] = 4
+
+        for i in range(8):
+            sc.queue_sim(self.fake_suite, i)
+
+        sc.get_completed_sims(on_complete)
+
+        self.assertEqual(4, self.max_running)
+
+        self.max_running = 0
+        sc = LocalSimcraftConnector(max_concurrent_sims=4, concurrency_limit=lambda: 2)
+
+        for i in range(8):
+            sc.queue_sim(self.fake_suite, i)
+
+        sc.get_completed_sims()
+
+        self.assertEqual(2, self.max_running)
+
+    def test_priority_order(self):
+        sc = LocalSimcraftConnector(max_concurrent_sims=1)
+
+        sc.queue_sim(self.fake_suite, "a")
+        sc.queue_sim(self.fake_suite, "b", priority=-1)
+        sc.queue_sim(self.fake_suite, "c")
+
+        # results are returned in queue order, but run in priority then FIFO order
+        self.assertEqual(["a", "b", "c"], sc.get_completed_sims())
+        self.assertEqual(["b", "a", "c"], self.start_order)
+
+    def test_on_complete(self):
+        sc = LocalSimcraftConnector(max_concurrent_sims=2)
+        completed = []
+
+        sc.queue_sim(self.fake_suite, "slow", 0.05)
+        sc.queue_sim(self.fake_suite, "fast", 0.01)
+
+        self.assertEqual(["slow", "fast"], sc.get_completed_sims(completed.append))
+        self.assertEqual(["fast", "slow"], completed)
+
+    def test_completed_sims(self):
+        sc = LocalSimcraftConnector(max_concurrent_sims=2)
+
+        sc.queue_sim(self.fake_suite, "slow", 0.05)
+        sc.queue_sim(self.fake_suite, "fast", 0.01)
+
+        async def collect():
+            return [result async for result in sc.completed_sims()]
+
+        try:
+            self.assertEqual(["fast", "slow"], sc.loop.run_until_complete(collect()))
+        finally:
+            sc.close()
+
+    def test_cancel(self):
+        sc = LocalSimcraftConnector(max_concurrent_sims=2)
+
+        for i in range(5):
+            sc.queue_sim(self.fake_suite, i, 30)
+
+        threading.Timer(0.05, sc.cancel).start()
+        start = time.monotonic()
+
+        with self.assertRaises(asyncio.CancelledError):
+            sc.get_completed_sims()
+
+        # running sims are stopped, queued ones are never started
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual([0, 1], self.start_order)
+        self.assertEqual(0, sc.get_status()["running"])
+
+        # closed connectors ignore being cancelled
+        sc.cancel()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+# PyCharm workaround
+from __future__ import absolute_import
+
+import json
+import tempfile
+import unittest
+
+from src.cache.profile_store import ProfileStore
+
+profile = {"name": "Redrimer", "lastModified": 1521259200000, "items": {"head": {"id": 151811}}}
+
+
+class TestProfileStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_put_get(self):
+        store = ProfileStore(self.tmp_dir.name, 60)
+        self.assertIsNone(store.get("US", "arthas", "Redrimer"))
+
+        path, profile_hash = store.put("US", "arthas", "Redrimer", profile)
+
+        self.assertEqual((path, profile_hash), store.get("us", "Arthas", "redrimer"))
+
+        with open(path, 'r') as f:
+            self.assertEqual(profile, json.loads(f.read()))
+
+    def test_expired(self):
+        store = ProfileStore(self.tmp_dir.name, 0)
+        store.put("US", "arthas", "Redrimer", profile)
+
+        self.assertIsNone(store.get("US", "arthas", "Redrimer"))
+
+    def test_hash(self):
+        relogged = dict(profile, lastModified=1521262800000)
+        regeared = dict(profile, items={"head": {"id": 152112}})
+
+        self.assertEqual(ProfileStore.profile_hash(profile), ProfileStore.profile_hash(relogged))
+        self.assertNotEqual(ProfileStore.profile_hash(profile), ProfileStore.profile_hash(regeared))
+
+
+if __name__ == '__main__':
+    unittest.main()
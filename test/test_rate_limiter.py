@@ -0,0 +1,57 @@
+# PyCharm workaround
+from __future__ import absolute_import
+
+import asyncio
+import time
+import unittest
+
+from src.api.rate_limiter import RateLimiter, TokenBucket
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_for_limit(self):
+        bucket = TokenBucket.for_limit(100, 1, 0.1)
+
+        # burst plus one window of refill equals the limit
+        self.assertEqual(10, bucket.capacity)
+        self.assertEqual(90, bucket.refill_rate)
+
+    def test_burst_then_delay(self):
+        limiter = RateLimiter({"second": TokenBucket(5, 50)})
+
+        start = time.monotonic()
+        for _ in range(5):
+            self.assertEqual(0, limiter.acquire())
+
+        # bucket is empty, next call waits for a refill of 1/50 sec
+        self.assertGreater(limiter.acquire(), 0)
+        self.assertGreaterEqual(time.monotonic() - start, 0.015)
+
+    def test_all_buckets_limit(self):
+        limiter = RateLimiter({"fast": TokenBucket(10, 1000), "slow": TokenBucket(2, 20)})
+
+        limiter.acquire()
+        limiter.acquire()
+
+        levels = limiter.levels()
+        self.assertLess(levels["slow"], 1)
+        self.assertGreater(levels["fast"], 7)
+
+    def test_acquire_async(self):
+        limiter = RateLimiter({"second": TokenBucket(1, 100)})
+        loop = asyncio.new_event_loop()
+
+        async def acquire_all():
+            return await asyncio.gather(*[limiter.acquire_async() for _ in range(3)])
+
+        try:
+            waits = loop.run_until_complete(acquire_all())
+        finally:
+            loop.close()
+
+        self.assertEqual(0, waits[0])
+        self.assertTrue(all(wait > 0 for wait in waits[1:]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+# PyCharm workaround
+from __future__ import absolute_import
+
+import os
+import tempfile
+import time
+import unittest
+
+from src.cache.result_store import ResultStore
+
+
+class TestResultStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp_dir.name, "results.db")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_latest(self):
+        store = ResultStore(self.db_path)
+        self.assertIsNone(store.latest("US", "Arthas", "Clutch"))
+
+        first = store.put("US", "Arthas", "Clutch", "heroic", 3, {"guild_avg": 80.0}, {"iterations": 100}, 1000)
+        store.put("US", "Arthas", "Clutch", "mythic", 3, {"guild_avg": 60.0}, {"iterations": 100})
+        store.close()
+
+        store = ResultStore(self.db_path)
+
+        # guilds and realms are matched regardless of case
+        latest = store.latest("us", "arthas", "CLUTCH")
+        self.assertEqual({"guild_avg": 60.0}, latest["report"])
+        self.assertEqual({"iterations": 100}, latest["params"])
+        self.assertLessEqual(latest["started"], latest["finished"])
+
+        heroic = store.latest("US", "Arthas", "Clutch", difficulty="heroic", weeks=3)
+        self.assertEqual({"guild_avg": 80.0}, heroic["report"])
+        self.assertEqual(first, heroic["etag"])
+        self.assertEqual(1000, heroic["started"])
+
+        self.assertIsNone(store.latest("US", "Arthas", "Clutch", weeks=4))
+        self.assertIsNone(store.latest("EU", "Arthas", "Clutch"))
+
+    def test_realm_slug(self):
+        store = ResultStore(self.db_path)
+        store.put("US", "Area 52", "Clutch", "heroic", 3, {"guild_avg": 80.0}, {})
+        store.put("EU", "Aggra (Português)", "Clutch", "heroic", 3, {"guild_avg": 70.0}, {})
+        store.put("US", "Kel'Thuzad", "Clutch", "heroic", 3, {"guild_avg": 60.0}, {})
+
+        # urls carry the realm's slug
+        self.assertEqual({"guild_avg": 80.0}, store.latest("US", "area-52", "Clutch")["report"])
+        self.assertEqual({"guild_avg": 80.0}, store.latest("US", "Area 52", "Clutch")["report"])
+        self.assertEqual({"guild_avg": 70.0}, store.latest("EU", "aggra-portugues", "Clutch")["report"])
+        self.assertEqual({"guild_avg": 60.0}, store.latest("US", "kelthuzad", "Clutch")["report"])
+        self.assertIsNone(store.latest("US", "area-51", "Clutch"))
+
+    def test_etag(self):
+        store = ResultStore(self.db_path)
+
+        first = store.put("US", "Arthas", "Clutch", "heroic", 3, {"a": 1, "guild_avg": 80.0}, {})
+        # same report, however its keys are ordered
+        self.assertEqual(first, store.put("US", "Arthas", "Clutch", "heroic", 3, {"guild_avg": 80.0, "a": 1}, {}))
+        self.assertNotEqual(first, store.put("US", "Arthas", "Clutch", "heroic", 3, {"guild_avg": 81.0}, {}))
+
+    def test_retention(self):
+        store = ResultStore(self.db_path, retention=0.05, max_reports_per_guild=2)
+
+        for guild_avg in range(3):
+            store.put("US", "Arthas", "Clutch", "heroic", 3, {"guild_avg": guild_avg}, {})
+
+        store.put("US", "Arthas", "Other", "heroic", 3, {"guild_avg": 0}, {})
+
+        # only the newest reports of each guild are kept
+        self.assertEqual(3, len(store))
+        self.assertEqual({"guild_avg": 2}, store.latest("US", "Arthas", "Clutch")["report"])
+
+        time.sleep(0.1)
+
+        self.assertEqual(3, store.purge())
+        self.assertIsNone(store.latest("US", "Arthas", "Clutch"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+# PyCharm workaround
+from __future__ import absolute_import
+
+import os
+import tempfile
+import time
+import unittest
+
+from src.cache.sim_cache import SimCache
+
+
+class TestSimCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp_dir.name, "sim_cache.db")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_persists_between_instances(self):
+        key = SimCache.make_key("Redrimer", "Arthas", "US", "subtlety", "3113211", "Ultraxion", 100, "abc")
+
+        cache = SimCache(self.db_path, ttl=60)
+        cache.put(key, {"dps": 845266})
+        cache.close()
+
+        cache = SimCache(self.db_path, ttl=60)
+        self.assertEqual({"dps": 845266}, cache.get(key))
+
+        # any changed sim parameter is a different sim
+        other_key = SimCache.make_key("Redrimer", "Arthas", "US", "subtlety", "3113211", "Ultraxion", 100, "def")
+        self.assertIsNone(cache.get(other_key))
+
+        precise_key = SimCache.make_key("Redrimer", "Arthas", "US", "subtlety", "3113211", "Ultraxion", 100, "abc",
+                                        target_error=0.2)
+        self.assertIsNone(cache.get(precise_key))
+
+    def test_ttl(self):
+        cache = SimCache(self.db_path, ttl=0.05)
+        cache.put("key", {"dps": 1})
+
+        time.sleep(0.1)
+
+        self.assertIsNone(cache.get("key"))
+        self.assertEqual(({"dps": 1}), cache.get_entry("key")[0])
+
+        cache.evict()
+        self.assertEqual(0, len(cache))
+
+    def test_lru_eviction(self):
+        cache = SimCache(self.db_path, max_entries=2)
+        cache.put("a", {"dps": 1})
+        time.sleep(0.01)
+        cache.put("b", {"dps": 2})
+        time.sleep(0.01)
+
+        # "a" is now the most recently used
+        cache.get("a")
+        time.sleep(0.01)
+        cache.put("c", {"dps": 3})
+
+        self.assertEqual(2, len(cache))
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual({"dps": 1}, cache.get("a"))
+        self.assertEqual({"dps": 3}, cache.get("c"))
+
+
+if __name__ == '__main__':
+    unittest.main()
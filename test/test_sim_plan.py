@@ -0,0 +1,35 @@
+# PyCharm workaround
+from __future__ import absolute_import
+
+import unittest
+
+from src.api.simcraft import SimJob
+from src.sim_plan import SimPlan
+
+
+class TestSimPlan(unittest.TestCase):
+    def test_duplicates_collapsed(self):
+        plan = SimPlan(0.001)
+        job = SimJob("Redrimer", "arthas", "US", "fire", "1111111", "Patchwerk", 1000)
+
+        plan.add(job, False)
+        plan.add(job, False)
+        plan.add(job._replace(fight_style="HecticAddCleave"), True)
+
+        summary = plan.summary()
+        self.assertEqual(1, summary["players"])
+        self.assertEqual(3, summary["sims_requested"])
+        self.assertEqual(2, summary["distinct_jobs"])
+        self.assertEqual(1, summary["cached_jobs"])
+        self.assertEqual([job], plan.jobs_to_run())
+        self.assertEqual({"Patchwerk": 1}, summary["jobs_by_fight_style"])
+
+    def test_estimate(self):
+        plan = SimPlan(0.001)
+        job = SimJob("Redrimer", "arthas", "US", "fire", "1111111", "HecticAddCleave", 1000)
+
+        self.assertAlmostEqual(SimPlan.SIMC_STARTUP_CPU_SECONDS + 2.5, plan.estimate_cpu_seconds(job))
+
+
+if __name__ == '__main__':
+    unittest.main()
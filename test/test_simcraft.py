@@ -1,7 +1,13 @@
 # PyCharm workaround
 from __future__ import absolute_import
 
+import asyncio
 import json
+import os
+import shutil
+import sys
+import tempfile
+import time
 import unittest
 
 from src.api.simcraft import SimulationCraft
@@ -17,3 +23,137 @@ class TestSimcraft(unittest.TestCase):
     def test_find_dps(self):
         self.assertEqual('845266', SimulationCraft.find_dps(dps_str_1))
         self.assertEqual('1109791', SimulationCraft.find_dps(dps_str_2))
+
+    def test_find_player_dps(self):
+        self.assertEqual({"Karendis": 845266}, SimulationCraft.find_player_dps(dps_str_1))
+
+        batch_report = ("DPS Ranking:\n 2301372 100.0%  Raid\n 1197306  52.0%  Redrimer\n 1104066  48.0%  Verrota\n"
+                        "Player: Redrimer blood_elf rogue subtlety 110\n  DPS: 1197306.2  DPS-Error=1670.7/0.198%\n"
+                        "Player: Verrota undead priest shadow 110\n  DPS: 1104065.7  DPS-Error=1670.7/0.198%\n"
+                        "Target: Fluffy_Pillow humanoid enemy unknown 113\n  DPS: 0.0  DPS-Error=0.0/0.000%\n")
+
+        self.assertEqual({"Redrimer": 1197306, "Verrota": 1104066}, SimulationCraft.find_player_dps(batch_report))
+
+    def test_parse_json_report(self):
+        report = {
+            "version": "735-01",
+            "sim": {
+                "options": {"iterations": 10000, "confidence_estimator": 1.96, "target_error": 0},
+                "statistics": {"elapsed_cpu_seconds": 23.1, "elapsed_time_seconds": 23.125},
+                "players": [{
+                    "name": "Karendis",
+                    "collected_data": {"dps": {"count": 7129, "mean": 845265.6, "mean_std_dev": 1000.0}}
+                }]
+            }
+        }
+
+        result = SimulationCraft.parse_json_report(report)["karendis"]
+
+        self.assertEqual(845266, result["dps"])
+        self.assertAlmostEqual(1960.0, result["dps_error"])
+        self.assertEqual(7129, result["iterations"])
+        self.assertEqual(23.125, result["elapsed_time"])
+
+    @unittest.skipIf(sys.platform == 'win32', "needs a shell script standing in for simc")
+    def test_cancel_kills_simc(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+
+        pid_path = os.path.join(tmp_dir, "simc.pid")
+        simc_path = os.path.join(tmp_dir, "simc")
+
+        # never finishes its sim
+        with open(simc_path, 'w') as f:
+            f.write("#!/bin/sh\necho $$ > %s\nexec sleep 30\n" % pid_path)
+
+        os.chmod(simc_path, 0o755)
+
+        simc = SimulationCraft(simc_path, 60, None, boss_profiles={})
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+
+        async def cancel_sim():
+            sim = asyncio.ensure_future(simc.run_sim("Karendis", "aegwynn", "US", "arms", "1111111", 100))
+
+            while not os.path.exists(pid_path) or not os.path.getsize(pid_path):
+                await asyncio.sleep(0.01)
+
+            sim.cancel()
+
+            with self.assertRaises(asyncio.CancelledError):
+                await sim
+
+        start = time.monotonic()
+        loop.run_until_complete(cancel_sim())
+        self.assertLess(time.monotonic() - start, 5)
+
+        with open(pid_path, 'r') as f:
+            pid = int(f.read())
+
+        # simc is gone, not left running until its timeout
+        with self.assertRaises(ProcessLookupError):
+            os.kill(pid, 0)
+
+    @unittest.skipIf(sys.platform == 'win32', "needs a shell script standing in for simc")
+    def test_forget_results(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+
+        runs_path = os.path.join(tmp_dir, "runs")
+        simc_path = os.path.join(tmp_dir, "simc")
+
+        # notes every run, and reports the DPS of dps_out_1.txt
+        with open(simc_path, 'w') as f:
+            f.write("#!/bin/sh\necho run >> %s\ncat %s\n" % (runs_path, os.path.abspath("dps_out_1.txt")))
+
+        os.chmod(simc_path, 0o755)
+
+        simc = SimulationCraft(simc_path, 60, None, output_format="text", boss_profiles={})
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+
+        def run_sim():
+            return loop.run_until_complete(simc.run_sim("Karendis", "aegwynn", "US", "arms", "1111111", 100))
+
+        def num_runs():
+            with open(runs_path, 'r') as f:
+                return len(f.readlines())
+
+        dps = run_sim()
+        self.assertTrue(dps)
+        self.assertEqual(dps, run_sim())
+        self.assertEqual(1, num_runs())
+
+        # a long-lived instance sims again, gear may have changed since
+        simc.forget_results()
+        self.assertEqual(dps, run_sim())
+        self.assertEqual(2, num_runs())
+
+    @unittest.skipIf(sys.platform == 'win32', "needs a shell script standing in for simc")
+    def test_args_with_spaces(self):
+        tmp_dir = tempfile.mkdtemp(prefix="simc dir ")
+        self.addCleanup(shutil.rmtree, tmp_dir)
+
+        args_path = os.path.join(tmp_dir, "args")
+        simc_path = os.path.join(tmp_dir, "simc")
+
+        # notes every argument on its own line, and reports the DPS of dps_out_1.txt
+        with open(simc_path, 'w') as f:
+            f.write('#!/bin/sh\nfor arg in "$@"; do echo "$arg" >> "%s"; done\ncat %s\n' %
+                    (args_path, os.path.abspath("dps_out_1.txt")))
+
+        os.chmod(simc_path, 0o755)
+
+        profile_path = os.path.join(tmp_dir, "Karendis profile.json")
+        simc = SimulationCraft(simc_path, 60, None, output_format="text", boss_profiles={})
+        simc.set_character_profile("Karendis", "aegwynn", "US", profile_path, "hash")
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+
+        self.assertTrue(loop.run_until_complete(simc.run_sim("Karendis", "aegwynn", "US", "arms", "1111111", 100,
+                                                             fight_style="Patchwerk")))
+
+        with open(args_path, 'r') as f:
+            self.assertEqual(["local_json=%s" % profile_path, "spec=arms", "talents=1111111", "iterations=100",
+                              "fight_style=Patchwerk"], f.read().splitlines())
@@ -2,15 +2,19 @@
 # PyCharm workaround
 from __future__ import absolute_import
 
+import asyncio
 import json
 import os
+import sys
+import tempfile
 import unittest
 import pprint
 
 import time
 
-from src.api.simcraft import SimulationCraft
-from src.simbot import SimcraftBot, SimBotConfig
+from src.api.simcraft import SimJob, SimulationCraft
+from src.api.warcraftlogs import WarcraftLogsError
+from src.simbot import SimBotError, SimcraftBot, SimBotConfig
 from test.mocks.battlenet_mock import BattleNetMock
 from test.mocks.warcraftlogs_mock import WarcraftLogsMock
 
@@ -90,3 +94,304 @@ def setup_iterations(iterations, local=True):
     simc = SimulationCraft(sbc.params["simc_location"], sbc.params["simcraft_timeout"], sbc.params["config_path"])
 
     return SimcraftBot(sbc, bnet, warcr, simc)
+
+
+class FakeSimc:
+    # sims run one at a time, like local simc
+    parallel = False
+    simc_version = "fake"
+
+    def __init__(self, dps=1000000, dps_error=None, fight_dps=None):
+        """
+        Stands in for SimulationCraft, simming every sim at the same DPS.
+        :param dps_error: DPS error of every sim, None to report none, as with text output
+        :param fight_dps: dict of fight style to the DPS of its sims instead
+        """
+        self.dps = dps
+        self.fight_dps = fight_dps or {}
+        self.dps_error = dps_error
+        # hash of every character's profile, None when there is no local profile
+        self.profile_hash = None
+        # SimJob of every sim run
+        self.jobs = []
+
+    def character_profile(self, character_name, realm_slug, region):
+        return None, self.profile_hash
+
+    def is_cached(self, job):
+        return False
+
+    async def run_sim_result(self, character_name, realm_slug, region, spec, talent_string, iterations,
+                             simc_stderr=False, fight_style=None, target_error=None):
+        self.jobs.append(SimJob(character_name, realm_slug, region, spec, talent_string, fight_style, iterations,
+                                target_error))
+
+        result = {"dps": self.fight_dps.get(fight_style, self.dps)}
+
+        if self.dps_error is not None:
+            result.update(dps_error=self.dps_error, iterations=iterations, elapsed_time=1.0)
+
+        return result
+
+
+class TestSimSuites(unittest.TestCase):
+    PROFILES = {"Garothi Worldbreaker": "Ultraxion", "Felhounds of Sargeras": "LightMovement"}
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+        with open('raiding_stats_redrimer.json', 'r') as f:
+            self.raiding_stats = {boss_name: stats for boss_name, stats in json.loads(f.read()).items()
+                                  if boss_name in self.PROFILES}
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def make_bot(self, simc=None, bnet=None, warcr=None, profiles=PROFILES, **kwargs):
+        params = dict(write_logs=False, cache_path=self.tmp_dir.name, talent_cache_ttl=0, roster_cache_ttl=0,
+                      character_profile_ttl=0, suite_cache_ttl=0, result_retention=0)
+        params.update(kwargs)
+
+        sbc = SimBotConfig()
+        sbc.init_args("TestGuild_NoAPI", "TestRealm_NoAPI", "simc", config_path='../config', **params)
+
+        return SimcraftBot(sbc, bnet, warcr, simc or FakeSimc(), profiles)
+
+    @staticmethod
+    def run_suite(sb, raiding_stats, iterations=100, target_error=None, simc=None):
+        loop = asyncio.new_event_loop()
+
+        try:
+            return loop.run_until_complete(sb.sim_single_suite("Redrimer", "arthas", "US", iterations, raiding_stats,
+                                                               target_error, simc))
+        finally:
+            loop.close()
+
+    def test_boss_without_kills_or_profile(self):
+        # warcraftlogs lists every boss the player ever logged, old tiers have no fight profile
+        suite = self.run_suite(self.make_bot(), dict(self.raiding_stats, **{"Old Boss": []}))
+
+        self.assertEqual(["Garothi Worldbreaker", "Felhounds of Sargeras", "Old Boss"],
+                         [boss["boss_name"] for boss in suite["bosses"]])
+        self.assertEqual(SimBotError.NO_KILLS_LOGGED.value, suite["bosses"][2]["error"])
+        self.assertEqual(1000000, suite["bosses"][0]["sim_dps"])
+
+    def test_sort_players(self):
+        simc = FakeSimc()
+        simc.profile_hash = "gear"
+        sb = self.make_bot(simc, suite_cache_ttl=3600)
+        players = [{"name": "Redrimer", "realm": "Arthas"}, {"name": "Nokills", "realm": "Arthas"},
+                   {"name": "Private", "realm": "Arthas"}]
+        all_parses = [dict(self.raiding_stats, **{"Old Boss": []}), {}, WarcraftLogsError("private logs")]
+
+        skipped, reused, to_sim, fingerprints = sb.sort_players(players, all_parses)
+
+        self.assertEqual([{"player_name": "Private", "error": "private logs"}], skipped)
+        self.assertEqual([], reused)
+        self.assertEqual([players[0]], [player for player, _ in to_sim])
+        self.assertEqual(["Redrimer"], list(fingerprints))
+
+        cache_key, fingerprint = fingerprints["Redrimer"]
+        sb._suite_cache.put(cache_key, {"fingerprint": fingerprint, "suite": {"player_name": "Redrimer"}})
+
+        skipped, reused, to_sim, fingerprints = sb.sort_players(players, all_parses)
+        self.assertEqual([{"player_name": "Redrimer", "reused": True}], reused)
+        self.assertEqual([], to_sim)
+
+        # new gear
+        simc.profile_hash = "new gear"
+        skipped, reused, to_sim, fingerprints = sb.sort_players(players, all_parses)
+        self.assertEqual([], reused)
+        self.assertEqual([players[0]], [player for player, _ in to_sim])
+
+    def test_failed_boss_not_stored(self):
+        class FailingSimc(FakeSimc):
+            def __init__(self):
+                super().__init__()
+                self.failing = True
+
+            async def run_sim_result(self, character_name, *args, fight_style=None, **kwargs):
+                if self.failing and character_name == "Redrimer" and fight_style == "Ultraxion":
+                    return False
+
+                return await super().run_sim_result(character_name, *args, fight_style=fight_style, **kwargs)
+
+        simc = FailingSimc()
+        simc.profile_hash = "gear"
+
+        with open('bnet_guild.json', 'rb') as f:
+            bnet_guild = f.read().decode('utf-8')
+
+        with open('bnet_talent.json', 'rb') as f:
+            bnet_talent = f.read().decode('utf-8')
+
+        player_names = ["Redrimer"] + ["empty"] * 6 + ["Lunaraura"] + ["empty"] * 7 + ["Verrota"]
+        warcr_entries = []
+
+        for name in player_names:
+            with open('warcr_%s.json' % name, 'rb') as f:
+                warcr_entries.append(f.read().decode('utf-8'))
+
+        def run_guild():
+            # the suite cache is kept in cache_path, across bots, and the logs cover every boss of the tier
+            sb = self.make_bot(simc, BattleNetMock(bnet_guild, bnet_talent), WarcraftLogsMock('{}', warcr_entries),
+                               profiles=None, suite_cache_ttl=3600)
+            simc.jobs = []
+
+            return sb.run_all_sims()
+
+        result = run_guild()
+        self.assertIn(SimBotError.SIMCRAFT_ERROR.value, [boss.get("error") for boss in result["Redrimer"]["bosses"]])
+        self.assertFalse(SimcraftBot.can_store_suite(result["Redrimer"]))
+
+        # only the suite with the failed boss is simmed again
+        simc.failing = False
+        result = run_guild()
+        self.assertNotIn("reused", result["Redrimer"])
+        self.assertNotIn(SimBotError.SIMCRAFT_ERROR.value, [boss.get("error") for boss in result["Redrimer"]["bosses"]])
+        self.assertTrue(SimcraftBot.can_store_suite(result["Redrimer"]))
+        self.assertEqual({"Redrimer"}, {job.character_name for job in simc.jobs})
+
+    def test_sort_players_without_profile(self):
+        players = [{"name": "Redrimer", "realm": "Arthas"}]
+
+        for sim_cache_ttl, reuse in ((0, False), (3600, True)):
+            sb = self.make_bot(suite_cache_ttl=3600, sim_cache_ttl=sim_cache_ttl)
+            cache_key, fingerprint = sb.suite_fingerprint(players[0], self.raiding_stats)
+            sb._suite_cache.put(cache_key, {"fingerprint": fingerprint, "suite": {"player_name": "Redrimer"}})
+            time.sleep(0.01)
+
+            # gear changes go unseen without a character profile, so suites last no longer than sim results
+            _, reused, _, _ = sb.sort_players(players, [self.raiding_stats])
+            self.assertEqual(reuse, bool(reused))
+
+    def test_suite_fingerprint(self):
+        sb = self.make_bot()
+        player = {"name": "Redrimer", "realm": "Arthas"}
+
+        cache_key, fingerprint = sb.suite_fingerprint(player, self.raiding_stats)
+        self.assertEqual((cache_key, fingerprint), sb.suite_fingerprint({"name": "redrimer", "realm": "Arthas"},
+                                                                        self.raiding_stats))
+
+        # bosses without kills need no fight profile
+        self.assertEqual(cache_key, sb.suite_fingerprint(player, dict(self.raiding_stats, **{"Old Boss": []}))[0])
+
+        changed = json.loads(json.dumps(self.raiding_stats))
+        changed["Garothi Worldbreaker"][0]["talents"] = "1111111"
+        self.assertEqual(cache_key, sb.suite_fingerprint(player, changed)[0])
+        self.assertNotEqual(fingerprint, sb.suite_fingerprint(player, changed)[1])
+
+        self.assertNotEqual(fingerprint, self.make_bot(simc_iter=200).suite_fingerprint(player,
+                                                                                             self.raiding_stats)[1])
+
+    def test_first_pass_options(self):
+        self.assertEqual((1000, 0.5), self.make_bot().first_pass_options(1000, 0.5))
+        self.assertEqual((50, None), self.make_bot(screening_iterations=50).first_pass_options(1000, 0.5))
+
+    def test_needs_refinement(self):
+        sb = self.make_bot(screening_iterations=50, screening_threshold=80, screening_margin=10,
+                           screening_max_error=1.0)
+
+        # close to the threshold
+        self.assertTrue(sb.needs_refinement({"percent_potential": 75, "sim_dps": 100000}))
+        self.assertFalse(sb.needs_refinement({"percent_potential": 60, "sim_dps": 100000}))
+        # too imprecise
+        self.assertTrue(sb.needs_refinement({"percent_potential": 60, "sim_dps": 100000, "sim_dps_error": 2000}))
+        self.assertFalse(sb.needs_refinement({"percent_potential": 60, "sim_dps": 100000, "sim_dps_error": 500}))
+
+    def test_refinement(self):
+        # Garothi's kills average about 80% of this, Felhounds' about 54% of the default
+        simc = FakeSimc(dps_error=1000, fight_dps={"Ultraxion": 1345000})
+        sb = self.make_bot(simc, screening_iterations=10)
+
+        suite = self.run_suite(sb, self.raiding_stats, iterations=1000, target_error=0.1)
+
+        garothi, felhounds = suite["bosses"]
+        self.assertEqual("refined", garothi["sim_stage"])
+        self.assertEqual(1000, garothi["sim_iterations"])
+        self.assertEqual("screening", felhounds["sim_stage"])
+        self.assertEqual(10, felhounds["sim_iterations"])
+
+        # screened without a target error, then only Garothi refined with both
+        self.assertEqual([(10, None), (10, None), (1000, 0.1)],
+                         [(job.iterations, job.target_error) for job in simc.jobs])
+
+    def test_set_screening_options(self):
+        sb = self.make_bot()
+        screening = self.make_bot(screening_iterations=10, screening_threshold=70).screening_options()
+
+        self.assertIsNone(sb.screening_options())
+
+        # as a sim worker's SimcraftBot gets them with each suite
+        sb.set_screening_options(screening)
+        self.assertEqual(screening, sb.screening_options())
+        self.assertEqual((10, None), sb.first_pass_options(1000, 0.1))
+
+        sb.set_screening_options(None)
+        self.assertEqual((1000, 0.1), sb.first_pass_options(1000, 0.1))
+
+    def test_plan_sims_cached(self):
+        simc = FakeSimc()
+        simc.is_cached = lambda job: True
+        players = [{"name": "Redrimer", "realm": "Arthas"}]
+
+        plan = self.make_bot(simc, sim_backend="lambda").plan_sims(players, [self.raiding_stats])
+        self.assertEqual([True, True], list(plan.jobs.values()))
+
+        # queue workers and invoked suites don't look in this sim cache
+        for sim_backend, lambda_work_unit in (("queue", "sim"), ("lambda", "suite")):
+            plan = self.make_bot(simc, sim_backend=sim_backend, lambda_work_unit=lambda_work_unit).plan_sims(
+                players, [self.raiding_stats])
+            self.assertEqual([False, False], list(plan.jobs.values()))
+
+    @unittest.skipIf(sys.platform == 'win32', "needs a shell script standing in for simc")
+    def test_target_error(self):
+        args_path = os.path.join(self.tmp_dir.name, "simc_args")
+        simc_path = os.path.join(self.tmp_dir.name, "simc")
+
+        # notes the options of every run, and reports the DPS of dps_out_1.txt
+        with open(simc_path, 'w') as f:
+            f.write('#!/bin/sh\necho "$@" >> %s\ncat %s\n' % (args_path, os.path.abspath("dps_out_1.txt")))
+
+        os.chmod(simc_path, 0o755)
+
+        class Connector:
+            def __init__(self):
+                self.queued = []
+
+            def queue_sim(self, sim_coro, *args, priority=0, **kwargs):
+                self.queued.append((sim_coro, args, kwargs))
+
+        def run_guild_suite(sim_target_error):
+            sbc = SimBotConfig()
+            sbc.init_args("TestGuild_NoAPI", "TestRealm_NoAPI", simc_path, config_path='../config', write_logs=False,
+                          cache_path=self.tmp_dir.name, simc_output_format="text",
+                          sim_target_error=sim_target_error, talent_cache_ttl=0, roster_cache_ttl=0,
+                          character_profile_ttl=0, suite_cache_ttl=0, result_retention=0)
+            sb = SimcraftBot(sbc, None, None, None, self.PROFILES)
+
+            connector = Connector()
+            sb.queue_suite("Redrimer", "Arthas", self.raiding_stats, connector)
+            sim_coro, args, kwargs = connector.queued.pop()
+
+            loop = asyncio.new_event_loop()
+
+            try:
+                loop.run_until_complete(sim_coro(*args, **kwargs))
+            finally:
+                loop.close()
+
+            with open(args_path, 'r') as f:
+                return f.read().splitlines()
+
+        runs = run_guild_suite(0.5)
+        self.assertEqual(2, len(runs))
+        self.assertTrue(all("target_error=0.5" in run.split() for run in runs))
+
+        # the same sims come from the sim cache
+        self.assertEqual(2, len(run_guild_suite(0.5)))
+
+        # not the result of another target error
+        runs = run_guild_suite(0.25)
+        self.assertEqual(4, len(runs))
+        self.assertTrue(all("target_error=0.25" in run.split() for run in runs[2:]))
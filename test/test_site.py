@@ -0,0 +1,66 @@
+# PyCharm workaround
+from __future__ import absolute_import
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from src.cache.result_store import ResultStore
+
+try:
+    import flask_socketio
+except ImportError:
+    flask_socketio = None
+
+
+@unittest.skipIf(flask_socketio is None, "needs Flask and Flask-SocketIO")
+class TestSite(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # the site reads simbot_params.json from its own directory
+        cwd = os.getcwd()
+        os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "site"))
+
+        try:
+            from src.site import site
+        finally:
+            os.chdir(cwd)
+
+        cls.site = site
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.result_store = ResultStore(os.path.join(self.tmp_dir.name, "results.db"))
+
+        patcher = mock.patch.object(self.site, "result_store", self.result_store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.client = self.site.app.test_client()
+
+    def tearDown(self):
+        self.result_store.close()
+        self.tmp_dir.cleanup()
+
+    def test_guild_results(self):
+        # stored under the realm's name, asked for by its slug
+        etag = self.result_store.put("US", "Area 52", "Clutch", "heroic", 3, {"guild_avg": 80.0},
+                                     {"iterations": 100})
+
+        response = self.client.get("/results/us/area-52/clutch")
+        self.assertEqual(200, response.status_code)
+        self.assertEqual({"guild_avg": 80.0}, response.get_json()["data"])
+        self.assertEqual(etag, response.get_etag()[0])
+
+        # the client already has this report
+        response = self.client.get("/results/us/area-52/clutch", headers={"If-None-Match": '"%s"' % etag})
+        self.assertEqual(304, response.status_code)
+
+        response = self.client.get("/results/us/area-52/clutch?difficulty=mythic")
+        self.assertEqual(404, response.status_code)
+        self.assertEqual("error", response.get_json()["status"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+# PyCharm workaround
+from __future__ import absolute_import
+
+import json
+import tempfile
+import unittest
+
+from src.api.warcraftlogs import WarcraftLogs
+from src.cache.talent_store import TalentStore
+
+with open("7_1_5_talents.json", 'r') as f:
+    talent_dump = json.loads(f.read())
+
+
+class TestTalentStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.fetches = 0
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def fetch(self, locale):
+        self.fetches += 1
+
+        return talent_dump
+
+    def test_stored_between_runs(self):
+        talent_data, talent_index = TalentStore(self.tmp_dir.name, 60, "7.1.5").get("en_US", self.fetch)
+        stored_data, stored_index = TalentStore(self.tmp_dir.name, 60, "7.1.5").get("en_US", self.fetch)
+
+        self.assertEqual(1, self.fetches)
+        self.assertEqual(talent_data, stored_data)
+        self.assertEqual(WarcraftLogs.build_talent_index(talent_dump), stored_index)
+
+    def test_refresh(self):
+        TalentStore(self.tmp_dir.name, 60, "7.1.5").get("en_US", self.fetch)
+
+        # new patch
+        TalentStore(self.tmp_dir.name, 60, "7.2.0").get("en_US", self.fetch)
+        self.assertEqual(2, self.fetches)
+
+        # expired
+        TalentStore(self.tmp_dir.name, 0, "7.2.0").get("en_US", self.fetch)
+        self.assertEqual(3, self.fetches)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,14 @@
 # PyCharm workaround
 from __future__ import absolute_import
 
+import asyncio
 import json
 import unittest
+from unittest import mock
 
-from src.api.warcraftlogs import WarcraftLogs
+from aiohttp import web
+
+from src.api.warcraftlogs import WarcraftLogs, WarcraftLogsError
 
 with open("sample_warcraftlogs_api_response.json", 'r') as f:
     api_stub = json.loads(f.read())
@@ -93,5 +97,92 @@ class TestWarcraftLogs(unittest.TestCase):
 
         self.assertIsNotNone(result)
 
+
+class TestWarcraftLogsAsync(unittest.TestCase):
+    def setUp(self):
+        self.wl = WarcraftLogs("")
+        self.wl.set_talent_data(talent_dump)
+        self.wl.RATE_LIMIT_BACKOFF_SEC = 0.01
+        # requests received for each character
+        self.requests = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def handle(self, request):
+        character_name = request.match_info["character_name"]
+        self.requests[character_name] = self.requests.get(character_name, 0) + 1
+
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+        try:
+            await asyncio.sleep(0.01)
+
+            if character_name == "throttled" and self.requests[character_name] == 1:
+                return web.json_response({"error": "Too many requests"}, status=429, headers={"Retry-After": "0"})
+            elif character_name == "backoff" and self.requests[character_name] <= 2:
+                return web.json_response({"error": "Too many requests"}, status=429)
+            elif character_name == "always_throttled":
+                return web.json_response({"error": "Too many requests"}, status=429)
+            elif character_name == "dropped":
+                # connection closed without a response
+                request.transport.close()
+
+            return web.json_response(api_stub)
+        finally:
+            self.in_flight -= 1
+
+    def get_parses(self, players, max_concurrent_requests=8):
+        async def run():
+            app = web.Application()
+            app.router.add_get("/parses/character/{character_name}/{server}/{region}", self.handle)
+            runner = web.AppRunner(app)
+            await runner.setup()
+            site = web.TCPSite(runner, "127.0.0.1", 0)
+            await site.start()
+
+            port = site._server.sockets[0].getsockname()[1]
+
+            try:
+                with mock.patch("src.api.warcraftlogs.API_URL", "http://127.0.0.1:%d/" % port):
+                    # 999 weeks to prevent breaking dataset
+                    return await self.wl.get_parses_for_players([(name, "arthas") for name in players], "US",
+                                                                "dps", "heroic", 999, max_concurrent_requests)
+            finally:
+                await runner.cleanup()
+
+        loop = asyncio.new_event_loop()
+
+        try:
+            return loop.run_until_complete(run())
+        finally:
+            loop.close()
+
+    def test_rate_limit_retried(self):
+        self.wl.MAX_RATE_LIMIT_RETRIES = 2
+        results = self.get_parses(["throttled", "backoff", "always_throttled"])
+
+        # retried after Retry-After, or after backing off without one
+        self.assertIsInstance(results[0], dict)
+        self.assertEqual(2, self.requests["throttled"])
+        self.assertIsInstance(results[1], dict)
+        self.assertEqual(3, self.requests["backoff"])
+        # out of retries
+        self.assertIsInstance(results[2], WarcraftLogsError)
+        self.assertEqual(3, self.requests["always_throttled"])
+
+    def test_failure_isolated(self):
+        results = self.get_parses(["ok", "dropped"])
+
+        self.assertIsInstance(results[0], dict)
+        self.assertIsInstance(results[1], WarcraftLogsError)
+
+    def test_concurrency_limit(self):
+        results = self.get_parses(["player%d" % i for i in range(12)], max_concurrent_requests=3)
+
+        self.assertEqual(12, len([result for result in results if isinstance(result, dict)]))
+        self.assertLessEqual(self.max_in_flight, 3)
+
+
 if __name__ == '__main__':
     unittest.main()
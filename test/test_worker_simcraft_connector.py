@@ -0,0 +1,128 @@
+# PyCharm workaround
+from __future__ import absolute_import
+
+import asyncio
+import threading
+import time
+import unittest
+
+from aiohttp import web
+
+from src.connectors.simcraft_connectors.worker_simcraft_connector import WorkerSimcraftConnector
+
+
+class TestWorkerSimcraftConnector(unittest.TestCase):
+    def setUp(self):
+        # worker name to sims it ran, and to the most it ran at once
+        self.sims = {}
+        self.max_in_flight = {}
+        self.in_flight = {}
+
+    def worker_app(self, name, healthy=True):
+        async def health(request):
+            return web.json_response({"status": "ok"}, status=200 if healthy else 503)
+
+        async def sim(request):
+            job = (await request.json())["sim_job"]
+
+            self.sims.setdefault(name, []).append(job["fight_style"])
+            self.in_flight[name] = self.in_flight.get(name, 0) + 1
+            self.max_in_flight[name] = max(self.max_in_flight.get(name, 0), self.in_flight[name])
+
+            try:
+                await asyncio.sleep(0.02)
+                return web.json_response({"result": {"dps": 1000}})
+            finally:
+                self.in_flight[name] -= 1
+
+        app = web.Application()
+        app.router.add_get("/health", health)
+        app.router.add_post("/", sim)
+
+        return app
+
+    @staticmethod
+    async def suite(player, realm_slug, region, iterations, raiding_stats, simc=None):
+        results = await asyncio.gather(*[simc.run_sim_result(player, realm_slug, region, "Fire", "1111111",
+                                                             iterations, fight_style="style%d" % i)
+                                         for i in range(6)])
+
+        return {"player_name": player, "results": results}
+
+    def run_workers(self, workers, players=("a", "b"), retry_delay=0.01):
+        """
+        :param workers: list of (worker name, True if healthy)
+        :param players: Players whose suites are run
+        :param retry_delay: Backoff before a request is retried
+        :return: (connector, suites)
+        """
+        runners = []
+
+        async def start():
+            urls = []
+
+            for name, healthy in workers:
+                runner = web.AppRunner(self.worker_app(name, healthy))
+                await runner.setup()
+                site = web.TCPSite(runner, "127.0.0.1", 0)
+                await site.start()
+                runners.append(runner)
+
+                urls.append("http://127.0.0.1:%d" % site._server.sockets[0].getsockname()[1])
+
+            return urls
+
+        async def stop():
+            for runner in runners:
+                await runner.cleanup()
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        urls = loop.run_until_complete(start())
+
+        sc = WorkerSimcraftConnector({"workers": urls}, max_retries=1)
+        sc.RETRY_BASE_DELAY_SEC = retry_delay
+
+        # the connector runs on its own loop, the workers keep serving from a thread
+        for player in players:
+            sc.queue_sim(self.suite, player, "arthas", "US", 100, {})
+
+        worker_thread = threading.Thread(target=loop.run_forever)
+        worker_thread.start()
+
+        try:
+            return sc, sc.get_completed_sims()
+        finally:
+            loop.call_soon_threadsafe(loop.stop)
+            worker_thread.join()
+            loop.run_until_complete(stop())
+            loop.close()
+
+    def test_least_outstanding(self):
+        _, suites = self.run_workers([("w1", True), ("w2", True), ("w3", True)])
+
+        self.assertEqual([{"dps": 1000}] * 6, suites[0]["results"])
+        self.assertEqual(12, sum(len(sims) for sims in self.sims.values()))
+        # spread over every worker, one sim at a time each
+        self.assertEqual({"w1", "w2", "w3"}, set(self.sims))
+        self.assertEqual({1}, set(self.max_in_flight.values()))
+
+    def test_unhealthy_worker_skipped(self):
+        _, suites = self.run_workers([("w1", True), ("down", False)])
+
+        self.assertEqual([{"dps": 1000}] * 6, suites[1]["results"])
+        self.assertEqual(["w1"], list(self.sims))
+
+    def test_first_health_check_shared(self):
+        start = time.monotonic()
+        sc, suites = self.run_workers([("w1", True), ("w2", True), ("w3", True), ("w4", True)],
+                                      players=["a", "b", "c"], retry_delay=1)
+
+        self.assertEqual([[{"dps": 1000}] * 6] * 3, [suite["results"] for suite in suites])
+        # requests arriving during the first health checks wait for them, they are neither retried nor throttle
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(4, sc._concurrency.limit)
+
+
+if __name__ == '__main__':
+    unittest.main()